@@ -1,14 +1,115 @@
 """AWS client initialization module for Cognito backup/restore operations."""
 
+import json
+import threading
+from typing import Any, Dict, Optional, Tuple
 import boto3
+from botocore.config import Config as BotoConfig
 from .config import Config
 
+# Every Cognito call goes through AIMDController, which needs to see every
+# TooManyRequestsException to adjust its concurrency limit and retries
+# throttles and transient failures itself
+COGNITO_CLIENT_CONFIG = BotoConfig(retries={'mode': 'standard', 'max_attempts': 1})
+
+def _config_key(config: Optional[BotoConfig]) -> Optional[str]:
+    """Canonical form of botocore settings: equal settings give equal keys."""
+    if config is None:
+        return None
+    return json.dumps(
+        {name: getattr(config, name) for name in BotoConfig.OPTION_DEFAULTS},
+        sort_keys=True, default=repr
+    )
+
+class ClientRegistry:
+    """
+    Process-wide cache of boto3 clients, reused by warm Lambda invocations.
+
+    Clients are created on first use and keyed by service, region and
+    botocore settings (compared by value, so equal Config objects share a
+    client), so a warm invocation skips client construction and keeps its
+    connection pools. boto3 clients are thread-safe; only their creation is locked.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._clients: Dict[Tuple[str, Optional[str], Optional[str]], Any] = {}
+        self._lock = threading.Lock()
+
+    def client(self, service_name: str, region_name: Optional[str],
+               config: Optional[BotoConfig] = None):
+        """
+        Return the cached client for a service, creating it on first use.
+
+        Args:
+            service_name: AWS service name (e.g. 's3')
+            region_name: AWS region of the client
+            config: botocore settings of the client
+
+        Returns:
+            boto3 client
+        """
+        key = (service_name, region_name, _config_key(config))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+            client = boto3.client(service_name, region_name=region_name, config=config)
+            self._clients[key] = client
+            return client
+
+    def stats(self) -> Dict[str, int]:
+        """Cache hits, misses and clients held."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'clients': len(self._clients)}
+
+    def clear(self) -> None:
+        """Drop every cached client and reset the counters."""
+        with self._lock:
+            self._clients.clear()
+            self.hits = 0
+            self.misses = 0
+
+CLIENT_REGISTRY = ClientRegistry()
+
 class AWSClients:
-    """Manages AWS client initialization for Cognito, S3, and DynamoDB."""
+    """
+    Manages AWS client initialization for Cognito, S3, DynamoDB, Lambda and SQS.
 
-    def __init__(self, config: Config):
-        self.cognito_client = boto3.client('cognito-idp', region_name=config.region)
-        self.s3_client = boto3.client('s3', region_name=config.region)
-        self.dynamodb_client = boto3.client('dynamodb', region_name=config.region)
+    Clients come from a ClientRegistry (the process-wide one by default) and
+    are only created when first used.
+    """
+
+    def __init__(self, config: Config, registry: Optional[ClientRegistry] = None):
+        self.region = config.region
+        self.registry = registry or CLIENT_REGISTRY
         self.bucket_name = config.backup_bucket_name
-        self.dynamodb_table = config.dynamodb_table_name
\ No newline at end of file
+        self.dynamodb_table = config.dynamodb_table_name
+
+    @property
+    def cognito_client(self):
+        """Cognito user pools client (no botocore retries, see COGNITO_CLIENT_CONFIG)."""
+        return self.registry.client('cognito-idp', self.region, COGNITO_CLIENT_CONFIG)
+
+    @property
+    def s3_client(self):
+        """S3 client."""
+        return self.registry.client('s3', self.region)
+
+    @property
+    def dynamodb_client(self):
+        """DynamoDB client."""
+        return self.registry.client('dynamodb', self.region)
+
+    @property
+    def lambda_client(self):
+        """Lambda client."""
+        return self.registry.client('lambda', self.region)
+
+    @property
+    def sqs_client(self):
+        """SQS client."""
+        return self.registry.client('sqs', self.region)
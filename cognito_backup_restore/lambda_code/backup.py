@@ -1,24 +1,56 @@
 """Backup module for AWS Cognito User Pool operations."""
 
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, UTC
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 from botocore.exceptions import ClientError
 from .aws_clients import AWSClients
 from .config import logger
+from .backup_format import (
+    ShardedBackupWriter, DEFAULT_SHARD_SIZE, latest_backup, load_catalog, load_manifest,
+    load_membership_index, load_user_index, record_backup, write_membership_index
+)
+from .checkpoint import BackupCheckpoint
+from .concurrency import AIMDController
+from .s3_writer import S3MultipartWriter, DEFAULT_PART_SIZE
+from .time_budget import TimeBudget
 
 class CognitoBackup:
     """Handles backup operations for AWS Cognito User Pools."""
 
-    def __init__(self, aws_clients: AWSClients):
+    def __init__(self, aws_clients: AWSClients, membership_strategy: str = 'group',
+                 part_size: int = DEFAULT_PART_SIZE, backup_format: str = 'v1',
+                 shard_size: int = DEFAULT_SHARD_SIZE, max_workers: int = 8,
+                 time_budget: Optional[TimeBudget] = None):
         self.aws_clients = aws_clients
+        self.time_budget = time_budget or TimeBudget()
+        self.max_workers = max_workers
+        self.concurrency = AIMDController(
+            max_limit=max_workers, initial_limit=max(1, max_workers // 2)
+        )
+        self.membership_strategy = membership_strategy
+        self.part_size = part_size
+        self.backup_format = backup_format
+        self.shard_size = shard_size
 
-    def backup_user_pool(self, user_pool_id: str) -> Dict[str, Any]:
+    def backup_user_pool(self, user_pool_id: str, incremental: bool = False) -> Dict[str, Any]:
         """
         Backup Cognito User Pool users and groups (no clients).
+
+        Users are streamed to S3 page by page, so memory use is bounded by the
+        upload part size (v1) or shard size (v2) rather than the size of the pool.
+        Incremental backups always use the v2 layout and store only the users
+        added, changed or deleted since the pool's previous v2 backup; without a
+        previous v2 backup a full snapshot is taken instead. v2 backups record a
+        checkpoint after every shard, so resume_backup can finish them in a
+        later invocation; v1 backups must fit in one invocation. The group
+        membership index is only built while the time budget lasts and is
+        saved with a v2 backup's checkpoint for its resumes.
         
         Args:
             user_pool_id: The ID of the user pool to backup
+            incremental: Whether to back up only the changes since the last backup
             
         Returns:
             Dict containing backup status and statistics
@@ -28,101 +60,529 @@ class CognitoBackup:
         """
         try:
             # Get user pool details
-            user_pool = self.aws_clients.cognito_client.describe_user_pool(
-                UserPoolId=user_pool_id
+            user_pool = self.concurrency.call(
+                self.aws_clients.cognito_client.describe_user_pool, UserPoolId=user_pool_id
             )
 
-            # Get users (paginated) with embedded group memberships
-            users = self._get_users_with_groups(user_pool_id)
+            previous = self._get_previous_backup(user_pool_id) if incremental else None
 
             # Get groups
             groups = self._get_groups(user_pool_id)
+            membership_index = self._get_membership_index(user_pool_id, groups)
+            membership_strategy = 'group' if membership_index is not None else 'user'
 
-            # Create backup object (no clients)
-            backup_data = {
-                'timestamp': datetime.now(UTC).isoformat(),
+            started_at = datetime.now(UTC)
+            header = {
+                'timestamp': started_at.isoformat(),
                 'user_pool': user_pool['UserPool'],
-                'users': users,
+                'membership_strategy': membership_strategy,
                 'groups': groups
             }
-
-            # Save to S3
-            backup_key = (
+            backup_prefix = (
                 f"cognito-backups/{user_pool_id}/"
-                f"{datetime.now(UTC).strftime('%Y-%m-%d_%H-%M-%S')}.json"
+                f"{started_at.strftime('%Y-%m-%d_%H-%M-%S')}"
             )
 
-            self.aws_clients.s3_client.put_object(
-                Bucket=self.aws_clients.bucket_name,
-                Key=backup_key,
-                Body=json.dumps(backup_data, default=str, indent=2),
-                ContentType='application/json'
+            if self.backup_format == 'v2' or incremental:
+                # A v2 backup spans many objects, so its prefix must never be
+                # shared with another backup taken within the same second
+                backup_prefix = f"{backup_prefix}-{started_at.strftime('%f')}"
+                membership_index_key = None
+                if membership_index is not None:
+                    membership_index_key = f'{backup_prefix}/membership-index.ndjson'
+                    write_membership_index(
+                        self.aws_clients.s3_client, self.aws_clients.bucket_name,
+                        membership_index_key, membership_index
+                    )
+                checkpoint = BackupCheckpoint.create(
+                    self.aws_clients.s3_client, self.aws_clients.bucket_name, user_pool_id,
+                    backup_prefix, header, previous['manifest_key'] if previous else None,
+                    membership_index_key
+                )
+                return self._write_sharded_backup(checkpoint, membership_index, previous)
+
+            # Get users (paginated) with embedded group memberships
+            pages = self._iter_users_with_groups(user_pool_id, membership_index)
+            backup_key, users_backed_up = self._write_legacy_backup(
+                f"{backup_prefix}.json", header, pages
             )
 
             logger.info("Backup completed for user pool %s", user_pool_id)
             return {
                 'status': 'success',
                 'backup_location': f"s3://{self.aws_clients.bucket_name}/{backup_key}",
-                'users_backed_up': len(users),
-                'groups_backed_up': len(groups)
+                'backup_format': 'v1',
+                'users_backed_up': users_backed_up,
+                'groups_backed_up': len(groups),
+                'membership_strategy': membership_strategy,
+                'concurrency': self.concurrency.stats()
             }
 
         except ClientError as exc:
             logger.error("Backup failed for user pool %s: %s", user_pool_id, str(exc))
             raise
 
-    def _get_users_with_groups(self, user_pool_id: str) -> List[Dict[str, Any]]:
+    def resume_backup(self, checkpoint: BackupCheckpoint) -> Dict[str, Any]:
+        """
+        Continue a v2 backup from its checkpoint ledger.
+
+        Listing restarts at the recorded PaginationToken; the header (and so
+        the groups) recorded when the backup started are kept, as is the
+        group membership index saved with the checkpoint.
+        
+        Args:
+            checkpoint: Ledger loaded with load_checkpoint
+            
+        Returns:
+            Dict containing backup status and statistics; the recorded result
+            if the backup had already finished
+        """
+        if checkpoint.complete:
+            logger.info("Backup %s already finished", checkpoint.key)
+            return checkpoint.result
+
+        checkpoint.start_invocation()
+        user_pool_id = checkpoint.state['user_pool_id']
+        header = checkpoint.state['header']
+        previous = None
+        if checkpoint.state['previous_manifest_key']:
+            previous = self._load_previous_backup(checkpoint.state['previous_manifest_key'])
+
+        membership_index = None
+        if header['membership_strategy'] == 'group' and not checkpoint.state['listing_complete']:
+            if checkpoint.state.get('membership_index_key'):
+                membership_index = load_membership_index(
+                    self.aws_clients.s3_client, self.aws_clients.bucket_name,
+                    checkpoint.state['membership_index_key']
+                )
+            else:
+                membership_index = self._build_group_membership_index(
+                    user_pool_id, header['groups']
+                )
+            if membership_index is None:
+                # Groups could not be listed (or the budget ran out); look
+                # memberships up per user like the 'user' strategy
+                header['membership_strategy'] = 'user'
+        return self._write_sharded_backup(checkpoint, membership_index, previous)
+
+    def _get_previous_backup(self, user_pool_id: str) -> Optional[Dict[str, Any]]:
         """
-        Get all users from the user pool with their group memberships embedded.
+        Get the latest v2 backup of the user pool to base an incremental backup on.
         
         Args:
             user_pool_id: The ID of the user pool
             
         Returns:
-            List of user objects with embedded group memberships
-        """
-        users = []
-        paginator = self.aws_clients.cognito_client.get_paginator('list_users')
-
-        for page in paginator.paginate(UserPoolId=user_pool_id):
-            for user in page['Users']:
-                # Enhance user object with group memberships
-                username = user['Username']
-                user_groups = []
-                try:
-                    user_groups_response = self.aws_clients.cognito_client.admin_list_groups_for_user(
-                        UserPoolId=user_pool_id,
-                        Username=username
-                    )
-                    user_groups = [
-                        group['GroupName'] for group in user_groups_response['Groups']
+            Dict with the previous 'manifest_key', 'manifest' and user 'index',
+            or None if the pool has no v2 backup yet
+        """
+        entry = latest_backup(
+            load_catalog(self.aws_clients.s3_client, self.aws_clients.bucket_name, user_pool_id)
+        )
+        if entry is None:
+            logger.info(
+                "No previous v2 backup of user pool %s, taking a full snapshot", user_pool_id
+            )
+            return None
+        return self._load_previous_backup(entry['manifest_key'])
+
+    def _load_previous_backup(self, manifest_key: str) -> Dict[str, Any]:
+        """
+        Load the manifest and user index of the backup an incremental is based on.
+        
+        Args:
+            manifest_key: S3 key of the previous backup's manifest
+            
+        Returns:
+            Dict with the previous 'manifest_key', 'manifest' and user 'index'
+        """
+        s3_client = self.aws_clients.s3_client
+        bucket = self.aws_clients.bucket_name
+        manifest = load_manifest(s3_client, bucket, manifest_key)
+        return {
+            'manifest_key': manifest_key,
+            'manifest': manifest,
+            'index': load_user_index(s3_client, bucket, manifest)
+        }
+
+    def _write_legacy_backup(self, backup_key: str, header: Dict[str, Any],
+                             pages: Iterator[List[Dict[str, Any]]]) -> Tuple[str, int]:
+        """
+        Stream a single-file (v1) backup document to S3 via a multipart upload.
+
+        Groups are written ahead of users so readers can restore them before the
+        first user arrives.
+        
+        Args:
+            backup_key: S3 key of the backup file
+            header: Backup-level fields (timestamp, user_pool, groups, ...)
+            pages: Pages of users from _iter_users_with_groups
+            
+        Returns:
+            Tuple of (backup key, number of users written)
+        """
+        users_backed_up = 0
+        with S3MultipartWriter(
+            self.aws_clients.s3_client,
+            self.aws_clients.bucket_name,
+            backup_key,
+            part_size=self.part_size
+        ) as writer:
+            writer.write(json.dumps(header, default=str)[:-1] + ', "users": [')
+            for page, _ in pages:
+                for user in page:
+                    separator = ',\n' if users_backed_up else '\n'
+                    writer.write(separator + json.dumps(user, default=str))
+                    users_backed_up += 1
+            writer.write('\n]}')
+
+        return backup_key, users_backed_up
+
+    def _write_sharded_backup(self, checkpoint: BackupCheckpoint,
+                              membership_index: Optional[Dict[str, List[str]]],
+                              previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Write a sharded (v2) backup: NDJSON user shards, user index and manifest,
+        then record it in the user pool's backup catalog.
+
+        Listing starts (or resumes) at the checkpoint's PaginationToken. Every
+        time a shard or index part is flushed, the remaining buffers are flushed
+        too and the checkpoint records the shards written and the token of the
+        next page. Once the time budget runs out the buffers are flushed, the
+        checkpoint is recorded and an 'in_progress' result is returned. The
+        manifest is written once the listing has finished.
+
+        When a previous backup is given only users that are new, whose
+        UserLastModifiedDate or groups differ from the previous index, or that
+        have been deleted are stored, and the backup is chained to the previous
+        backup's base snapshot.
+        
+        Args:
+            checkpoint: Ledger of the backup
+            membership_index: Index from _get_membership_index, or None to look
+                memberships up per user
+            previous: Previous backup from _get_previous_backup, for incrementals
+            
+        Returns:
+            Dict containing backup status and statistics, or the checkpoint
+            to resume from if the time budget ran out
+        """
+        s3_client = self.aws_clients.s3_client
+        bucket = self.aws_clients.bucket_name
+        state = checkpoint.state
+        user_pool_id = state['user_pool_id']
+        header = dict(state['header'])
+        writer = ShardedBackupWriter(
+            s3_client, bucket, state['backup_prefix'],
+            shard_size=self.shard_size,
+            part_size=self.part_size
+        )
+        writer.load_state(state['writer'])
+
+        # Users still left in the previous index once the pool has been
+        # listed no longer exist and are recorded as deletions
+        previous_index = previous['index'] if previous else None
+        if previous_index is not None and writer.index_keys:
+            for username in load_user_index(s3_client, bucket, {'index_keys': writer.index_keys}):
+                previous_index.pop(username, None)
+
+        users_total = state['users_total']
+        users_changed = state['users_changed']
+        if not state['listing_complete']:
+            for users, next_token in self._iter_users_with_groups(
+                    user_pool_id, membership_index, state['pagination_token']):
+                if previous_index is None:
+                    flushed = writer.add_page(users)
+                    changed = users
+                else:
+                    changed = [
+                        user for user in users
+                        if self._user_changed(user, previous_index.pop(user['Username'], None))
                     ]
-                    if user_groups:
-                        logger.info("User %s belongs to groups: %s", username, user_groups)
-                except ClientError as exc:
-                    logger.warning("Could not retrieve groups for user %s: %s", username, exc)
+                    flushed = writer.add_page(changed, index_users=users)
+                users_total += len(users)
+                users_changed += len(changed)
+                if not next_token:
+                    continue
+                out_of_time = self.time_budget.exhausted()
+                if flushed or out_of_time:
+                    writer.flush()
+                    checkpoint.record_listing(
+                        next_token, writer.state(), users_total, users_changed
+                    )
+                if out_of_time:
+                    logger.info(
+                        "Backup of user pool %s paused after %d users, resume from %s",
+                        user_pool_id, users_total, checkpoint.key
+                    )
+                    return {
+                        'status': 'in_progress',
+                        'user_pool_id': user_pool_id,
+                        'checkpoint_key': checkpoint.key,
+                        'users_listed': users_total,
+                        'shards_written': len(writer.shards),
+                        'invocations': state['invocations'],
+                        'concurrency': self.concurrency.stats()
+                    }
+            writer.flush()
+            checkpoint.record_listing(None, writer.state(), users_total, users_changed)
+
+        if previous is None:
+            header.update({'backup_type': 'full', 'chain': []})
+            manifest = writer.write_manifest(header)
+            stats = {'users_backed_up': manifest['users_backed_up']}
+        else:
+            deleted = sorted(previous_index)
+            writer.add_page(
+                [{'Username': username, 'Deleted': True} for username in deleted],
+                index_users=[]
+            )
+
+            previous_manifest = previous['manifest']
+            groups_changed = header['groups'] != previous_manifest['groups']
+            if not groups_changed:
+                header['groups'] = previous_manifest['groups']
+            header.update({
+                'backup_type': 'incremental',
+                'chain': previous_manifest['chain'] + [previous['manifest_key']],
+                'users_total': users_total,
+                'users_changed': users_changed,
+                'users_deleted': len(deleted),
+                'groups_changed': groups_changed
+            })
+            manifest = writer.write_manifest(header)
+            stats = {
+                'users_backed_up': users_changed,
+                'users_deleted': len(deleted),
+                'users_unchanged': users_total - users_changed,
+                'groups_changed': groups_changed,
+                'base_backup': manifest['chain'][0]
+            }
 
-                # Add groups to user object
-                user['Groups'] = user_groups
-                users.append(user)
+        record_backup(
+            s3_client, bucket, user_pool_id,
+            {
+                'manifest_key': writer.manifest_key,
+                'backup_type': manifest['backup_type'],
+                'timestamp': manifest['timestamp'],
+                'users_total': manifest['users_total'],
+                'chain': manifest['chain']
+            }
+        )
 
-        return users
+        logger.info("Backup completed for user pool %s", user_pool_id)
+        result = {
+            'status': 'success',
+            'backup_location': f"s3://{bucket}/{writer.manifest_key}",
+            'backup_format': 'v2',
+            'backup_type': manifest['backup_type'],
+            **stats,
+            'groups_backed_up': len(header['groups']),
+            'membership_strategy': header['membership_strategy'],
+            'invocations': state['invocations'],
+            'checkpoint_key': checkpoint.key,
+            'concurrency': self.concurrency.stats()
+        }
+        checkpoint.finish(result)
+        return result
+
+    @staticmethod
+    def _user_changed(user: Dict[str, Any],
+                      previous_entry: Optional[Tuple[str, List[str]]]) -> bool:
+        """
+        Check whether a user differs from its entry in the previous backup's index.
+        
+        Args:
+            user: User object with embedded group memberships
+            previous_entry: (UserLastModifiedDate, groups) from the previous index,
+                or None if the user was not in the previous backup
+            
+        Returns:
+            True if the user is new or has changed
+        """
+        if previous_entry is None:
+            return True
+        last_modified, groups = previous_entry
+        return (
+            last_modified != str(user.get('UserLastModifiedDate'))
+            or sorted(groups) != sorted(user.get('Groups', []))
+        )
+
+    def _get_membership_index(self, user_pool_id: str,
+                              groups: List[Dict[str, Any]]) -> Optional[Dict[str, List[str]]]:
+        """
+        Get the group membership index for the configured strategy.
+        
+        Args:
+            user_pool_id: The ID of the user pool
+            groups: Groups of the user pool, as returned by _get_groups
+            
+        Returns:
+            Username -> group names index, or None when memberships must be
+            looked up per user (the 'user' strategy, or the 'group' fallback)
+        """
+        if self.membership_strategy != 'group':
+            return None
+        return self._build_group_membership_index(user_pool_id, groups)
+
+    def _iter_users_with_groups(self, user_pool_id: str,
+                                membership_index: Optional[Dict[str, List[str]]],
+                                pagination_token: Optional[str] = None
+                                ) -> Iterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Iterate over the user pool one list_users page at a time, with each user's
+        group memberships embedded.
+
+        Per-user group lookups within a page run concurrently. Every user is
+        looked up, even for incrementals: adding a user to a group or removing
+        it does not change its UserLastModifiedDate, so groups from the
+        previous backup cannot be reused.
+        
+        Args:
+            user_pool_id: The ID of the user pool
+            membership_index: Index from _get_membership_index, or None to look
+                memberships up per user
+            pagination_token: PaginationToken to resume listing at
+            
+        Yields:
+            Tuples of (user objects with embedded group memberships,
+            PaginationToken of the next page or None after the last page)
+        """
+        kwargs = {'PaginationToken': pagination_token} if pagination_token else {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for page in self._paginate('list_users', token_key='PaginationToken',
+                                       UserPoolId=user_pool_id, **kwargs):
+                users = page['Users']
+                lookups = []
+                for user in users:
+                    # Enhance user object with group memberships
+                    if membership_index is not None:
+                        user['Groups'] = membership_index.get(user['Username'], [])
+                    else:
+                        lookups.append(user)
+
+                for user, user_groups in zip(lookups, executor.map(
+                        lambda user: self._get_groups_for_user(user_pool_id, user['Username']),
+                        lookups)):
+                    user['Groups'] = user_groups
+                yield users, page.get('PaginationToken')
+
+    def _build_group_membership_index(self, user_pool_id: str,
+                                      groups: List[Dict[str, Any]]
+                                      ) -> Optional[Dict[str, List[str]]]:
+        """
+        Build a username -> group names index by listing the members of each
+        group, several groups at a time, while the time budget lasts.
+        
+        Args:
+            user_pool_id: The ID of the user pool
+            groups: Groups of the user pool, as returned by _get_groups
+            
+        Returns:
+            Dict mapping usernames to their group names, or None if any group
+            could not be listed or the time budget ran out first (callers
+            should fall back to per-user lookups)
+        """
+        def list_group_members(group_name: str) -> List[str]:
+            return [
+                user['Username']
+                for page in self._paginate('list_users_in_group',
+                                           UserPoolId=user_pool_id, GroupName=group_name)
+                for user in page['Users']
+            ]
+
+        group_names = [group['GroupName'] for group in groups]
+        membership_index: Dict[str, List[str]] = {}
+        memberships = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for group_name, members in zip(group_names,
+                                               executor.map(list_group_members, group_names)):
+                    for username in members:
+                        membership_index.setdefault(username, []).append(group_name)
+                        memberships += 1
+                    if self.time_budget.exhausted():
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        logger.warning(
+                            "Time budget ran out while indexing group memberships, "
+                            "falling back to per-user group lookups"
+                        )
+                        return None
+        except ClientError as exc:
+            logger.warning(
+                "Could not list users in every group, falling back to per-user "
+                "group lookups: %s", exc
+            )
+            return None
+
+        logger.info(
+            "Indexed %d group memberships for %d users across %d groups",
+            memberships, len(membership_index), len(groups)
+        )
+        return membership_index
+
+    def _get_groups_for_user(self, user_pool_id: str, username: str) -> List[str]:
+        """
+        Get the group names of a single user with admin_list_groups_for_user.
+        
+        Args:
+            user_pool_id: The ID of the user pool
+            username: Username to look up
+            
+        Returns:
+            List of group names (empty if the lookup failed)
+        """
+        user_groups = []
+        try:
+            for page in self._paginate('admin_list_groups_for_user',
+                                       UserPoolId=user_pool_id, Username=username):
+                user_groups.extend(group['GroupName'] for group in page['Groups'])
+            if user_groups:
+                logger.info("User %s belongs to groups: %s", username, user_groups)
+        except ClientError as exc:
+            logger.warning("Could not retrieve groups for user %s: %s", username, exc)
+
+        return user_groups
 
     def _get_groups(self, user_pool_id: str) -> List[Dict[str, Any]]:
         """
         Get all groups from the user pool.
+
+        Listing errors are not swallowed: a partial group list would back up
+        the members of the missing groups without those memberships.
         
         Args:
             user_pool_id: The ID of the user pool
             
         Returns:
             List of group objects
+
+        Raises:
+            ClientError: If the groups could not be listed
         """
         groups = []
-        try:
-            groups_response = self.aws_clients.cognito_client.list_groups(UserPoolId=user_pool_id)
-            groups = groups_response['Groups']
-        except ClientError as exc:
-            logger.warning("Could not retrieve groups: %s", exc)
+        for page in self._paginate('list_groups', UserPoolId=user_pool_id):
+            groups.extend(page['Groups'])
+        return groups
 
-        return groups
\ No newline at end of file
+    def _paginate(self, operation: str, token_key: str = 'NextToken',
+                  **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Page through a Cognito list API, making every call under the adaptive
+        concurrency limit so throttled pages are retried rather than failing.
+        
+        Args:
+            operation: Name of the cognito-idp client method
+            token_key: Name of the pagination token in requests and responses
+            **kwargs: Arguments for every call
+            
+        Yields:
+            API response pages
+        """
+        method = getattr(self.aws_clients.cognito_client, operation)
+        while True:
+            page = self.concurrency.call(method, **kwargs)
+            yield page
+            if not page.get(token_key):
+                return
+            kwargs[token_key] = page[token_key]
@@ -0,0 +1,478 @@
+"""Sharded (v2) backup format module for Cognito backup/restore operations.
+
+A v2 backup lives under ``cognito-backups/<pool>/<timestamp>/`` and consists of
+newline-delimited JSON shards (one user object per line) plus a manifest that
+lists every shard with its user count, byte size and SHA-256 checksum. The
+manifest is written last and is the single entry point for readers.
+
+Every v2 backup also writes a compact user index (username, UserLastModifiedDate
+and groups of every user in the pool at backup time). Incremental backups
+compare list_users against the previous backup's index and only store the
+users that were added, changed or deleted (as ``{"Username": ..., "Deleted":
+true}`` tombstones), chained to a full base snapshot. Each pool keeps a
+catalog of its v2 backups under ``cognito-backups/<pool>/catalog/``: one
+entry object per backup, named so that keys sort in the order the backups
+were recorded.
+"""
+
+import hashlib
+import json
+import tempfile
+import uuid
+from datetime import datetime, UTC
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from .config import logger
+from .s3_writer import S3MultipartWriter, DEFAULT_PART_SIZE
+
+FORMAT_VERSION = 2
+MANIFEST_NAME = 'manifest.json'
+CATALOG_PREFIX = 'catalog'
+DEFAULT_SHARD_SIZE = 10000
+
+# Shard bytes held in memory while verifying a shard; larger shards spill to /tmp
+SHARD_SPOOL_SIZE = 16 * 1024 * 1024
+
+def is_manifest_key(key: str) -> bool:
+    """Return True if the S3 key points at a v2 backup manifest."""
+    return key.endswith(f'/{MANIFEST_NAME}')
+
+def load_manifest(s3_client, bucket: str, key: str) -> Dict[str, Any]:
+    """
+    Load and validate a v2 backup manifest.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        key: S3 key of the manifest
+
+    Returns:
+        Manifest dict
+
+    Raises:
+        ValueError: If the object is not a v2 manifest
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    manifest = json.loads(response['Body'].read())
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"s3://{bucket}/{key} is not a v{FORMAT_VERSION} backup manifest")
+    return manifest
+
+def iter_shard_users(s3_client, bucket: str, shard: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the user objects of one shard once its size and checksum are verified.
+
+    The shard is spooled (in memory up to SHARD_SPOOL_SIZE, then to a
+    temporary file) and checked before the first user is yielded, so nothing
+    is ever restored from a corrupt shard.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        shard: Shard entry from the manifest
+
+    Yields:
+        User objects in shard order
+
+    Raises:
+        ValueError: If the shard size or checksum does not match the manifest
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=shard['key'])
+    digest = hashlib.sha256()
+    with tempfile.SpooledTemporaryFile(max_size=SHARD_SPOOL_SIZE) as spool:
+        for chunk in response['Body'].iter_chunks():
+            digest.update(chunk)
+            spool.write(chunk)
+        if spool.tell() != shard['bytes'] or digest.hexdigest() != shard['sha256']:
+            raise ValueError(f"Shard s3://{bucket}/{shard['key']} failed checksum verification")
+
+        spool.seek(0)
+        for line in spool:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_manifest_records(s3_client, bucket: str,
+                          manifest: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the records stored in one manifest's own shards (users and, for
+    incremental backups, deletion tombstones), shard by shard.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        manifest: Manifest dict from load_manifest
+
+    Yields:
+        Records in shard order
+    """
+    for shard in manifest['shards']:
+        yield from iter_shard_users(s3_client, bucket, shard)
+
+def resolve_chain(s3_client, bucket: str, manifest: Dict[str, Any],
+                  manifest_key: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Resolve the manifests needed to rebuild a v2 backup, base snapshot first.
+
+    For an incremental backup the most recent compacted snapshot that covers
+    part of its chain is used as the base, so only the deltas taken after it
+    have to be replayed.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        manifest: Manifest dict from load_manifest
+        manifest_key: S3 key of the manifest, used to match compacted snapshots
+
+    Returns:
+        List of manifests: a full snapshot followed by the deltas to replay
+    """
+    if manifest.get('backup_type', 'full') == 'full':
+        return [manifest]
+
+    chain = manifest['chain'] + [manifest_key]
+    start, base_key = 0, chain[0]
+    if manifest_key is not None:
+        catalog = load_catalog(s3_client, bucket, manifest['user_pool']['Id'])
+        for entry in catalog['backups']:
+            covered = entry.get('compacted_from', [])
+            if covered and chain[:len(covered)] == covered and len(covered) > start:
+                start, base_key = len(covered), entry['manifest_key']
+
+    if start:
+        logger.info("Restoring from compacted snapshot %s", base_key)
+    else:
+        start = 1
+    manifests = [load_manifest(s3_client, bucket, base_key)]
+    manifests.extend(load_manifest(s3_client, bucket, key) for key in manifest['chain'][start:])
+    if start <= len(manifest['chain']):
+        manifests.append(manifest)
+    return manifests
+
+def iter_backup_users(s3_client, bucket: str, manifest: Dict[str, Any],
+                      manifest_key: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Stream every user of a v2 backup.
+
+    For an incremental backup the chain is replayed (see resolve_chain): the
+    newest version of each user wins and deleted users are dropped. Only the
+    usernames stored in the deltas are held in memory; the base snapshot is
+    streamed.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        manifest: Manifest dict from load_manifest
+        manifest_key: S3 key of the manifest, used to find compacted snapshots
+
+    Yields:
+        User objects
+    """
+    manifests = resolve_chain(s3_client, bucket, manifest, manifest_key)
+    seen = set()
+    for delta in reversed(manifests[1:]):
+        for record in iter_manifest_records(s3_client, bucket, delta):
+            if record['Username'] in seen:
+                continue
+            seen.add(record['Username'])
+            if not record.get('Deleted'):
+                yield record
+
+    for user in iter_manifest_records(s3_client, bucket, manifests[0]):
+        if user['Username'] not in seen:
+            yield user
+
+def user_index_entry(user: Dict[str, Any]) -> List[Any]:
+    """Build the user index entry (username, last modified date, groups) for a user."""
+    return [user['Username'], str(user.get('UserLastModifiedDate')), user.get('Groups', [])]
+
+def load_user_index(s3_client, bucket: str,
+                    manifest: Dict[str, Any]) -> Dict[str, Tuple[str, List[str]]]:
+    """
+    Load the user index of a v2 backup.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        manifest: Manifest dict from load_manifest
+
+    Returns:
+        Dict mapping usernames to (UserLastModifiedDate, groups)
+    """
+    index = {}
+    for key in manifest.get('index_keys', []):
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        for line in response['Body'].iter_lines():
+            if line.strip():
+                username, last_modified, groups = json.loads(line)
+                index[username] = (last_modified, groups)
+    return index
+
+def write_membership_index(s3_client, bucket: str, key: str,
+                           membership_index: Dict[str, List[str]]) -> None:
+    """
+    Save a username -> group names index as NDJSON [username, groups] lines.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        key: S3 key to write the index to
+        membership_index: Index built by the backup
+    """
+    with S3MultipartWriter(s3_client, bucket, key, 'application/x-ndjson') as writer:
+        for username, groups in membership_index.items():
+            writer.write(json.dumps([username, groups]) + '\n')
+
+def load_membership_index(s3_client, bucket: str, key: str) -> Dict[str, List[str]]:
+    """
+    Load an index saved by write_membership_index.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        key: S3 key of the index
+
+    Returns:
+        Dict mapping usernames to their group names
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    index = {}
+    for line in response['Body'].iter_lines():
+        if line.strip():
+            username, groups = json.loads(line)
+            index[username] = groups
+    return index
+
+def catalog_prefix(user_pool_id: str) -> str:
+    """Return the S3 prefix of a user pool's backup catalog entries."""
+    return f'cognito-backups/{user_pool_id}/{CATALOG_PREFIX}/'
+
+def load_catalog(s3_client, bucket: str, user_pool_id: str) -> Dict[str, Any]:
+    """
+    Load a user pool's backup catalog, or an empty one if none exists yet.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        user_pool_id: The ID of the backed up user pool
+
+    Returns:
+        Catalog dict with a 'backups' list, oldest first
+    """
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=catalog_prefix(user_pool_id)):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    backups = [
+        json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        for key in sorted(keys)
+    ]
+    return {'user_pool_id': user_pool_id, 'backups': backups}
+
+def latest_backup(catalog: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Return the most recent catalog entry, or None for an empty catalog."""
+    return catalog['backups'][-1] if catalog['backups'] else None
+
+def record_backup(s3_client, bucket: str, user_pool_id: str, entry: Dict[str, Any]) -> None:
+    """
+    Add a completed v2 backup to the user pool's catalog.
+
+    Every backup writes its own entry object, keyed by the time it was
+    recorded (plus a random suffix), so backups of the same pool finishing
+    together never overwrite each other's entries and no conditional write
+    is needed.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        user_pool_id: The ID of the backed up user pool
+        entry: Catalog entry (manifest_key, backup_type, timestamp, ...)
+    """
+    recorded_at = datetime.now(UTC).strftime('%Y%m%dT%H%M%S%fZ')
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=f'{catalog_prefix(user_pool_id)}{recorded_at}-{uuid.uuid4().hex[:8]}.json',
+        Body=json.dumps(entry),
+        ContentType='application/json'
+    )
+
+def verify_backup(s3_client, bucket: str, manifest: Dict[str, Any],
+                  max_workers: int = 8) -> Dict[str, Any]:
+    """
+    Verify the size and checksum of every shard of a v2 backup in parallel.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        manifest: Manifest dict from load_manifest
+        max_workers: Number of shards verified concurrently
+
+    Returns:
+        Dict containing verification statistics and the keys of corrupt shards
+    """
+    def verify_shard(shard: Dict[str, Any]) -> bool:
+        try:
+            users = sum(1 for _ in iter_shard_users(s3_client, bucket, shard))
+        except ValueError as exc:
+            logger.warning("%s", exc)
+            return False
+        return users == shard['users']
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(verify_shard, manifest['shards']))
+
+    failed_shards = [
+        shard['key'] for shard, valid in zip(manifest['shards'], results) if not valid
+    ]
+    return {
+        'status': 'success' if not failed_shards else 'corrupt',
+        'shards_verified': len(results),
+        'users_verified': sum(
+            shard['users'] for shard, valid in zip(manifest['shards'], results) if valid
+        ),
+        'failed_shards': failed_shards
+    }
+
+class ShardedBackupWriter:
+    """
+    Writes a v2 backup: NDJSON user shards followed by the manifest.
+
+    Users are buffered until a shard holds at least shard_size users; shards are
+    only cut between list_users pages so a page is never split across shards.
+    User index entries are buffered and flushed to index parts the same way.
+    """
+
+    def __init__(self, s3_client, bucket: str, prefix: str,
+                 shard_size: int = DEFAULT_SHARD_SIZE,
+                 part_size: int = DEFAULT_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+        self.shard_size = shard_size
+        self.part_size = part_size
+        self.shards: List[Dict[str, Any]] = []
+        self.users_written = 0
+        self.index_keys: List[str] = []
+        self._pending: List[str] = []
+        self._pending_index: List[str] = []
+
+    @property
+    def manifest_key(self) -> str:
+        """S3 key of the manifest for this backup."""
+        return f'{self.prefix}/{MANIFEST_NAME}'
+
+    def state(self) -> Dict[str, Any]:
+        """Return the objects written so far, for a backup checkpoint."""
+        return {
+            'shards': list(self.shards),
+            'index_keys': list(self.index_keys),
+            'users_written': self.users_written
+        }
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        """Continue after the objects recorded by state() in an earlier invocation."""
+        self.shards = list(state['shards'])
+        self.index_keys = list(state['index_keys'])
+        self.users_written = state['users_written']
+
+    def add_page(self, users: List[Dict[str, Any]],
+                 index_users: Optional[List[Dict[str, Any]]] = None) -> bool:
+        """
+        Add one page of records, flushing a shard once enough are buffered.
+
+        Args:
+            users: Records to store (user objects with embedded group memberships,
+                or deletion tombstones for incremental backups)
+            index_users: Users to add to the user index; defaults to users
+
+        Returns:
+            True if a shard or index part was flushed
+        """
+        if index_users is None:
+            index_users = users
+        self._pending.extend(json.dumps(user, default=str) + '\n' for user in users)
+        self._pending_index.extend(
+            json.dumps(user_index_entry(user), default=str) + '\n' for user in index_users
+        )
+        flushed = False
+        if len(self._pending) >= self.shard_size:
+            self.flush_shard()
+            flushed = True
+        if len(self._pending_index) >= self.shard_size:
+            self.flush_index()
+            flushed = True
+        return flushed
+
+    def flush(self) -> None:
+        """Write every buffered user and index entry."""
+        self.flush_shard()
+        self.flush_index()
+
+    def flush_index(self) -> None:
+        """Write the buffered user index entries as the next index part."""
+        if not self._pending_index:
+            return
+
+        key = f'{self.prefix}/index-{len(self.index_keys):05d}.ndjson'
+        with S3MultipartWriter(
+            self.s3_client, self.bucket, key,
+            content_type='application/x-ndjson', part_size=self.part_size
+        ) as writer:
+            for line in self._pending_index:
+                writer.write(line)
+        self.index_keys.append(key)
+        self._pending_index = []
+
+    def flush_shard(self) -> None:
+        """Write the buffered users as the next shard."""
+        if not self._pending:
+            return
+
+        key = f'{self.prefix}/users-{len(self.shards):05d}.ndjson'
+        digest = hashlib.sha256()
+        with S3MultipartWriter(
+            self.s3_client, self.bucket, key,
+            content_type='application/x-ndjson', part_size=self.part_size
+        ) as writer:
+            for line in self._pending:
+                data = line.encode('utf-8')
+                digest.update(data)
+                writer.write(data)
+
+        self.shards.append({
+            'key': key,
+            'users': len(self._pending),
+            'bytes': writer.bytes_written,
+            'sha256': digest.hexdigest()
+        })
+        self.users_written += len(self._pending)
+        logger.info("Wrote backup shard %s (%d users)", key, len(self._pending))
+        self._pending = []
+
+    def write_manifest(self, header: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Flush any buffered users and write the manifest, completing the backup.
+
+        Args:
+            header: Backup-level fields (timestamp, user_pool, groups, ...)
+
+        Returns:
+            The manifest that was written
+        """
+        self.flush()
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'users_total': self.users_written,
+            **header,
+            'shard_size': self.shard_size,
+            'users_backed_up': self.users_written,
+            'total_bytes': sum(shard['bytes'] for shard in self.shards),
+            'shards': self.shards,
+            'index_keys': self.index_keys
+        }
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.manifest_key,
+            Body=json.dumps(manifest, default=str),
+            ContentType='application/json'
+        )
+        return manifest
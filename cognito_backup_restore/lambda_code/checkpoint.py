@@ -0,0 +1,364 @@
+"""Checkpoint ledger module for resumable Cognito backup and restore operations.
+
+Every restore keeps a ledger at ``cognito-restores/<pool>/<timestamp>/checkpoint.json``
+in the backup bucket. It is rewritten after each batch of users with the
+number of backup users processed so far, the running statistics and the
+failed users, and after each slice of DynamoDB sub remapping with the number
+of mappings remapped. Sub mappings are appended as separate NDJSON part
+objects so the ledger itself stays small.
+
+Every v2 backup keeps a ledger at ``<backup prefix>/checkpoint.json``, rewritten
+whenever a shard is flushed with the list_users PaginationToken of the next
+page and the shards written so far. The manifest is only written once the
+listing has finished, so a backup without a manifest is never read.
+
+A ``resume`` operation reloads either ledger (told apart by its ``kind``) and
+continues the operation from the last recorded point.
+"""
+
+import json
+from datetime import datetime, UTC
+from typing import Any, Dict, Iterator, List, Optional
+from .config import logger
+
+CHECKPOINT_NAME = 'checkpoint.json'
+
+class _Checkpoint:
+    """S3-backed progress ledger of one operation."""
+
+    KIND = ''
+
+    def __init__(self, s3_client, bucket: str, key: str, state: Dict[str, Any]):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.state = state
+
+    @property
+    def complete(self) -> bool:
+        """Whether the operation has finished."""
+        return self.state['status'] == 'complete'
+
+    @property
+    def result(self) -> Optional[Dict[str, Any]]:
+        """Final result of a completed operation."""
+        return self.state.get('result')
+
+    def save(self) -> None:
+        """Write the ledger to S3."""
+        self.state['updated_at'] = datetime.now(UTC).isoformat()
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=json.dumps(self.state, default=str),
+            ContentType='application/json'
+        )
+
+    def start_invocation(self) -> None:
+        """Count another invocation working on the operation."""
+        self.state['invocations'] += 1
+        logger.info("Resuming %s from checkpoint %s", self.KIND, self.key)
+        self.save()
+
+    def finish(self, result: Dict[str, Any]) -> None:
+        """Mark the operation complete and keep its final result."""
+        self.state['status'] = 'complete'
+        self.state['result'] = result
+        self.save()
+
+    @classmethod
+    def load(cls, s3_client, bucket: str, key: str) -> '_Checkpoint':
+        """
+        Load a ledger of this kind.
+
+        Raises:
+            ValueError: If the object is not a ledger of this kind
+        """
+        checkpoint = load_checkpoint(s3_client, bucket, key)
+        if not isinstance(checkpoint, cls):
+            raise ValueError(f"s3://{bucket}/{key} is not a {cls.KIND} checkpoint")
+        return checkpoint
+
+class RestoreCheckpoint(_Checkpoint):
+    """Progress ledger of one restore."""
+
+    KIND = 'restore'
+
+    @classmethod
+    def create(cls, s3_client, bucket: str, backup_key: str, backup_timestamp: str,
+               user_pool_id: str, options: Dict[str, Any]) -> 'RestoreCheckpoint':
+        """
+        Start the ledger of a new restore.
+
+        Args:
+            s3_client: Boto3 S3 client
+            bucket: Backup bucket name
+            backup_key: S3 key of the backup being restored
+            backup_timestamp: Timestamp of the backup being restored
+            user_pool_id: Target user pool ID
+            options: Restore options to reuse when resuming (prescan, restore_mode)
+
+        Returns:
+            The saved checkpoint
+        """
+        now = datetime.now(UTC)
+        key = (
+            f"cognito-restores/{user_pool_id}/"
+            f"{now.strftime('%Y-%m-%d_%H-%M-%S-%f')}/{CHECKPOINT_NAME}"
+        )
+        checkpoint = cls(s3_client, bucket, key, {
+            'kind': cls.KIND,
+            'status': 'in_progress',
+            'backup_key': backup_key,
+            'backup_timestamp': backup_timestamp,
+            'target_user_pool_id': user_pool_id,
+            'options': options,
+            'created_at': now.isoformat(),
+            'invocations': 1,
+            'groups_restored': None,
+            'import_jobs': None,
+            'import_users_written': 0,
+            'import_jobs_created': False,
+            'target_indexes': {},
+            'users_processed': 0,
+            'users_restored': 0,
+            'existing_users': 0,
+            'memberships_restored': 0,
+            'failed_users': [],
+            'mappings_saved': 0,
+            'mapping_parts': [],
+            'users_complete': False,
+            'mapping_artifact': None,
+            'remap': {
+                'mappings_processed': 0,
+                'records_updated': 0,
+                'already_migrated': 0,
+                'users_already_migrated': 0,
+                'users_without_records': 0,
+                'failed_updates': [],
+                'skipped_updates': 0,
+                'aliases_written': 0,
+                'elapsed_seconds': 0.0,
+                'mappings_queued': 0,
+                'messages_queued': 0,
+                'scan_position': None
+            }
+        })
+        checkpoint.save()
+        return checkpoint
+
+    @property
+    def users_processed(self) -> int:
+        """Number of backup users already handled, in backup order."""
+        return self.state['users_processed']
+
+    @property
+    def mappings_saved(self) -> int:
+        """Number of sub mappings already written to mapping parts."""
+        return self.state['mappings_saved']
+
+    def record_groups(self, groups_restored: int) -> None:
+        """Record that the backup's groups have been restored."""
+        self.state['groups_restored'] = groups_restored
+        self.save()
+
+    @property
+    def import_jobs_created(self) -> bool:
+        """Whether every user import job of the restore has been created."""
+        # Checkpoints from before budgeted job creation recorded all jobs at once
+        return self.state.get('import_jobs_created', self.state['import_jobs'] is not None)
+
+    def record_import_job(self, entry: Dict[str, Any], users_written: int) -> None:
+        """
+        Record a created user import job.
+
+        Args:
+            entry: Ledger entry of the job
+            users_written: Number of backup users in the jobs created so far
+        """
+        self.state['import_jobs'] = (self.state['import_jobs'] or []) + [entry]
+        self.state['import_users_written'] = users_written
+        self.save()
+
+    def record_import_jobs_created(self) -> None:
+        """Record that no further user import jobs will be created."""
+        if self.state['import_jobs'] is None:
+            self.state['import_jobs'] = []
+        self.state['import_jobs_created'] = True
+        self.save()
+
+    def record_import_jobs(self, import_jobs: List[Dict[str, Any]]) -> None:
+        """Record the finished user import jobs of the restore."""
+        self.state['import_jobs'] = import_jobs
+        self.save()
+
+    def record_target_index(self, name: str, index_key: str) -> None:
+        """Record a saved index of the target pool ('users' or 'memberships')."""
+        self.state.setdefault('target_indexes', {})[name] = index_key
+        self.save()
+
+    def record_progress(self, users_processed: int, progress: Dict[str, Any]) -> None:
+        """
+        Record a finished batch of users.
+
+        Args:
+            users_processed: Number of users in the batch
+            progress: Running statistics with the sub mappings added since
+                mappings_saved under 'new_sub_mappings'
+        """
+        new_mappings = progress['new_sub_mappings']
+        if new_mappings:
+            part_key = self.key.replace(
+                CHECKPOINT_NAME, f"mappings/part-{len(self.state['mapping_parts']):06d}.ndjson"
+            )
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=part_key,
+                Body=''.join(json.dumps(mapping) + '\n' for mapping in new_mappings),
+                ContentType='application/x-ndjson'
+            )
+            self.state['mapping_parts'].append(part_key)
+            self.state['mappings_saved'] += len(new_mappings)
+
+        self.state['users_processed'] += users_processed
+        for field in ('users_restored', 'existing_users', 'memberships_restored', 'failed_users'):
+            self.state[field] = progress[field]
+        self.save()
+
+    def record_users_complete(self) -> None:
+        """Record that every backup user has been processed."""
+        self.state['users_complete'] = True
+        self.save()
+
+    def record_mapping_artifact(self, index_key: str) -> None:
+        """Record the index of the published sub mapping artifact."""
+        self.state['mapping_artifact'] = index_key
+        self.save()
+
+    def record_remap(self, remap_stats: Dict[str, Any]) -> None:
+        """
+        Add a slice of DynamoDB sub remapping to the ledger.
+
+        Args:
+            remap_stats: Result of DynamoDBUpdate.update_dynamodb_sub for the
+                mappings after the ones already remapped
+        """
+        remap = self.state['remap']
+        for field in ('mappings_processed', 'records_updated', 'already_migrated',
+                      'users_already_migrated', 'users_without_records', 'skipped_updates',
+                      'aliases_written', 'elapsed_seconds'):
+            remap[field] += remap_stats.get(field, 0)
+        remap['failed_updates'].extend(remap_stats['failed_updates'])
+        remap['scan_position'] = remap_stats.get('scan_position')
+        self.save()
+
+    def record_remap_queued(self, mappings_queued: int, messages_queued: int) -> None:
+        """
+        Add sub mappings published to the remap queue to the ledger.
+
+        Args:
+            mappings_queued: Mappings published, after the ones already queued
+            messages_queued: Work messages they were published in
+        """
+        remap = self.state['remap']
+        remap['mappings_queued'] += mappings_queued
+        remap['messages_queued'] += messages_queued
+        self.save()
+
+    def iter_mappings(self) -> Iterator[Dict[str, str]]:
+        """Stream back every sub mapping saved so far, part by part."""
+        for part_key in self.state['mapping_parts']:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=part_key)
+            for line in response['Body'].iter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    def load_mappings(self) -> List[Dict[str, str]]:
+        """Read back every sub mapping saved so far."""
+        return list(self.iter_mappings())
+
+class BackupCheckpoint(_Checkpoint):
+    """Progress ledger of one v2 backup."""
+
+    KIND = 'backup'
+
+    @classmethod
+    def create(cls, s3_client, bucket: str, user_pool_id: str, backup_prefix: str,
+               header: Dict[str, Any], previous_manifest_key: Optional[str] = None,
+               membership_index_key: Optional[str] = None) -> 'BackupCheckpoint':
+        """
+        Start the ledger of a new backup.
+
+        Args:
+            s3_client: Boto3 S3 client
+            bucket: Backup bucket name
+            user_pool_id: The ID of the backed up user pool
+            backup_prefix: S3 prefix of the backup's shards and manifest
+            header: Backup-level fields (timestamp, user_pool, groups, ...)
+            previous_manifest_key: Manifest of the backup an incremental is based on
+            membership_index_key: Saved group membership index, reused on resume
+
+        Returns:
+            The saved checkpoint
+        """
+        checkpoint = cls(s3_client, bucket, f'{backup_prefix}/{CHECKPOINT_NAME}', {
+            'kind': cls.KIND,
+            'status': 'in_progress',
+            'user_pool_id': user_pool_id,
+            'backup_prefix': backup_prefix,
+            'header': json.loads(json.dumps(header, default=str)),
+            'previous_manifest_key': previous_manifest_key,
+            'membership_index_key': membership_index_key,
+            'created_at': datetime.now(UTC).isoformat(),
+            'invocations': 1,
+            'pagination_token': None,
+            'listing_complete': False,
+            'writer': {'shards': [], 'index_keys': [], 'users_written': 0},
+            'users_total': 0,
+            'users_changed': 0
+        })
+        checkpoint.save()
+        return checkpoint
+
+    def record_listing(self, pagination_token: Optional[str], writer_state: Dict[str, Any],
+                       users_total: int, users_changed: int) -> None:
+        """
+        Record the flushed shards and where the list_users pagination stands.
+
+        Args:
+            pagination_token: PaginationToken of the next page, or None once
+                every page has been listed
+            writer_state: ShardedBackupWriter.state() after flushing
+            users_total: Users listed so far
+            users_changed: Users stored so far (incremental backups)
+        """
+        self.state.update({
+            'pagination_token': pagination_token,
+            'listing_complete': pagination_token is None,
+            'writer': writer_state,
+            'users_total': users_total,
+            'users_changed': users_changed
+        })
+        self.save()
+
+def load_checkpoint(s3_client, bucket: str, key: str) -> '_Checkpoint':
+    """
+    Load the ledger of an earlier backup or restore to resume it.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        key: S3 key of the checkpoint
+
+    Returns:
+        A RestoreCheckpoint or BackupCheckpoint, depending on the ledger's kind
+
+    Raises:
+        ValueError: If the object is not a checkpoint ledger
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    state = json.loads(response['Body'].read())
+    for checkpoint_class in (RestoreCheckpoint, BackupCheckpoint):
+        if state.get('kind') == checkpoint_class.KIND:
+            return checkpoint_class(s3_client, bucket, key, state)
+    raise ValueError(f"s3://{bucket}/{key} is not a backup or restore checkpoint")
@@ -0,0 +1,234 @@
+"""Compaction module for incremental Cognito backup chains."""
+
+import heapq
+import itertools
+import json
+import os
+import tempfile
+from contextlib import ExitStack
+from datetime import datetime, UTC
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+from botocore.exceptions import ClientError
+from .aws_clients import AWSClients
+from .backup_format import (
+    ShardedBackupWriter, DEFAULT_SHARD_SIZE, iter_shard_users, latest_backup, load_catalog,
+    load_manifest, record_backup
+)
+from .config import logger
+from .s3_writer import DEFAULT_PART_SIZE
+
+# Users sorted in memory at a time when spilling a shard to sorted runs
+SORT_RUN_RECORDS = 10000
+
+# Run files merged (and so held open) at a time
+MERGE_FAN_IN = 64
+
+class BackupCompaction:
+    """Folds a base snapshot and its incremental backups into a new full snapshot."""
+
+    def __init__(self, aws_clients: AWSClients, shard_size: int = DEFAULT_SHARD_SIZE,
+                 part_size: int = DEFAULT_PART_SIZE):
+        self.aws_clients = aws_clients
+        self.shard_size = shard_size
+        self.part_size = part_size
+
+    def compact(self, user_pool_id: str, backup_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Compact an incremental backup chain into a fresh full v2 snapshot.
+
+        Every shard of the chain is sorted by username into local run files
+        (at most SORT_RUN_RECORDS users in memory at a time), runs are merged
+        in passes of at most MERGE_FAN_IN open files until one pass can merge
+        them all, and that last merge keeps the newest version of each user
+        and drops deleted users. The
+        snapshot is recorded in the catalog with the chain it replaces, so
+        restores of that chain start from it.
+
+        Args:
+            user_pool_id: The ID of the backed up user pool
+            backup_key: Manifest key of the incremental backup to compact;
+                defaults to the pool's latest backup
+
+        Returns:
+            Dict containing compaction status and statistics
+        """
+        s3_client = self.aws_clients.s3_client
+        bucket = self.aws_clients.bucket_name
+        try:
+            if backup_key is None:
+                entry = latest_backup(load_catalog(s3_client, bucket, user_pool_id))
+                if entry is None:
+                    raise ValueError(f"User pool {user_pool_id} has no v2 backups to compact")
+                backup_key = entry['manifest_key']
+
+            manifest = load_manifest(s3_client, bucket, backup_key)
+            if manifest['backup_type'] != 'incremental':
+                logger.info("Backup %s is already a full snapshot, nothing to compact", backup_key)
+                return {
+                    'status': 'skipped',
+                    'backup_location': f"s3://{bucket}/{backup_key}",
+                    'deltas_merged': 0
+                }
+
+            source_keys = manifest['chain'] + [backup_key]
+            sources = [load_manifest(s3_client, bucket, key) for key in manifest['chain']]
+            sources.append(manifest)
+
+            writer = ShardedBackupWriter(
+                s3_client, bucket,
+                f"cognito-backups/{user_pool_id}/"
+                f"{datetime.now(UTC).strftime('%Y-%m-%d_%H-%M-%S-%f')}",
+                shard_size=self.shard_size,
+                part_size=self.part_size
+            )
+            with tempfile.TemporaryDirectory() as spill_dir:
+                runs = self._reduce_runs(self._spill_sorted_runs(sources, spill_dir), spill_dir)
+                with ExitStack() as stack:
+                    files = [
+                        stack.enter_context(open(run, encoding='utf-8')) for run in runs
+                    ]
+                    page = []
+                    for user in self._merge_runs(files):
+                        page.append(user)
+                        if len(page) >= 100:
+                            writer.add_page(page)
+                            page = []
+                    writer.add_page(page)
+
+            header = {
+                key: manifest[key]
+                for key in ('timestamp', 'user_pool', 'membership_strategy', 'groups')
+            }
+            header.update({
+                'backup_type': 'full',
+                'chain': [],
+                'compacted_at': datetime.now(UTC).isoformat(),
+                'compacted_from': source_keys
+            })
+            compacted = writer.write_manifest(header)
+            record_backup(s3_client, bucket, user_pool_id, {
+                'manifest_key': writer.manifest_key,
+                'backup_type': 'full',
+                'timestamp': compacted['timestamp'],
+                'users_total': compacted['users_total'],
+                'chain': [],
+                'compacted_from': source_keys
+            })
+
+            logger.info(
+                "Compacted %d backups of user pool %s into %s",
+                len(source_keys), user_pool_id, writer.manifest_key
+            )
+            return {
+                'status': 'success',
+                'backup_location': f"s3://{bucket}/{writer.manifest_key}",
+                'users_backed_up': compacted['users_backed_up'],
+                'deltas_merged': len(source_keys) - 1,
+                'compacted_from': source_keys
+            }
+
+        except (ClientError, ValueError) as exc:
+            logger.error("Compaction failed for user pool %s: %s", user_pool_id, str(exc))
+            raise
+
+    def _spill_sorted_runs(self, sources: List[Dict[str, Any]], spill_dir: str) -> List[str]:
+        """
+        Sort every shard of every source by username into local run files of
+        at most SORT_RUN_RECORDS users each.
+
+        Args:
+            sources: Manifests of the chain, base first
+            spill_dir: Directory for the run files
+
+        Returns:
+            Paths of the run files (closed)
+        """
+        runs: List[str] = []
+        for priority, source in enumerate(sources):
+            for shard in source['shards']:
+                users = iter_shard_users(
+                    self.aws_clients.s3_client, self.aws_clients.bucket_name, shard
+                )
+                while records := list(itertools.islice(users, SORT_RUN_RECORDS)):
+                    records.sort(key=lambda record: record['Username'])
+                    runs.append(self._write_run(
+                        ((record['Username'], -priority, record) for record in records),
+                        spill_dir, len(runs)
+                    ))
+        return runs
+
+    def _reduce_runs(self, runs: List[str], spill_dir: str) -> List[str]:
+        """
+        Merge runs in passes of MERGE_FAN_IN until at most MERGE_FAN_IN are left.
+
+        Intermediate merges keep only the newest version of each user but
+        keep deletions, which must still hide older versions in other runs.
+
+        Args:
+            runs: Paths of sorted run files
+            spill_dir: Directory for the merged run files
+
+        Returns:
+            Paths of the remaining run files
+        """
+        generation = 0
+        while len(runs) > MERGE_FAN_IN:
+            generation += 1
+            merged = []
+            for start in range(0, len(runs), MERGE_FAN_IN):
+                group = runs[start:start + MERGE_FAN_IN]
+                with ExitStack() as stack:
+                    files = [stack.enter_context(open(run, encoding='utf-8')) for run in group]
+                    merged.append(self._write_run(
+                        self._newest_versions(files), spill_dir, len(merged), generation
+                    ))
+                for run in group:
+                    os.remove(run)
+            logger.info("Merged %d sorted runs into %d", len(runs), len(merged))
+            runs = merged
+        return runs
+
+    @staticmethod
+    def _write_run(items: Iterable[Tuple[str, int, Dict[str, Any]]], spill_dir: str,
+                   number: int, generation: int = 0) -> str:
+        """Write (username, -priority, record) items, already sorted, to a run file."""
+        path = os.path.join(spill_dir, f'run-{generation:02d}-{number:06d}.ndjson')
+        with open(path, 'w', encoding='utf-8') as run:
+            for item in items:
+                run.write(json.dumps(item) + '\n')
+        return path
+
+    @staticmethod
+    def _newest_versions(runs: List[IO[str]]) -> Iterator[Tuple[str, int, Dict[str, Any]]]:
+        """
+        Merge sorted run files, keeping only the newest version of each user.
+
+        Args:
+            runs: Open run files
+
+        Yields:
+            (username, -priority, record) items in username order, deletions included
+        """
+        def read_run(run: IO[str]) -> Iterator[Tuple[str, int, Dict[str, Any]]]:
+            for line in run:
+                username, priority, record = json.loads(line)
+                yield username, priority, record
+
+        merged = heapq.merge(*(read_run(run) for run in runs), key=lambda item: item[:2])
+        for _, versions in itertools.groupby(merged, key=lambda item: item[0]):
+            yield from itertools.islice(versions, 1)
+
+    @classmethod
+    def _merge_runs(cls, runs: List[IO[str]]) -> Iterator[Dict[str, Any]]:
+        """
+        Merge sorted runs, keeping only the newest version of each user.
+
+        Args:
+            runs: Open run files from _spill_sorted_runs or _reduce_runs
+
+        Yields:
+            Live user objects in username order
+        """
+        for _, _, newest in cls._newest_versions(runs):
+            if not newest.get('Deleted'):
+                yield newest
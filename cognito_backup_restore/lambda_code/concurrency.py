@@ -0,0 +1,165 @@
+"""Adaptive concurrency control module for Cognito backup/restore operations."""
+
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+from .config import logger
+
+# Error codes Cognito returns when a request rate quota is exceeded
+THROTTLING_ERROR_CODES = ('TooManyRequestsException', 'LimitExceededException')
+
+# Error codes of server-side failures worth another attempt (as are 5xx
+# responses and connection errors); they do not lower the limit
+TRANSIENT_ERROR_CODES = (
+    'InternalErrorException', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout'
+)
+
+def _is_transient(exc: Exception) -> bool:
+    """Whether a failed attempt should be retried without lowering the limit."""
+    if isinstance(exc, (BotoConnectionError, HTTPClientError)):
+        return True
+    return isinstance(exc, ClientError) and (
+        exc.response['Error']['Code'] in TRANSIENT_ERROR_CODES
+        or exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    )
+
+class AIMDController:
+    """
+    Additive-increase/multiplicative-decrease limit on concurrent API calls.
+
+    Every successful call raises the limit by 1/limit (about +1 per round of
+    calls at the current limit); a throttled call halves it, and any other
+    failure leaves it unchanged. Throttled calls,
+    and transient failures (5xx responses, connection errors), are retried
+    with jittered exponential backoff, so callers only see such an error once
+    max_retries is exhausted. Cognito clients are created without botocore
+    retries, so this is the only retry layer.
+    """
+
+    def __init__(self, max_limit: int, initial_limit: int = 1, min_limit: int = 1,
+                 max_retries: int = 8, base_delay: float = 0.1, max_delay: float = 5.0):
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._calls = 0
+        self._throttles = 0
+        self._retries = 0
+        self._peak_limit = int(self._limit)
+
+    @property
+    def limit(self) -> int:
+        """Current number of calls allowed in flight."""
+        return int(self._limit)
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run an API call within the concurrency limit, retrying throttled and
+        transient failures.
+
+        Args:
+            func: Boto3 client method (or any callable raising ClientError)
+            *args: Positional arguments for func
+            **kwargs: Keyword arguments for func
+
+        Returns:
+            The call's result
+
+        Raises:
+            ClientError: If the call fails, or still fails after max_retries
+        """
+        return self.call_paced(None, func, *args, **kwargs)
+
+    def call_paced(self, pace: Optional[Callable[[], None]], func: Callable[..., Any],
+                   *args, **kwargs) -> Any:
+        """
+        Like call, but wait for pace (e.g. a TokenBucket's acquire) before every
+        attempt, outside the concurrency limit so a paced caller holds no slot
+        while it waits.
+
+        Args:
+            pace: Callable blocking until the next attempt may start, or None
+            func: Boto3 client method (or any callable raising ClientError)
+            *args: Positional arguments for func
+            **kwargs: Keyword arguments for func
+
+        Returns:
+            The call's result
+
+        Raises:
+            ClientError: If the call fails, or still fails after max_retries
+        """
+        attempt = 0
+        while True:
+            if pace is not None:
+                pace()
+            self._acquire()
+            outcome = None
+            retry = False
+            try:
+                result = func(*args, **kwargs)
+                outcome = 'success'
+            except (ClientError, BotoConnectionError, HTTPClientError) as exc:
+                if (isinstance(exc, ClientError)
+                        and exc.response['Error']['Code'] in THROTTLING_ERROR_CODES):
+                    outcome = 'throttled'
+                retry = outcome == 'throttled' or _is_transient(exc)
+                if not retry or attempt >= self.max_retries:
+                    raise
+            finally:
+                self._release(outcome)
+
+            if not retry:
+                return result
+
+            attempt += 1
+            with self._condition:
+                self._retries += 1
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+            time.sleep(random.uniform(delay / 2, delay))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the current limit and call/throttle counters for operation results."""
+        with self._condition:
+            return {
+                'concurrency_limit': int(self._limit),
+                'peak_concurrency_limit': self._peak_limit,
+                'max_concurrency': self.max_limit,
+                'calls': self._calls,
+                'throttles': self._throttles,
+                'retries': self._retries
+            }
+
+    def _acquire(self) -> None:
+        """Wait until a call slot is free under the current limit."""
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def _release(self, outcome: Optional[str]) -> None:
+        """
+        Free a call slot and adjust the limit from the call's outcome:
+        'success' raises it, 'throttled' halves it and None (any other
+        failure) leaves it unchanged.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            self._calls += 1
+            if outcome == 'throttled':
+                self._throttles += 1
+                self._limit = max(float(self.min_limit), self._limit / 2)
+                logger.warning(
+                    "Cognito throttled a request, concurrency limit lowered to %d",
+                    int(self._limit)
+                )
+            elif outcome == 'success':
+                self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+                self._peak_limit = max(self._peak_limit, int(self._limit))
+            self._condition.notify_all()
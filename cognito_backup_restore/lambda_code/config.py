@@ -1,13 +1,62 @@
 """Configuration module for Cognito backup/restore system."""
 
 import os
+import json
 import logging
-from typing import Optional
+from typing import Dict, Optional
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Group membership enumeration strategies for backups:
+#   group - walk every group with list_users_in_group (cost scales with memberships)
+#   user  - call admin_list_groups_for_user once per user (legacy fallback)
+MEMBERSHIP_STRATEGIES = ('group', 'user')
+
+# Backup layouts:
+#   v1 - a single JSON document per backup, written in one invocation
+#   v2 - NDJSON user shards plus a manifest (see backup_format.py), checkpointed
+#        so backups longer than one invocation resume where they stopped
+BACKUP_FORMATS = ('v1', 'v2')
+
+# User restore modes:
+#   per_user - admin_create_user for every user
+#   import   - Cognito user import jobs (CSV), requires IMPORT_ROLE_ARN
+#   auto     - import jobs for backups of at least IMPORT_MIN_USERS users
+RESTORE_MODES = ('per_user', 'import', 'auto')
+
+# DynamoDB sub remap modes (see dynamodb_update.py):
+#   query - query the item collection of every mapped user
+#   scan  - scan the whole table once and hash-join items against the mappings
+#   auto  - scan when the mappings are a large share of the table's items
+#   alias - leave the records in place and write one alias#<old_sub> item per
+#           user for applications to resolve (see sub_alias.py)
+REMAP_MODES = ('auto', 'query', 'scan', 'alias')
+
+# How remapped DynamoDB records are moved:
+#   transaction - an atomic Put+Delete per record, packed into TransactWriteItems
+#   batch       - BatchWriteItem puts, a verification read, then batched deletes
+REMAP_WRITE_MODES = ('transaction', 'batch')
+
+# Default Cognito request rate quotas (requests per second) for the admin APIs
+# used during restore; override with COGNITO_RPS_LIMITS='{"admin_create_user": 40}'
+DEFAULT_COGNITO_RPS_LIMITS = {
+    'admin_create_user': 50.0,
+    'admin_get_user': 120.0,
+    'admin_add_user_to_group': 25.0,
+    'list_users': 30.0,
+    'describe_user_import_job': 5.0
+}
+
+# Share of the DynamoDB table's write capacity a sub remap may use, leaving the
+# rest to production traffic (see rate_limit.WriteCapacityLimiter)
+DEFAULT_WRITE_CAPACITY_FRACTION = 0.5
+
+# Milliseconds of invocation time kept back for writing a checkpoint and
+# returning once an operation stops early (see time_budget.py)
+DEFAULT_TIME_BUDGET_MARGIN_MS = 60000
+
 class Config:
     """Handles configuration and environment variables for the Cognito backup/restore system."""
 
@@ -15,6 +64,44 @@ class Config:
         self.region: str = os.environ.get('REGION', 'eu-west-2')
         self.backup_bucket_name: Optional[str] = os.environ.get('BACKUP_BUCKET_NAME')
         self.dynamodb_table_name: Optional[str] = os.environ.get('DYNAMODB_TABLE_NAME')
+        self.membership_strategy: str = os.environ.get('MEMBERSHIP_STRATEGY', 'group')
+        self.backup_part_size: int = int(os.environ.get('BACKUP_PART_SIZE_MB', '8')) * 1024 * 1024
+        self.backup_format: str = os.environ.get('BACKUP_FORMAT', 'v1')
+        self.backup_shard_size: int = int(os.environ.get('BACKUP_SHARD_SIZE', '10000'))
+        self.backup_workers: int = int(os.environ.get('BACKUP_WORKERS', '8'))
+        self.restore_workers: int = int(os.environ.get('RESTORE_WORKERS', '8'))
+        self.restore_prescan: bool = os.environ.get('RESTORE_PRESCAN', 'false').lower() == 'true'
+        self.prescan_spill_threshold: int = int(
+            os.environ.get('PRESCAN_SPILL_THRESHOLD', '500000')
+        )
+        self.restore_mode: str = os.environ.get('RESTORE_MODE', 'auto')
+        self.import_role_arn: Optional[str] = os.environ.get('IMPORT_ROLE_ARN')
+        self.import_min_users: int = int(os.environ.get('IMPORT_MIN_USERS', '10000'))
+        self.remap_mode: str = os.environ.get('REMAP_MODE', 'auto')
+        self.remap_write_mode: str = os.environ.get('REMAP_WRITE_MODE', 'transaction')
+        self.remap_capacity_fraction: float = float(
+            os.environ.get('REMAP_WRITE_CAPACITY_FRACTION', str(DEFAULT_WRITE_CAPACITY_FRACTION))
+        )
+        # Only for tables where every user with records has a u#<sub>/u#<sub> profile record
+        self.remap_probe_profile: bool = (
+            os.environ.get('REMAP_PROBE_PROFILE', 'false').lower() == 'true'
+        )
+        self.remap_queue_url: Optional[str] = os.environ.get('REMAP_QUEUE_URL')
+        self.remap_chunk_size: int = int(os.environ.get('REMAP_CHUNK_SIZE', '100'))
+        self.remap_queue_wait_seconds: int = int(os.environ.get('REMAP_QUEUE_WAIT_SECONDS', '20'))
+        self.remap_capacity_units: Optional[float] = (
+            float(os.environ['REMAP_WRITE_CAPACITY_UNITS'])
+            if os.environ.get('REMAP_WRITE_CAPACITY_UNITS') else None
+        )
+        self.time_budget_margin_ms: int = int(
+            os.environ.get('TIME_BUDGET_MARGIN_MS', str(DEFAULT_TIME_BUDGET_MARGIN_MS))
+        )
+        self.auto_continue: bool = os.environ.get('AUTO_CONTINUE', 'false').lower() == 'true'
+        self.max_invocations: int = int(os.environ.get('MAX_INVOCATIONS', '50'))
+        self.cognito_rps_limits: Dict[str, float] = {
+            **DEFAULT_COGNITO_RPS_LIMITS,
+            **json.loads(os.environ.get('COGNITO_RPS_LIMITS', '{}'))
+        }
 
     def validate(self) -> None:
         """Validate required configuration parameters."""
@@ -22,4 +109,26 @@ class Config:
             logger.error("BACKUP_BUCKET_NAME environment variable is not set")
             raise ValueError("BACKUP_BUCKET_NAME is required")
         if not self.dynamodb_table_name:
-            logger.warning("DYNAMODB_TABLE_NAME environment variable is not set")
\ No newline at end of file
+            logger.warning("DYNAMODB_TABLE_NAME environment variable is not set")
+        if self.membership_strategy not in MEMBERSHIP_STRATEGIES:
+            logger.error("Invalid MEMBERSHIP_STRATEGY: %s", self.membership_strategy)
+            raise ValueError(
+                f"MEMBERSHIP_STRATEGY must be one of {', '.join(MEMBERSHIP_STRATEGIES)}"
+            )
+        if self.backup_format not in BACKUP_FORMATS:
+            logger.error("Invalid BACKUP_FORMAT: %s", self.backup_format)
+            raise ValueError(f"BACKUP_FORMAT must be one of {', '.join(BACKUP_FORMATS)}")
+        if self.restore_mode not in RESTORE_MODES:
+            logger.error("Invalid RESTORE_MODE: %s", self.restore_mode)
+            raise ValueError(f"RESTORE_MODE must be one of {', '.join(RESTORE_MODES)}")
+        if self.remap_mode not in REMAP_MODES:
+            logger.error("Invalid REMAP_MODE: %s", self.remap_mode)
+            raise ValueError(f"REMAP_MODE must be one of {', '.join(REMAP_MODES)}")
+        if self.remap_write_mode not in REMAP_WRITE_MODES:
+            logger.error("Invalid REMAP_WRITE_MODE: %s", self.remap_write_mode)
+            raise ValueError(
+                f"REMAP_WRITE_MODE must be one of {', '.join(REMAP_WRITE_MODES)}"
+            )
+        if not 0 < self.remap_capacity_fraction <= 1:
+            logger.error("Invalid REMAP_WRITE_CAPACITY_FRACTION: %s", self.remap_capacity_fraction)
+            raise ValueError("REMAP_WRITE_CAPACITY_FRACTION must be greater than 0 and at most 1")
@@ -1,118 +1,961 @@
 """DynamoDB update module for Cognito user sub mappings."""
 
-from typing import Dict, Any, List
+import base64
+import hashlib
+import itertools
+import json
+import math
+import threading
+import time
+import uuid
+from datetime import datetime, UTC
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple, Union
 from botocore.exceptions import ClientError
 from .aws_clients import AWSClients
-from .config import logger
+from .config import DEFAULT_WRITE_CAPACITY_FRACTION, logger
+from .rate_limit import WriteCapacityLimiter
+from .remap_ledger import (
+    BATCH_GET_SIZE, BATCH_RETRY_BASE_DELAY, MAX_BATCH_RETRIES,
+    existing_keys, ledger_item, probe_window
+)
+from .sub_alias import alias_item
+from .sub_mapping_store import SubMappingStore
+from .time_budget import TimeBudget
+
+# TransactWriteItems accepts at most 100 actions, i.e. 50 Put/Delete pairs
+MAX_TRANSACTION_PAIRS = 50
+
+# Mappings queried per worker thread before their records are written
+QUERY_WINDOW_FACTOR = 4
+
+# In 'auto' remap mode, scan the table instead of querying per user once the
+# mappings number at least this share of the table's items (and at least
+# SCAN_MIN_MAPPINGS, below which querying is always cheap enough)
+SCAN_MAPPING_RATIO = 0.1
+SCAN_MIN_MAPPINGS = 1000
+
+# BatchWriteItem accepts at most 25 requests
+BATCH_WRITE_SIZE = 25
+
+# Errors with which DynamoDB rejects writes for lack of capacity; throttled
+# transactions fail with TransactionCanceledException and these reason codes
+THROTTLE_ERROR_CODES = frozenset({
+    'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded'
+})
+THROTTLE_CANCELLATION_CODES = frozenset({'ThrottlingError', 'ProvisionedThroughputExceeded'})
+
+# Namespace of the ClientRequestTokens derived from transaction contents
+REQUEST_TOKEN_NAMESPACE = uuid.UUID('0c4d7d62-5f4b-4d36-9a53-5b0f6e1c2a7e')
+
+def _byte_length(data: Union[str, bytes, bytearray]) -> int:
+    """Length in bytes of a string (UTF-8) or binary value."""
+    return len(data) if isinstance(data, (bytes, bytearray)) else len(data.encode('utf-8'))
+
+def _attribute_value_size(value: Dict[str, Any]) -> int:
+    """
+    Approximate the stored size of a low-level attribute value, the way
+    DynamoDB sizes items (numbers are counted by their digits).
+    """
+    (kind, data), = value.items()
+    if kind in ('S', 'N', 'B'):
+        return _byte_length(data)
+    if kind in ('SS', 'NS', 'BS'):
+        return sum(_byte_length(member) for member in data)
+    if kind == 'L':
+        return 3 + sum(1 + _attribute_value_size(member) for member in data)
+    if kind == 'M':
+        return 3 + sum(
+            1 + _byte_length(name) + _attribute_value_size(member) for name, member in data.items()
+        )
+    # BOOL and NULL
+    return 1
+
+def _canonical_value(value: Dict[str, Any]) -> Any:
+    """Comparable form of a low-level attribute value (set members are unordered)."""
+    (kind, data), = value.items()
+    if kind in ('SS', 'NS', 'BS'):
+        return kind, tuple(sorted(data))
+    if kind == 'L':
+        return kind, tuple(_canonical_value(member) for member in data)
+    if kind == 'M':
+        return kind, tuple(sorted(
+            (name, _canonical_value(member)) for name, member in data.items()
+        ))
+    return kind, data
+
+def _same_item(item: Optional[Dict[str, Any]], other: Dict[str, Any]) -> bool:
+    """Whether two low-level items hold the same attributes and values."""
+    return item is not None and item.keys() == other.keys() and all(
+        _canonical_value(item[name]) == _canonical_value(other[name]) for name in other
+    )
+
+def _binary_to_json(value: Any) -> Any:
+    """json.dumps default for binary attribute values, which JSON cannot hold."""
+    if isinstance(value, (bytes, bytearray)):
+        return {'$binary': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Cannot encode {type(value).__name__} in a request token")
 
 class DynamoDBUpdate:
     """Handles DynamoDB update operations for Cognito user sub mappings."""
 
-    def __init__(self, aws_clients: AWSClients):
+    def __init__(self, aws_clients: AWSClients,
+                 max_transaction_pairs: int = MAX_TRANSACTION_PAIRS, max_workers: int = 8,
+                 remap_mode: str = 'auto', write_mode: str = 'transaction',
+                 write_capacity_fraction: float = DEFAULT_WRITE_CAPACITY_FRACTION,
+                 write_capacity_units: Optional[float] = None, probe_profile: bool = False):
         self.aws_clients = aws_clients
+        self.remap_mode = remap_mode
+        self.write_mode = write_mode
+        self.probe_profile = probe_profile
+        self.max_transaction_pairs = max_transaction_pairs
+        self.max_workers = max_workers
+        # Pairs moved together: one transaction, or one verification read
+        self.flush_size = BATCH_GET_SIZE if write_mode == 'batch' else max_transaction_pairs
+        self.write_capacity_fraction = write_capacity_fraction
+        self.write_capacity_units = write_capacity_units
+        self.capacity_limiter: Optional[WriteCapacityLimiter] = None
+        self._limiter_lock = threading.Lock()
 
-    def update_dynamodb_sub(self, sub_mappings: List[Dict[str, str]]) -> Dict[str, Any]:
+    def update_dynamodb_sub(self, sub_mappings: Union[List[Dict[str, str]], SubMappingStore],
+                            time_budget: Optional[TimeBudget] = None,
+                            scan_position: Optional[Dict[str, Any]] = None,
+                            remap_mode: Optional[str] = None) -> Dict[str, Any]:
         """
         Update DynamoDB table with new user sub values using transactions.
+
+        Mappings are applied by querying each user's item collection or, when
+        they cover a large share of the table (or remap_mode is 'scan'), by
+        scanning the whole table once (see _scan_remap). With remap_mode
+        'alias' no record is moved; one alias item per user is written instead
+        (see _alias_remap). Records are moved in transactions or, with
+        write_mode 'batch', in two batched phases (see _batch_write_pairs).
+
+        Writes are paced to write_capacity_fraction of the table's write
+        capacity (see _write_capacity_units) so production traffic keeps the
+        rest; throttled writes slow the pace down and are retried. Concurrent
+        calls on one instance share the pacing. The result reports the
+        throughput of the call and the capacity used by the instance so far.
         
         Args:
-            sub_mappings: List of mappings containing old_sub, new_sub, and username
+            sub_mappings: Mappings containing old_sub, new_sub, and username,
+                as a list or a SubMappingStore (or a slice of one)
+            time_budget: Budget checked between units of work; once it is
+                exhausted the remaining mappings are left for a later invocation
+            scan_position: scan_position of a scan remap stopped by its budget,
+                to continue it where it stopped
+            remap_mode: Remap mode of this call, instead of the instance's
             
         Returns:
-            Dict containing update statistics
+            Dict containing update statistics and the number of mappings
+            processed; a scan remap that did not finish also returns its
+            scan_position
+        """
+        started = time.monotonic()
+        with self._limiter_lock:
+            if self.capacity_limiter is None:
+                self.capacity_limiter = WriteCapacityLimiter(
+                    self._write_capacity_units(), self.write_capacity_fraction
+                )
+        remap_mode = remap_mode or self.remap_mode
+        if remap_mode == 'alias':
+            stats = self._alias_remap(sub_mappings, time_budget)
+        elif self._use_scan(len(sub_mappings), remap_mode):
+            stats = self._scan_remap(sub_mappings, time_budget, scan_position)
+        else:
+            stats = self._query_remap(sub_mappings, time_budget)
+
+        elapsed = time.monotonic() - started
+        stats['write_mode'] = self.write_mode
+        stats['elapsed_seconds'] = round(elapsed, 3)
+        stats['records_per_second'] = (
+            round(stats['records_updated'] / elapsed, 1) if elapsed else 0.0
+        )
+        stats.update(self.capacity_limiter.stats())
+        logger.info(
+            "Remapped %d DynamoDB records in %.1f s (%.1f records/s, %s writes)",
+            stats['records_updated'], elapsed, stats['records_per_second'], self.write_mode
+        )
+        return stats
+
+    def _write_capacity_units(self) -> Optional[float]:
         """
-        updated_records = 0
-        failed_updates = []
-        skipped_updates = 0
+        Find the write capacity remap writes are paced against.
 
-        for mapping in sub_mappings:
-            old_sub = mapping['old_sub']
-            new_sub = mapping['new_sub']
-            username = mapping['username']
+        An explicit write_capacity_units wins. Otherwise a provisioned table's
+        capacity is the lowest WriteCapacityUnits of the table and its global
+        secondary indexes (every write also writes the indexes), and an
+        on-demand table's is its MaxWriteRequestUnits, if one is set.
+        
+        Returns:
+            Write capacity units per second, or None to pace by observed capacity
+        """
+        if self.write_capacity_units:
+            return self.write_capacity_units
+        try:
+            table = self.aws_clients.dynamodb_client.describe_table(
+                TableName=self.aws_clients.dynamodb_table
+            )['Table']
+        except ClientError as exc:
+            logger.warning(
+                "Could not describe DynamoDB table, pacing by observed capacity: %s", exc
+            )
+            return None
 
-            if old_sub == new_sub:
-                logger.info(
-                    "Skipping DynamoDB update for user %s: old_sub %s equals new_sub %s",
-                    username, old_sub, new_sub
+        provisioned = [
+            throughput.get('WriteCapacityUnits', 0)
+            for throughput in [table.get('ProvisionedThroughput', {})] + [
+                index.get('ProvisionedThroughput', {})
+                for index in table.get('GlobalSecondaryIndexes', [])
+            ]
+        ]
+        if provisioned[0] > 0:
+            return min(units for units in provisioned if units > 0)
+        max_units = table.get('OnDemandThroughput', {}).get('MaxWriteRequestUnits', -1)
+        return max_units if max_units > 0 else None
+
+    def _use_scan(self, mapping_count: int, remap_mode: Optional[str] = None) -> bool:
+        """
+        Decide whether to remap with a table scan rather than per-user queries.
+        
+        Args:
+            mapping_count: Number of sub mappings to apply
+            remap_mode: Remap mode of the call (the instance's by default)
+            
+        Returns:
+            True to remap with _scan_remap
+        """
+        remap_mode = remap_mode or self.remap_mode
+        if remap_mode != 'auto':
+            return remap_mode == 'scan'
+        if mapping_count < SCAN_MIN_MAPPINGS:
+            return False
+        try:
+            # ItemCount is refreshed by DynamoDB roughly every six hours
+            item_count = self.aws_clients.dynamodb_client.describe_table(
+                TableName=self.aws_clients.dynamodb_table
+            )['Table'].get('ItemCount', 0)
+        except ClientError as exc:
+            logger.warning("Could not describe DynamoDB table, remapping by query: %s", exc)
+            return False
+        use_scan = item_count > 0 and mapping_count >= item_count * SCAN_MAPPING_RATIO
+        logger.info(
+            "Remapping %d sub mappings against about %d items by %s",
+            mapping_count, item_count, 'scan' if use_scan else 'query'
+        )
+        return use_scan
+
+    def _alias_remap(self, sub_mappings: List[Dict[str, str]],
+                     time_budget: Optional[TimeBudget] = None) -> Dict[str, Any]:
+        """
+        Write an alias#<old_sub> -> new_sub item per user instead of moving records.
+
+        Applications translate subs through the aliases with
+        sub_alias.SubAliasResolver until the records are moved by a later
+        query or scan remap. Aliases are put with BatchWriteItem, so writing
+        one again (a resumed restore) is harmless.
+        
+        Args:
+            sub_mappings: List of mappings containing old_sub, new_sub, and username
+            time_budget: Budget checked before each batch of aliases
+            
+        Returns:
+            Dict containing update statistics and the number of mappings processed
+        """
+        stats = self._empty_stats()
+        for start in range(0, len(sub_mappings), BATCH_WRITE_SIZE):
+            if time_budget is not None and time_budget.exhausted():
+                break
+            batch = sub_mappings[start:start + BATCH_WRITE_SIZE]
+            stats['mappings_processed'] += len(batch)
+            aliased = [mapping for mapping in batch if mapping['old_sub'] != mapping['new_sub']]
+            stats['skipped_updates'] += len(batch) - len(aliased)
+            unprocessed = {
+                request['PutRequest']['Item']['PK']['S']
+                for request in self._batch_write(
+                    [{'PutRequest': {'Item': alias_item(mapping)}} for mapping in aliased], stats
                 )
-                skipped_updates += 1
-                continue
+            }
+            for mapping in aliased:
+                if alias_item(mapping)['PK']['S'] in unprocessed:
+                    stats['failed_updates'].append({
+                        'username': mapping['username'],
+                        'old_sub': mapping['old_sub'],
+                        'error': 'alias could not be written'
+                    })
+                else:
+                    stats['aliases_written'] += 1
+
+        logger.info("Wrote %d sub aliases", stats['aliases_written'])
+        return stats
+
+    def _scan_remap(self, sub_mappings: Union[List[Dict[str, str]], SubMappingStore],
+                    time_budget: Optional[TimeBudget] = None,
+                    scan_position: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Remap by reading the whole table once with a parallel segmented scan.
+
+        Every item's PK is probed against an in-memory u#<old_sub> -> mapping
+        hash map (or, for a SubMappingStore, by binary search of the store)
+        and only matching items are moved. A scan stopped by the time budget
+        returns the LastEvaluatedKey of every segment as its scan_position,
+        from which the next invocation continues; until a scan completes no
+        mapping counts as processed. A segment whose scan fails is recorded
+        in failed_updates and not scanned further.
+        
+        Args:
+            sub_mappings: Mappings containing old_sub, new_sub, and username
+            time_budget: Budget checked before each scan page
+            scan_position: Position returned by the stopped scan to continue
+            
+        Returns:
+            Dict containing update statistics, the number of mappings processed
+            and the scan_position (None once the scan has completed)
+        """
+        skipped_updates = sum(
+            1 for mapping in sub_mappings if mapping['old_sub'] == mapping['new_sub']
+        )
+        if isinstance(sub_mappings, SubMappingStore):
+            def find_mapping(pk: str) -> Optional[Dict[str, str]]:
+                return sub_mappings.lookup(pk[2:]) if pk.startswith('u#') else None
+        else:
+            find_mapping = {
+                f"u#{mapping['old_sub']}": mapping for mapping in sub_mappings
+            }.get
+
+        if scan_position is None:
+            scan_position = {
+                'total_segments': self.max_workers,
+                'segments': [{'start_key': None, 'done': False} for _ in range(self.max_workers)]
+            }
+        segments = scan_position['total_segments']
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            results = list(executor.map(
+                lambda segment: self._scan_segment(
+                    segment, segments, find_mapping, time_budget,
+                    scan_position['segments'][segment]
+                ),
+                range(segments)
+            ))
 
+        complete = all(position['done'] for _, position in results)
+        stats = self._empty_stats()
+        for field in ('records_updated', 'already_migrated', 'transactions', 'batch_requests'):
+            stats[field] = sum(result[field] for result, _ in results)
+        stats['failed_updates'] = [
+            failure for result, _ in results for failure in result['failed_updates']
+        ]
+        stats['scan_position'] = None
+        if complete:
+            stats['skipped_updates'] = skipped_updates
+            stats['mappings_processed'] = len(sub_mappings)
+        else:
+            stats['scan_position'] = {
+                'total_segments': segments,
+                'segments': [position for _, position in results]
+            }
+        logger.info(
+            "Scan remap %s: %d records updated in %d transactions",
+            'completed' if complete else 'stopped early',
+            stats['records_updated'], stats['transactions']
+        )
+        return stats
+
+    def _scan_segment(self, segment: int, total_segments: int,
+                      find_mapping: Callable[[str], Optional[Dict[str, str]]],
+                      time_budget: Optional[TimeBudget] = None,
+                      position: Optional[Dict[str, Any]] = None
+                      ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Scan one table segment and move the items of mapped users.
+        
+        Args:
+            segment: Segment number
+            total_segments: Number of segments the table is scanned in
+            find_mapping: Returns the sub mapping of an old PK, or None
+            time_budget: Budget checked before each scan page
+            position: Where an earlier scan of the segment stopped
+            
+        Returns:
+            Tuple of (segment statistics, segment position: the start_key of
+            the next page and whether the segment is done)
+        """
+        stats = self._empty_stats()
+        if position is not None and position['done']:
+            return stats, position
+        pending: List[Dict[str, Any]] = []
+        kwargs = {}
+        if position is not None and position['start_key']:
+            kwargs['ExclusiveStartKey'] = position['start_key']
+        done = True
+        while True:
+            if time_budget is not None and time_budget.exhausted():
+                done = False
+                break
             try:
+                page = self.aws_clients.dynamodb_client.scan(
+                    TableName=self.aws_clients.dynamodb_table,
+                    Segment=segment,
+                    TotalSegments=total_segments,
+                    **kwargs
+                )
+            except ClientError as exc:
+                logger.warning("Scan of table segment %d failed: %s", segment, exc)
+                stats['failed_updates'].append({
+                    'segment': segment,
+                    'start_key': kwargs.get('ExclusiveStartKey'),
+                    'error': str(exc)
+                })
+                break
+            for item in page.get('Items', []):
+                mapping = find_mapping(item['PK']['S'])
+                if mapping is None or mapping['old_sub'] == mapping['new_sub']:
+                    continue
+                pending.append(self._remap_pair(mapping, item))
+                if len(pending) >= self.flush_size:
+                    self._flush_pairs(pending, stats)
+                    pending = []
+            if 'LastEvaluatedKey' not in page:
+                break
+            kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+        self._flush_pairs(pending, stats)
+        return stats, {'start_key': kwargs.get('ExclusiveStartKey'), 'done': done}
+
+    def _query_remap(self, sub_mappings: List[Dict[str, str]],
+                     time_budget: Optional[TimeBudget] = None) -> Dict[str, Any]:
+        """
+        Remap by querying the item collection of every mapped user.
+
+        The item collections of several users are queried at once by a pool of
+        max_workers threads (every query following LastEvaluatedKey to the
+        end); results are consumed in mapping order, so each collection's
+        records are written in key order. Every record is moved with a Put of
+        the re-keyed item and a Delete of the old one. Pairs are packed, across
+        users, into transactions of up to max_transaction_pairs pairs (or
+        batches, see _batch_write_pairs); a transaction that fails is split in
+        half and retried until the failing records are isolated.
+
+        Retries are idempotent: each Put requires the new key to be free and
+        each Delete the old record to exist, and records whose conditions show
+        an earlier attempt already moved them are counted as already_migrated
+        (see _finish_migrated_pair). Transactions carry a ClientRequestToken
+        derived from their contents. Users whose records have all moved are
+        written to the remap ledger, and ledger users are skipped without a
+        query the next time (users_already_migrated). With probe_profile set,
+        users without a profile record are skipped too (see probe_window).
+        
+        Args:
+            sub_mappings: List of mappings containing old_sub, new_sub, and username
+            time_budget: Budget checked before each mapping
+            
+        Returns:
+            Dict containing update statistics and the number of mappings processed
+        """
+        stats = self._empty_stats()
+        pending: List[Dict[str, Any]] = []
+        # Records still to move per old sub of the users being moved, and the
+        # users whose records have all moved, for the remap ledger
+        outstanding: Dict[str, List[Any]] = {}
+        completed: List[Dict[str, str]] = []
+
+        def flush() -> None:
+            failures = len(stats['failed_updates'])
+            self._flush_pairs(pending, stats)
+            failed_subs = {failure['old_sub'] for failure in stats['failed_updates'][failures:]}
+            for pair in pending:
+                entry = outstanding[pair['old_sub']]
+                entry[1] -= 1
+                if pair['old_sub'] in failed_subs:
+                    entry[2] = True
+                if entry[1] == 0:
+                    del outstanding[pair['old_sub']]
+                    if not entry[2]:
+                        completed.append(entry[0])
+            pending.clear()
+
+        def budgeted_mappings() -> Iterator[Dict[str, str]]:
+            for mapping in sub_mappings:
+                if time_budget is not None and time_budget.exhausted():
+                    return
+                yield mapping
+
+        mappings = budgeted_mappings()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            window_size = self.max_workers * QUERY_WINDOW_FACTOR
+            while window := list(itertools.islice(mappings, window_size)):
+                migrated, without_records = probe_window(
+                    self.aws_clients, window, stats, self.probe_profile
+                )
+                stats['mappings_processed'] += len(migrated) + len(without_records)
+                stats['users_already_migrated'] += len(migrated)
+                stats['users_without_records'] += len(without_records)
+                window = [
+                    mapping for mapping in window
+                    if id(mapping) not in migrated and id(mapping) not in without_records
+                ]
+                for mapping, items in zip(window, executor.map(self._query_user_items, window)):
+                    stats['mappings_processed'] += 1
+                    if items is None:
+                        stats['skipped_updates'] += 1
+                        continue
+                    if isinstance(items, ClientError):
+                        stats['failed_updates'].append({
+                            'username': mapping['username'],
+                            'old_sub': mapping['old_sub'],
+                            'error': str(items)
+                        })
+                        continue
+                    if not items:
+                        completed.append(mapping)
+                        continue
+
+                    outstanding[mapping['old_sub']] = [mapping, len(items), False]
+                    for item in items:
+                        pending.append(self._remap_pair(mapping, item))
+                        if len(pending) >= self.flush_size:
+                            flush()
+                if len(completed) >= BATCH_WRITE_SIZE:
+                    self._record_migrated(completed, stats)
+                    completed = []
+
+        flush()
+        self._record_migrated(completed, stats)
+        return stats
+
+    def _query_user_items(self, mapping: Dict[str, str]
+                          ) -> Union[List[Dict[str, Any]], ClientError, None]:
+        """
+        Read every record of a user's item collection, page by page.
+        
+        Args:
+            mapping: Sub mapping of the user
+            
+        Returns:
+            The records in key order, the ClientError that stopped the query,
+            or None if the mapping needs no update
+        """
+        old_sub = mapping['old_sub']
+        username = mapping['username']
+        if old_sub == mapping['new_sub']:
+            logger.info(
+                "Skipping DynamoDB update for user %s: old_sub %s equals new_sub %s",
+                username, old_sub, mapping['new_sub']
+            )
+            return None
+
+        items = []
+        kwargs = {}
+        try:
+            while True:
                 response = self.aws_clients.dynamodb_client.query(
                     TableName=self.aws_clients.dynamodb_table,
                     KeyConditionExpression='PK = :old_sub',
-                    ExpressionAttributeValues={':old_sub': {'S': f'u#{old_sub}'}}
+                    ExpressionAttributeValues={':old_sub': {'S': f'u#{old_sub}'}},
+                    **kwargs
                 )
+                items.extend(response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except ClientError as exc:
+            logger.warning(
+                "Failed to query DynamoDB for user %s (PK u#%s): %s",
+                username, old_sub, exc
+            )
+            return exc
 
-                items = response.get('Items', [])
-                if not items:
-                    logger.info(
-                        "No DynamoDB records found for user %s with PK u#%s, skipping creation",
-                        username, old_sub
-                    )
-                    continue
+        if not items:
+            logger.info(
+                "No DynamoDB records found for user %s with PK u#%s, skipping creation",
+                username, old_sub
+            )
+        return items
 
-                for item in items:
-                    try:
-                        old_pk = item['PK']['S']
-                        old_sk = item['SK']['S']
-
-                        new_item = {k: v for k, v in item.items()}
-                        new_item['PK'] = {'S': f'u#{new_sub}'}
-
-                        if old_sk.startswith('u#'):
-                            new_item['SK'] = {'S': f'u#{new_sub}'}
-
-                        self.aws_clients.dynamodb_client.transact_write_items(
-                            TransactItems=[
-                                {
-                                    'Put': {
-                                        'TableName': self.aws_clients.dynamodb_table,
-                                        'Item': new_item
-                                    }
-                                },
-                                {
-                                    'Delete': {
-                                        'TableName': self.aws_clients.dynamodb_table,
-                                        'Key': {
-                                            'PK': {'S': old_pk},
-                                            'SK': {'S': old_sk}
-                                        }
-                                    }
-                                }
-                            ]
-                        )
-                        updated_records += 1
-                        logger.info(
-                            "Updated DynamoDB record for user %s: PK u#%s -> u#%s, SK %s -> %s",
-                            username, old_sub, new_sub, old_sk, new_item['SK']['S']
-                        )
-                    except ClientError as exc:
-                        logger.warning(
-                            "Failed to update DynamoDB record for user %s "
-                            "(PK u#%s -> u#%s, SK %s): %s",
-                            username, old_sub, new_sub, old_sk, exc
+    @staticmethod
+    def _remap_pair(mapping: Dict[str, str], item: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Describe the move of one record from the old sub's key to the new sub's.
+        
+        Args:
+            mapping: Sub mapping of the record's user
+            item: The record as returned by query
+            
+        Returns:
+            Dict with the mapping fields, the old keys and the re-keyed item
+        """
+        new_sub = mapping['new_sub']
+        new_item = dict(item)
+        new_item['PK'] = {'S': f'u#{new_sub}'}
+        if item['SK']['S'].startswith('u#'):
+            new_item['SK'] = {'S': f'u#{new_sub}'}
+        return {
+            **mapping,
+            'old_pk': item['PK']['S'],
+            'old_sk': item['SK']['S'],
+            'new_item': new_item
+        }
+
+    def _flush_pairs(self, pairs: List[Dict[str, Any]], stats: Dict[str, Any]) -> None:
+        """Move the records of a group of pairs the way write_mode asks for."""
+        if self.write_mode == 'batch':
+            self._batch_write_pairs(pairs, stats)
+        else:
+            self._write_pairs(pairs, stats)
+
+    def _write_pairs(self, pairs: List[Dict[str, Any]], stats: Dict[str, Any]) -> None:
+        """
+        Write Put/Delete pairs in one transaction, splitting it on failure.
+        
+        Args:
+            pairs: Pairs from _remap_pair
+            stats: Statistics of the running update
+        """
+        if not pairs:
+            return
+
+        table = self.aws_clients.dynamodb_table
+        units = 4 * sum(self._write_units(pair['new_item']) for pair in pairs)
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            self.capacity_limiter.acquire(units)
+            try:
+                response = self.aws_clients.dynamodb_client.transact_write_items(
+                    TransactItems=[
+                        action
+                        for pair in pairs
+                        for action in (
+                            {'Put': {
+                                'TableName': table,
+                                'Item': pair['new_item'],
+                                'ConditionExpression': 'attribute_not_exists(PK)'
+                            }},
+                            {'Delete': {
+                                'TableName': table,
+                                'Key': {'PK': {'S': pair['old_pk']}, 'SK': {'S': pair['old_sk']}},
+                                'ConditionExpression': 'attribute_exists(PK)'
+                            }}
                         )
-                        failed_updates.append({
-                            'username': username,
-                            'old_sub': old_sub,
-                            'sk': old_sk,
-                            'error': str(exc)
-                        })
+                    ],
+                    ClientRequestToken=self._request_token(pairs),
+                    ReturnConsumedCapacity='TOTAL'
+                )
             except ClientError as exc:
-                logger.warning(
-                    "Failed to query DynamoDB for user %s (PK u#%s): %s",
-                    username, old_sub, exc
+                if self._is_throttled(exc) and attempt < MAX_BATCH_RETRIES:
+                    self.capacity_limiter.throttled()
+                    continue
+                conflicts = self._condition_conflicts(exc, len(pairs))
+                if conflicts:
+                    for index, (put_failed, delete_failed) in conflicts.items():
+                        self._finish_migrated_pair(pairs[index], put_failed, delete_failed, stats)
+                    self._write_pairs(
+                        [pair for index, pair in enumerate(pairs) if index not in conflicts], stats
+                    )
+                    return
+                if len(pairs) > 1:
+                    logger.warning(
+                        "Transaction of %d record updates failed, splitting it: %s", len(pairs), exc
+                    )
+                    middle = len(pairs) // 2
+                    self._write_pairs(pairs[:middle], stats)
+                    self._write_pairs(pairs[middle:], stats)
+                    return
+
+                self._record_failure(pairs[0], stats, str(exc))
+                return
+            self.capacity_limiter.settle(units, self._consumed_units(response))
+            break
+
+        stats['transactions'] += 1
+        stats['records_updated'] += len(pairs)
+        for pair in pairs:
+            logger.info(
+                "Updated DynamoDB record for user %s: PK u#%s -> u#%s, SK %s -> %s",
+                pair['username'], pair['old_sub'], pair['new_sub'],
+                pair['old_sk'], pair['new_item']['SK']['S']
+            )
+
+    def _finish_migrated_pair(self, pair: Dict[str, Any], put_failed: bool,
+                              delete_failed: bool, stats: Dict[str, Any]) -> None:
+        """
+        Settle a record whose transaction conditions show it may already be moved.
+
+        If the old record is gone, an earlier attempt (or another worker) moved
+        it. If the new key is taken as well, the old record is only deleted when
+        the item under the new key equals the re-keyed record; any other item
+        there is a conflict, recorded as a failed update with both kept.
+        
+        Args:
+            pair: Pair from _remap_pair
+            put_failed: Whether the new record already existed
+            delete_failed: Whether the old record no longer existed
+            stats: Statistics of the running update
+        """
+        if put_failed and not delete_failed:
+            new_key = (pair['new_item']['PK']['S'], pair['new_item']['SK']['S'])
+            existing, unchecked = existing_keys(
+                self.aws_clients, [{'PK': pair['new_item']['PK'], 'SK': pair['new_item']['SK']}],
+                stats, projection=None
+            )
+            if unchecked:
+                self._record_failure(pair, stats, 'record under the new key could not be read')
+                return
+            if not _same_item(existing.get(new_key), pair['new_item']):
+                self._record_failure(pair, stats, 'conflicting record exists under the new key')
+                return
+            try:
+                self.aws_clients.dynamodb_client.delete_item(
+                    TableName=self.aws_clients.dynamodb_table,
+                    Key={'PK': {'S': pair['old_pk']}, 'SK': {'S': pair['old_sk']}},
+                    ConditionExpression='attribute_exists(PK)'
                 )
-                failed_updates.append({
-                    'username': username,
-                    'old_sub': old_sub,
-                    'error': str(exc)
-                })
+            except ClientError as exc:
+                if exc.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                    self._record_failure(pair, stats, str(exc))
+                    return
+        stats['already_migrated'] += 1
+        logger.info(
+            "DynamoDB record for user %s (SK %s) was already moved to u#%s",
+            pair['username'], pair['old_sk'], pair['new_sub']
+        )
 
+    def _record_migrated(self, mappings: List[Dict[str, str]], stats: Dict[str, Any]) -> None:
+        """
+        Add users whose records have all been moved to the remap ledger.
+        
+        Args:
+            mappings: Mappings of the finished users
+            stats: Statistics of the running update
+        """
+        now = datetime.now(UTC).isoformat()
+        unprocessed = self._batch_write(
+            [{'PutRequest': {'Item': ledger_item(mapping, now)}} for mapping in mappings], stats
+        )
+        if unprocessed:
+            # The users' records are moved either way; a re-run only queries them again
+            logger.warning("%d remap ledger entries could not be written", len(unprocessed))
+
+    def _batch_write_pairs(self, pairs: List[Dict[str, Any]], stats: Dict[str, Any]) -> None:
+        """
+        Move records without transactions, in batched phases.
+
+        BatchWriteItem puts cannot be conditional, so the new keys are read
+        first: a new key already holding the re-keyed record only needs the old
+        record deleted (already migrated), and any other item there is a
+        conflict, recorded as a failed update with both records kept, as in
+        transaction mode. Phase 1 writes the remaining re-keyed items. Phase 2
+        reads them back with a consistent BatchGetItem and deletes only the old
+        records whose new item is confirmed. A record is never lost: at worst
+        both copies exist until a later remap retries the delete.
+        
+        Args:
+            pairs: Pairs from _remap_pair
+            stats: Statistics of the running update
+        """
+        if not pairs:
+            return
+
+        def new_keys(pairs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            return [{'PK': pair['new_item']['PK'], 'SK': pair['new_item']['SK']} for pair in pairs]
+
+        def new_key(pair: Dict[str, Any]) -> Tuple[str, str]:
+            return pair['new_item']['PK']['S'], pair['new_item']['SK']['S']
+
+        # Keep records whose new key is already taken out of the unconditional puts
+        existing, unchecked = existing_keys(
+            self.aws_clients, new_keys(pairs), stats, projection=None
+        )
+        writes, migrated = [], []
+        for pair in pairs:
+            if new_key(pair) in unchecked:
+                self._record_failure(pair, stats, 'record under the new key could not be read')
+            elif new_key(pair) not in existing:
+                writes.append(pair)
+            elif _same_item(existing[new_key(pair)], pair['new_item']):
+                migrated.append(pair)
+            else:
+                self._record_failure(pair, stats, 'conflicting record exists under the new key')
+
+        # Phase 1: write the re-keyed items
+        self._batch_write(
+            [{'PutRequest': {'Item': pair['new_item']}} for pair in writes], stats
+        )
+
+        # Phase 2: delete the old records whose new item is confirmed
+        confirmed, _ = existing_keys(self.aws_clients, new_keys(writes), stats, projection=None)
+        deletable = []
+        for pair in writes:
+            if _same_item(confirmed.get(new_key(pair)), pair['new_item']):
+                deletable.append(pair)
+            else:
+                self._record_failure(pair, stats, 'new record could not be written')
+        unprocessed = self._batch_write(
+            [
+                {'DeleteRequest': {
+                    'Key': {'PK': {'S': pair['old_pk']}, 'SK': {'S': pair['old_sk']}}
+                }}
+                for pair in [*deletable, *migrated]
+            ],
+            stats
+        )
+        undeleted = {
+            (request['DeleteRequest']['Key']['PK']['S'], request['DeleteRequest']['Key']['SK']['S'])
+            for request in unprocessed
+        }
+        migrated_ids = {id(pair) for pair in migrated}
+        for pair in [*deletable, *migrated]:
+            if (pair['old_pk'], pair['old_sk']) in undeleted:
+                self._record_failure(pair, stats, 'old record could not be deleted')
+            elif id(pair) in migrated_ids:
+                stats['already_migrated'] += 1
+            else:
+                stats['records_updated'] += 1
+
+    def _batch_write(self, requests: List[Dict[str, Any]],
+                     stats: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Send write requests in BatchWriteItem calls, retrying UnprocessedItems.
+        
+        Args:
+            requests: PutRequest/DeleteRequest entries for the table
+            stats: Statistics of the running update
+            
+        Returns:
+            The requests still unprocessed after MAX_BATCH_RETRIES retries
+        """
+        table = self.aws_clients.dynamodb_table
+        unprocessed = []
+        for start in range(0, len(requests), BATCH_WRITE_SIZE):
+            batch = requests[start:start + BATCH_WRITE_SIZE]
+            for attempt in range(MAX_BATCH_RETRIES + 1):
+                if attempt:
+                    time.sleep(BATCH_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                units = sum(self._write_units(self._request_item(request)) for request in batch)
+                self.capacity_limiter.acquire(units)
+                try:
+                    response = self.aws_clients.dynamodb_client.batch_write_item(
+                        RequestItems={table: batch},
+                        ReturnConsumedCapacity='TOTAL'
+                    )
+                except ClientError as exc:
+                    if self._is_throttled(exc) and attempt < MAX_BATCH_RETRIES:
+                        self.capacity_limiter.throttled()
+                        continue
+                    logger.warning("Batch write of %d requests failed: %s", len(batch), exc)
+                    break
+                self.capacity_limiter.settle(units, self._consumed_units(response))
+                stats['batch_requests'] += 1
+                batch = response.get('UnprocessedItems', {}).get(table, [])
+                if not batch:
+                    break
+                # Unprocessed items mean the table ran out of write capacity
+                self.capacity_limiter.throttled()
+            unprocessed.extend(batch)
+        return unprocessed
+
+    @staticmethod
+    def _record_failure(pair: Dict[str, Any], stats: Dict[str, Any], error: str) -> None:
+        """Add a record that could not be moved to the failed updates."""
+        logger.warning(
+            "Failed to update DynamoDB record for user %s (PK u#%s -> u#%s, SK %s): %s",
+            pair['username'], pair['old_sub'], pair['new_sub'], pair['old_sk'], error
+        )
+        stats['failed_updates'].append({
+            'username': pair['username'],
+            'old_sub': pair['old_sub'],
+            'sk': pair['old_sk'],
+            'error': error
+        })
+
+    @staticmethod
+    def _request_item(request: Dict[str, Any]) -> Dict[str, Any]:
+        """Item (or key) written by a BatchWriteItem request."""
+        if 'PutRequest' in request:
+            return request['PutRequest']['Item']
+        return request['DeleteRequest']['Key']
+
+    @staticmethod
+    def _write_units(item: Dict[str, Any]) -> int:
+        """Estimate the write capacity units of writing an item (1 per started KB)."""
+        size = sum(
+            _byte_length(name) + _attribute_value_size(value) for name, value in item.items()
+        )
+        return max(1, math.ceil(size / 1024))
+
+    @staticmethod
+    def _consumed_units(response: Dict[str, Any]) -> Optional[float]:
+        """Total CapacityUnits in a response's ConsumedCapacity, if it has any."""
+        consumed = response.get('ConsumedCapacity')
+        if not consumed:
+            return None
+        return sum(entry.get('CapacityUnits', 0) for entry in consumed)
+
+    @staticmethod
+    def _is_throttled(exc: ClientError) -> bool:
+        """Whether a write failed for lack of table capacity."""
+        code = exc.response.get('Error', {}).get('Code')
+        if code in THROTTLE_ERROR_CODES:
+            return True
+        return code == 'TransactionCanceledException' and any(
+            reason.get('Code') in THROTTLE_CANCELLATION_CODES
+            for reason in exc.response.get('CancellationReasons', [])
+        )
+
+    @staticmethod
+    def _empty_stats() -> Dict[str, Any]:
+        """Statistics of an update that has not done anything yet."""
         return {
-            'records_updated': updated_records,
-            'failed_updates': failed_updates,
-            'skipped_updates': skipped_updates
-        }
\ No newline at end of file
+            'records_updated': 0,
+            'already_migrated': 0,
+            'users_already_migrated': 0,
+            'users_without_records': 0,
+            'aliases_written': 0,
+            'failed_updates': [],
+            'skipped_updates': 0,
+            'mappings_processed': 0,
+            'transactions': 0,
+            'batch_requests': 0
+        }
+
+    @staticmethod
+    def _request_token(pairs: List[Dict[str, Any]]) -> str:
+        """
+        ClientRequestToken of a transaction, derived from what it writes.
+
+        Retrying the same transaction (within DynamoDB's ten-minute window)
+        reuses the token, so a transaction that succeeded but whose response
+        was lost is not applied twice.
+        """
+        digest = hashlib.sha256()
+        for pair in pairs:
+            digest.update(json.dumps(
+                [pair['old_pk'], pair['old_sk'], pair['new_item']],
+                sort_keys=True, default=_binary_to_json
+            ).encode('utf-8'))
+        return str(uuid.uuid5(REQUEST_TOKEN_NAMESPACE, digest.hexdigest()))
+
+    @staticmethod
+    def _condition_conflicts(exc: ClientError, pair_count: int) -> Dict[int, Tuple[bool, bool]]:
+        """
+        Find the pairs of a cancelled transaction whose conditions failed.
+        
+        Args:
+            exc: Error of the transaction
+            pair_count: Number of Put/Delete pairs in the transaction
+            
+        Returns:
+            Dict mapping pair index to (Put condition failed, Delete condition failed)
+        """
+        if exc.response.get('Error', {}).get('Code') != 'TransactionCanceledException':
+            return {}
+        reasons = exc.response.get('CancellationReasons', [])
+        if len(reasons) != 2 * pair_count:
+            return {}
+        conflicts = {}
+        for index in range(pair_count):
+            put_failed, delete_failed = (
+                reasons[2 * index + offset].get('Code') == 'ConditionalCheckFailed'
+                for offset in (0, 1)
+            )
+            if put_failed or delete_failed:
+                conflicts[index] = (put_failed, delete_failed)
+        return conflicts
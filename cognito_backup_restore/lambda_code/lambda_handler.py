@@ -3,18 +3,36 @@
 import json
 from typing import Dict, Any
 from botocore.exceptions import ClientError
-from .config import Config, logger
-from .aws_clients import AWSClients
+from .config import Config, BACKUP_FORMATS, MEMBERSHIP_STRATEGIES, RESTORE_MODES, logger
+from .aws_clients import AWSClients, CLIENT_REGISTRY
 from .backup import CognitoBackup
+from .backup_format import is_manifest_key, load_manifest, verify_backup
+from .checkpoint import BackupCheckpoint, load_checkpoint
+from .compaction import BackupCompaction
+from .dynamodb_update import DynamoDBUpdate
+from .remap_queue import RemapWorker, SQSRemapQueue
 from .restore import CognitoRestore
+from .time_budget import TimeBudget
 
-def lambda_handler(event: Dict[str, Any], _context) -> Dict[str, Any]:
+def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     """
     Main Lambda handler for Cognito backup and restore operations.
 
+    Backups (v2) and restores stop cleanly when the invocation's remaining time
+    drops below TIME_BUDGET_MARGIN_MS and respond with status 202 and a
+    'continuation' event that resumes them; with AUTO_CONTINUE set the handler
+    invokes itself asynchronously with that event.
+
+    boto3 clients are created on first use and reused by later (warm)
+    invocations of the same execution environment (see ClientRegistry).
+
+    Events from an SQS event source mapping on REMAP_QUEUE_URL are remap work
+    messages; the response reports the messages to deliver again as
+    batchItemFailures.
+
     Args:
         event: Lambda event containing operation details
-        _context: Lambda context (unused, prefixed with underscore)
+        context: Lambda context (None outside Lambda)
 
     Returns:
         Dict containing HTTP response with status and body
@@ -23,6 +41,15 @@ def lambda_handler(event: Dict[str, Any], _context) -> Dict[str, Any]:
         config = Config()
         config.validate()
         aws_clients = AWSClients(config)
+        logger.info("Client registry before invocation: %s", json.dumps(CLIENT_REGISTRY.stats()))
+        time_budget = TimeBudget(context, config.time_budget_margin_ms)
+        if _is_sqs_event(event):
+            result = _remap_worker(config, aws_clients, time_budget).process_records(
+                event['Records']
+            )
+            logger.info("Remap worker finished: %s", json.dumps(result))
+            return {'batchItemFailures': result['batchItemFailures']}
+
         operation = event.get('operation')
 
         if operation == 'backup':
@@ -35,12 +62,38 @@ def lambda_handler(event: Dict[str, Any], _context) -> Dict[str, Any]:
                     })
                 }
 
-            backup_service = CognitoBackup(aws_clients)
-            result = backup_service.backup_user_pool(user_pool_id)
-            return {
-                'statusCode': 200,
-                'body': json.dumps(result)
-            }
+            membership_strategy = event.get('membership_strategy', config.membership_strategy)
+            if membership_strategy not in MEMBERSHIP_STRATEGIES:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': 'membership_strategy must be one of '
+                                 f"{', '.join(MEMBERSHIP_STRATEGIES)}"
+                    })
+                }
+
+            incremental = bool(event.get('incremental', False))
+            backup_format = event.get('backup_format', config.backup_format)
+            if incremental:
+                backup_format = 'v2'
+            if backup_format not in BACKUP_FORMATS:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': f"backup_format must be one of {', '.join(BACKUP_FORMATS)}"
+                    })
+                }
+
+            backup_service = CognitoBackup(
+                aws_clients, membership_strategy,
+                part_size=config.backup_part_size,
+                backup_format=backup_format,
+                shard_size=config.backup_shard_size,
+                max_workers=config.backup_workers,
+                time_budget=time_budget
+            )
+            result = backup_service.backup_user_pool(user_pool_id, incremental=incremental)
+            return _operation_response(result, config, aws_clients, context)
 
         if operation == 'restore':
             backup_key = event.get('backup_key')
@@ -62,8 +115,106 @@ def lambda_handler(event: Dict[str, Any], _context) -> Dict[str, Any]:
                     })
                 }
 
-            restore_service = CognitoRestore(aws_clients)
-            result = restore_service.restore_user_pool(backup_key, target_user_pool_id)
+            restore_mode = event.get('restore_mode', config.restore_mode)
+            if restore_mode not in RESTORE_MODES:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': f"restore_mode must be one of {', '.join(RESTORE_MODES)}"
+                    })
+                }
+
+            result = _restore_service(config, aws_clients, time_budget).restore_user_pool(
+                backup_key, target_user_pool_id,
+                prescan=bool(event.get('prescan', config.restore_prescan)),
+                restore_mode=restore_mode
+            )
+            return _operation_response(result, config, aws_clients, context)
+
+        if operation == 'resume':
+            checkpoint_key = event.get('checkpoint_key')
+            if not checkpoint_key:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': 'checkpoint_key is required for resume operation'
+                    })
+                }
+
+            checkpoint = load_checkpoint(
+                aws_clients.s3_client, aws_clients.bucket_name, checkpoint_key
+            )
+            if isinstance(checkpoint, BackupCheckpoint):
+                backup_service = CognitoBackup(
+                    aws_clients,
+                    part_size=config.backup_part_size,
+                    shard_size=config.backup_shard_size,
+                    max_workers=config.backup_workers,
+                    time_budget=time_budget
+                )
+                result = backup_service.resume_backup(checkpoint)
+            else:
+                result = _restore_service(
+                    config, aws_clients, time_budget
+                ).resume_user_pool(checkpoint)
+            return _operation_response(result, config, aws_clients, context)
+
+        if operation == 'remap_worker':
+            if not config.remap_queue_url:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': 'REMAP_QUEUE_URL is required for remap_worker operation'
+                    })
+                }
+
+            result = _remap_worker(config, aws_clients, time_budget).drain(
+                SQSRemapQueue(
+                    aws_clients.sqs_client, config.remap_queue_url,
+                    config.remap_queue_wait_seconds
+                )
+            )
+            return {
+                'statusCode': 200,
+                'body': json.dumps(result)
+            }
+
+        if operation == 'verify':
+            backup_key = event.get('backup_key')
+            if not backup_key or not is_manifest_key(backup_key):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': ('backup_key of a v2 backup manifest is required '
+                                  'for verify operation')
+                    })
+                }
+
+            manifest = load_manifest(
+                aws_clients.s3_client, aws_clients.bucket_name, backup_key
+            )
+            result = verify_backup(aws_clients.s3_client, aws_clients.bucket_name, manifest)
+            return {
+                'statusCode': 200,
+                'body': json.dumps(result)
+            }
+
+        if operation == 'compact':
+            user_pool_id = event.get('user_pool_id')
+            if not user_pool_id:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': 'user_pool_id is required for compact operation'
+                    })
+                }
+
+            compaction_service = BackupCompaction(
+                aws_clients,
+                shard_size=config.backup_shard_size,
+                part_size=config.backup_part_size
+            )
+            result = compaction_service.compact(user_pool_id, event.get('backup_key'))
             return {
                 'statusCode': 200,
                 'body': json.dumps(result)
@@ -72,13 +223,109 @@ def lambda_handler(event: Dict[str, Any], _context) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'body': json.dumps({
-                'error': 'Invalid operation. Use "backup" or "restore"'
+                'error': 'Invalid operation. Use "backup", "restore", "resume", '
+                         '"remap_worker", "verify" or "compact"'
             })
         }
 
     except (ClientError, ValueError) as exc:
         logger.error("Lambda execution failed: %s", str(exc))
+        if _is_sqs_event(event):
+            # Every message must be delivered again; a response without
+            # batchItemFailures would have SQS delete them all
+            return {'batchItemFailures': [
+                {'itemIdentifier': record['messageId']} for record in event['Records']
+            ]}
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(exc)})
-        }
\ No newline at end of file
+        }
+
+def _is_sqs_event(event: Dict[str, Any]) -> bool:
+    """Whether an event was delivered by an SQS event source mapping."""
+    records = event.get('Records')
+    return bool(records) and all(record.get('eventSource') == 'aws:sqs' for record in records)
+
+def _remap_worker(config: Config, aws_clients: AWSClients,
+                  time_budget: TimeBudget) -> RemapWorker:
+    """Create the worker that consumes remap work messages."""
+    dynamodb_update = DynamoDBUpdate(
+        aws_clients,
+        max_workers=config.restore_workers,
+        remap_mode=config.remap_mode,
+        write_mode=config.remap_write_mode,
+        write_capacity_fraction=config.remap_capacity_fraction,
+        write_capacity_units=config.remap_capacity_units,
+        probe_profile=config.remap_probe_profile
+    )
+    return RemapWorker(dynamodb_update, max_workers=config.restore_workers, time_budget=time_budget)
+
+def _restore_service(config: Config, aws_clients: AWSClients,
+                     time_budget: TimeBudget) -> CognitoRestore:
+    """Create the restore service used by the restore and resume operations."""
+    remap_queue = None
+    if config.remap_queue_url:
+        remap_queue = SQSRemapQueue(aws_clients.sqs_client, config.remap_queue_url)
+    return CognitoRestore(
+        aws_clients,
+        max_workers=config.restore_workers,
+        rps_limits=config.cognito_rps_limits,
+        prescan_spill_threshold=config.prescan_spill_threshold,
+        import_role_arn=config.import_role_arn,
+        import_min_users=config.import_min_users,
+        time_budget=time_budget,
+        remap_mode=config.remap_mode,
+        remap_write_mode=config.remap_write_mode,
+        remap_capacity_fraction=config.remap_capacity_fraction,
+        remap_capacity_units=config.remap_capacity_units,
+        remap_queue=remap_queue,
+        remap_chunk_size=config.remap_chunk_size,
+        remap_probe_profile=config.remap_probe_profile
+    )
+
+def _operation_response(result: Dict[str, Any], config: Config, aws_clients: AWSClients,
+                        context) -> Dict[str, Any]:
+    """
+    Build the response of a backup, restore or resume operation.
+
+    Operations stopped by their time budget get a 'continuation' event for the
+    resume operation and, with AUTO_CONTINUE set, are continued by an
+    asynchronous invocation of this function (up to MAX_INVOCATIONS per
+    operation).
+
+    Args:
+        result: Result returned by the backup or restore service
+        config: Configuration of this invocation
+        aws_clients: AWS clients of this invocation
+        context: Lambda context (None outside Lambda)
+
+    Returns:
+        Dict containing HTTP response with status and body
+    """
+    if result.get('status') != 'in_progress':
+        return {
+            'statusCode': 200,
+            'body': json.dumps(result)
+        }
+
+    continuation = {'operation': 'resume', 'checkpoint_key': result['checkpoint_key']}
+    result['continuation'] = continuation
+    result['continued'] = False
+    if config.auto_continue and context is not None:
+        if result['invocations'] >= config.max_invocations:
+            logger.warning(
+                "Not continuing %s: MAX_INVOCATIONS (%d) reached",
+                result['checkpoint_key'], config.max_invocations
+            )
+        else:
+            aws_clients.lambda_client.invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps(continuation).encode('utf-8')
+            )
+            result['continued'] = True
+            logger.info("Continuing %s in a new invocation", result['checkpoint_key'])
+    return {
+        'statusCode': 202,
+        'body': json.dumps(result)
+    }
@@ -0,0 +1,168 @@
+"""Streaming reader module for single-file (v1) Cognito backups.
+
+A v1 backup is one JSON document: backup-level fields (timestamp, user_pool,
+groups, ...) plus a ``users`` array. The reader walks the document straight
+off the S3 streaming body and yields users one at a time, so memory stays
+bounded by the largest single record rather than the size of the backup.
+"""
+
+import codecs
+import itertools
+import json
+from typing import Any, Dict, Iterator, Tuple
+from .config import logger
+
+# Bytes requested from the S3 body per read
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Header fields a restore needs before the first user can be created
+REQUIRED_HEADER_FIELDS = ('timestamp', 'groups')
+
+_WHITESPACE = ' \t\n\r'
+
+class _JsonStream:
+    """Incremental JSON tokenizer over a file-like byte stream."""
+
+    def __init__(self, body, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.body = body
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """Append the next chunk to the buffer; return False once the body is exhausted."""
+        if self._eof:
+            return False
+        chunk = self.body.read(self.chunk_size)
+        if self._pos > len(self._buffer) // 2:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        if not chunk:
+            self._eof = True
+            self._buffer += self._text.decode(b'', final=True)
+            return False
+        self._buffer += self._text.decode(chunk)
+        return True
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it ('' at the end)."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, chars: str) -> str:
+        """Consume the next non-whitespace character, which must be one of chars."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Malformed backup document: expected one of {chars!r}, got {char!r}")
+        self._pos += 1
+        return char
+
+    def value(self) -> Any:
+        """Decode and consume the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError as exc:
+                if self._fill():
+                    continue
+                raise ValueError(f"Malformed backup document: {exc}") from exc
+            # A number ending at the buffer edge may continue in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+def iter_document(body, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Tuple[str, Any]]:
+    """
+    Walk a v1 backup document as (field, value) pairs.
+
+    Every top-level field is yielded once with its value, except ``users``,
+    which is yielded once per element as ('users', user).
+
+    Args:
+        body: File-like byte stream (an S3 StreamingBody)
+        chunk_size: Bytes to read per call
+
+    Yields:
+        (field name, value) pairs in document order
+
+    Raises:
+        ValueError: If the document is not a JSON object
+    """
+    stream = _JsonStream(body, chunk_size)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        field = stream.value()
+        stream.expect(':')
+        if field == 'users':
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.expect(']')
+            else:
+                while True:
+                    yield field, stream.value()
+                    if stream.expect(',]') == ']':
+                        break
+        else:
+            yield field, stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+def load_legacy_backup(s3_client, bucket: str, key: str,
+                       chunk_size: int = STREAM_CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Load a v1 backup with its users as a stream.
+
+    Backups written by this tool put the header ahead of the users, so the
+    users are streamed from the same read. Older backups put ``groups`` after
+    ``users``; for those the document is read once for its header (users are
+    parsed and discarded one by one) and then a second time for the users.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        key: S3 key of the backup file
+        chunk_size: Bytes to read from S3 per call
+
+    Returns:
+        Backup header dict whose 'users' is a generator of user objects
+    """
+    def open_document() -> Iterator[Tuple[str, Any]]:
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        return iter_document(body, chunk_size)
+
+    document = open_document()
+    header: Dict[str, Any] = {}
+    for field, value in document:
+        if field != 'users':
+            header[field] = value
+            continue
+
+        if all(name in header for name in REQUIRED_HEADER_FIELDS):
+            header['users'] = _users(itertools.chain([(field, value)], document))
+            return header
+
+        logger.info("Backup %s lists users before its header, reading it twice", key)
+        for field, value in document:
+            if field != 'users':
+                header[field] = value
+        header['users'] = _users(open_document())
+        return header
+
+    header['users'] = iter(())
+    return header
+
+def _users(document: Iterator[Tuple[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Yield the users of a document walk, ignoring every other field."""
+    for field, value in document:
+        if field == 'users':
+            yield value
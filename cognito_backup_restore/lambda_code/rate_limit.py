@@ -0,0 +1,162 @@
+"""Rate limiting module for Cognito backup/restore operations."""
+
+import threading
+import time
+from typing import Any, Dict, Optional
+from .config import logger
+
+# Lowest write rate (capacity units per second) a throttled remap slows down to
+MIN_WRITE_CAPACITY_RATE = 1.0
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that paces callers to a sustained rate.
+
+    Tokens refill continuously at `rate` per second up to `capacity`; acquire()
+    blocks until enough tokens are available.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """
+        Take tokens from the bucket, waiting for them to refill if necessary.
+
+        Args:
+            tokens: Number of tokens to take (at most the bucket capacity)
+
+        Returns:
+            Seconds spent waiting
+        """
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def charge(self, tokens: float) -> None:
+        """
+        Adjust the bucket after the fact without waiting.
+
+        Positive tokens are taken and may leave the bucket in debt, which later
+        acquire() calls wait out; negative tokens are returned (up to capacity).
+
+        Args:
+            tokens: Number of tokens to take, or to return if negative
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - tokens)
+
+    def set_rate(self, rate: float) -> None:
+        """
+        Change the refill rate, keeping one second of burst capacity.
+
+        Args:
+            rate: New sustained rate per second
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = max(rate, 1.0)
+            self._tokens = min(self._tokens, self.capacity)
+
+    def _refill(self) -> None:
+        """Add the tokens accrued since the last refill (caller holds the lock)."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+class WriteCapacityLimiter:
+    """
+    Thread-safe pacer of DynamoDB writes to a share of the table's write capacity.
+
+    Writes acquire their estimated capacity units before they are sent and
+    settle the difference once DynamoDB reports the capacity they consumed,
+    so the bucket follows what the writes really cost. Without a known
+    capacity (on-demand tables) writes are not paced until the first throttle,
+    which sizes the bucket from the capacity the writes were observed to
+    consume. Every later throttle halves the rate.
+    """
+
+    def __init__(self, capacity_units: Optional[float], fraction: float):
+        if not 0 < fraction <= 1:
+            raise ValueError("fraction must be in (0, 1]")
+        self.fraction = fraction
+        self.bucket = TokenBucket(capacity_units * fraction) if capacity_units else None
+        self.consumed_units = 0.0
+        self.waited_seconds = 0.0
+        self.throttles = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units: float) -> None:
+        """
+        Wait until a write of about `units` capacity units may be sent.
+
+        Args:
+            units: Estimated write capacity units of the request
+        """
+        bucket = self.bucket
+        if bucket is None:
+            return
+        waited = bucket.acquire(units)
+        # A request larger than one second of capacity is paid off afterwards
+        if units > bucket.capacity:
+            bucket.charge(units - bucket.capacity)
+        with self._lock:
+            self.waited_seconds += waited
+
+    def settle(self, estimated: float, consumed: Optional[float]) -> None:
+        """
+        Correct the bucket with the capacity a sent write actually consumed.
+
+        Args:
+            estimated: Units acquired for the write
+            consumed: Units DynamoDB reported, or None if it reported none
+        """
+        if consumed is None:
+            consumed = estimated
+        with self._lock:
+            self.consumed_units += consumed
+        if self.bucket is not None:
+            self.bucket.charge(consumed - estimated)
+
+    def throttled(self) -> None:
+        """Slow down after DynamoDB throttled a write."""
+        with self._lock:
+            self.throttles += 1
+            if self.bucket is None:
+                elapsed = time.monotonic() - self._started
+                observed = self.consumed_units / elapsed if elapsed else 0.0
+                rate = max(MIN_WRITE_CAPACITY_RATE, observed * self.fraction)
+                self.bucket = TokenBucket(rate)
+            else:
+                rate = max(MIN_WRITE_CAPACITY_RATE, self.bucket.rate / 2)
+                self.bucket.set_rate(rate)
+        logger.warning("DynamoDB write throttled, pacing remap writes to %.1f WCU/s", rate)
+
+    def stats(self) -> Dict[str, Any]:
+        """Capacity consumed, time spent waiting and throttles seen so far."""
+        with self._lock:
+            return {
+                'write_capacity_units': round(self.consumed_units, 1),
+                'write_capacity_rate': self.bucket.rate if self.bucket is not None else None,
+                'capacity_wait_seconds': round(self.waited_seconds, 3),
+                'throttled_writes': self.throttles
+            }
@@ -0,0 +1,148 @@
+"""Remap ledger module for skipping users a query remap has already moved.
+
+A query remap writes one item per user whose records have all been moved::
+
+    PK = remap#<old_sub>, SK = remap#<new_sub>, username = <username>, completed_at = <time>
+
+Before a window of users is queried, their ledger items are looked up with
+consistent BatchGetItem reads (see probe_window), together with each user's
+``u#<sub>`` profile record when the profile probe is on, so a remap run again
+only queries the users it has not finished.
+"""
+
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+from botocore.exceptions import ClientError
+from .aws_clients import AWSClients
+from .config import logger
+
+LEDGER_PREFIX = 'remap#'
+
+# BatchGetItem accepts at most 100 keys
+BATCH_GET_SIZE = 100
+
+# Retries of a batch's UnprocessedItems/UnprocessedKeys, with exponential backoff
+MAX_BATCH_RETRIES = 8
+BATCH_RETRY_BASE_DELAY = 0.05
+
+def ledger_key(mapping: Dict[str, str]) -> Tuple[str, str]:
+    """
+    PK and SK of a mapping's remap ledger item.
+
+    Args:
+        mapping: Sub mapping containing old_sub, new_sub, and username
+
+    Returns:
+        Tuple of (PK, SK) strings
+    """
+    return f"{LEDGER_PREFIX}{mapping['old_sub']}", f"{LEDGER_PREFIX}{mapping['new_sub']}"
+
+def ledger_item(mapping: Dict[str, str], completed_at: str) -> Dict[str, Dict[str, str]]:
+    """
+    Remap ledger item recording that a user's records have all been moved.
+
+    Args:
+        mapping: Sub mapping containing old_sub, new_sub, and username
+        completed_at: ISO timestamp of the move
+
+    Returns:
+        DynamoDB item to put
+    """
+    pk, sk = ledger_key(mapping)
+    return {
+        'PK': {'S': pk},
+        'SK': {'S': sk},
+        'username': {'S': mapping['username']},
+        'completed_at': {'S': completed_at}
+    }
+
+def existing_keys(aws_clients: AWSClients, keys: List[Dict[str, Any]], stats: Dict[str, Any],
+                  projection: Optional[str] = 'PK, SK'
+                  ) -> Tuple[Dict[Tuple[str, str], Dict[str, Any]], Set[Tuple[str, str]]]:
+    """
+    Check which keys exist with consistent BatchGetItem reads.
+
+    Keys whose read failed, or were still unprocessed after
+    MAX_BATCH_RETRIES retries, are returned as unchecked: callers must not
+    take them to be missing.
+
+    Args:
+        aws_clients: Clients and table name of the remapped table
+        keys: PK/SK keys to look up (without duplicates)
+        stats: Statistics of the running update
+        projection: Attributes to read, or None for whole items
+
+    Returns:
+        Tuple of (dict mapping the (PK, SK) string pairs that were found to
+        their items, set of (PK, SK) string pairs that could not be checked)
+    """
+    table = aws_clients.dynamodb_table
+    found = {}
+    unchecked = set()
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        batch = {'Keys': keys[start:start + BATCH_GET_SIZE], 'ConsistentRead': True}
+        if projection:
+            batch['ProjectionExpression'] = projection
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            if attempt:
+                time.sleep(BATCH_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            try:
+                response = aws_clients.dynamodb_client.batch_get_item(RequestItems={table: batch})
+            except ClientError as exc:
+                logger.warning("Batch read of %d keys failed: %s", len(batch['Keys']), exc)
+                break
+            stats['batch_requests'] += 1
+            for item in response.get('Responses', {}).get(table, []):
+                found[(item['PK']['S'], item['SK']['S'])] = item
+            batch = response.get('UnprocessedKeys', {}).get(table)
+            if not batch:
+                break
+        if batch:
+            unchecked.update((key['PK']['S'], key['SK']['S']) for key in batch['Keys'])
+    if unchecked:
+        logger.warning("%d keys could not be checked", len(unchecked))
+    return found, unchecked
+
+def probe_window(aws_clients: AWSClients, mappings: List[Dict[str, str]],
+                 stats: Dict[str, Any], probe_profile: bool = False) -> Tuple[Set[int], Set[int]]:
+    """
+    Find the mappings that need no query, with batched key lookups.
+
+    The remap ledger items of the mappings are always looked up. With
+    probe_profile set, so is each user's u#<sub>/u#<sub> profile record, and
+    users without one are taken to have no records at all; the probe shares
+    its BatchGetItem calls with the ledger lookup. Users whose keys could not
+    be checked are queried.
+
+    Args:
+        aws_clients: Clients and table name of the remapped table
+        mappings: Mappings about to be queried
+        stats: Statistics of the running update
+        probe_profile: Whether to look up the users' profile records
+
+    Returns:
+        Tuple of (id()s of mappings the ledger records as finished,
+        id()s of mappings whose user has no profile record)
+    """
+    candidates = [mapping for mapping in mappings if mapping['old_sub'] != mapping['new_sub']]
+    ledger_keys = {ledger_key(mapping): mapping for mapping in candidates}
+    profile_keys = {}
+    if probe_profile:
+        profile_keys = {
+            (f"u#{mapping['old_sub']}", f"u#{mapping['old_sub']}"): mapping
+            for mapping in candidates
+        }
+    found, unchecked = existing_keys(
+        aws_clients,
+        [{'PK': {'S': pk}, 'SK': {'S': sk}} for pk, sk in [*ledger_keys, *profile_keys]],
+        stats
+    )
+    migrated = {id(ledger_keys[key]) for key in found if key in ledger_keys}
+    with_profile = {
+        id(profile_keys[key]) for key in [*found, *unchecked] if key in profile_keys
+    }
+    without_records = {
+        id(mapping) for mapping in profile_keys.values()
+        if id(mapping) not in with_profile and id(mapping) not in migrated
+    }
+    return migrated, without_records
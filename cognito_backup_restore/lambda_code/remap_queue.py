@@ -0,0 +1,360 @@
+"""Remap queue module for running DynamoDB sub remaps outside of restores.
+
+With a remap queue configured, a restore publishes its sub mappings as
+chunked work messages instead of remapping inline::
+
+    {"checkpoint_key": "<restore checkpoint>", "first_mapping": 200,
+     "mappings": [{"username": ..., "old_sub": ..., "new_sub": ...}, ...]}
+
+RemapWorker consumes them, either from the records of an SQS-triggered
+invocation (reporting partial batch failures) or by draining the queue. Every
+remap mode is idempotent (moved records no longer match their old key, alias
+puts overwrite themselves), so a redelivered message is harmless.
+"""
+
+import itertools
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from botocore.exceptions import ClientError
+from .config import logger
+from .dynamodb_update import DynamoDBUpdate
+from .time_budget import TimeBudget
+
+# Sub mappings per work message (about 150 bytes each, well under SQS's 256 KiB)
+DEFAULT_REMAP_CHUNK_SIZE = 100
+
+# SendMessageBatch and ReceiveMessage handle at most 10 messages
+QUEUE_BATCH_SIZE = 10
+
+# SendMessageBatch payload limit (the bodies of all its messages together)
+MAX_BATCH_PAYLOAD_BYTES = 256 * 1024
+
+# Attempts at sending the entries of a batch SQS did not accept
+MAX_SEND_ATTEMPTS = 3
+
+# Long polling wait of ReceiveMessage; a short poll samples only some SQS
+# servers and can come back empty while messages are still queued
+RECEIVE_WAIT_SECONDS = 20
+
+# Remap statistics summed over messages
+SUMMED_STATS = (
+    'mappings_processed', 'records_updated', 'already_migrated', 'users_already_migrated',
+    'users_without_records', 'aliases_written', 'skipped_updates'
+)
+
+def _send_batches(bodies: List[str]) -> Iterator[List[str]]:
+    """
+    Split message bodies into SendMessageBatch batches, bounded by both
+    QUEUE_BATCH_SIZE messages and MAX_BATCH_PAYLOAD_BYTES.
+
+    Raises:
+        ValueError: If a single body exceeds MAX_BATCH_PAYLOAD_BYTES
+    """
+    batch: List[str] = []
+    batch_bytes = 0
+    for body in bodies:
+        size = len(body.encode('utf-8'))
+        if size > MAX_BATCH_PAYLOAD_BYTES:
+            raise ValueError(
+                f"Remap message of {size} bytes exceeds the SQS limit of "
+                f"{MAX_BATCH_PAYLOAD_BYTES} bytes; lower REMAP_CHUNK_SIZE"
+            )
+        if batch and (len(batch) >= QUEUE_BATCH_SIZE
+                      or batch_bytes + size > MAX_BATCH_PAYLOAD_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(body)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+class LocalRemapQueue:
+    """
+    In-process stand-in for an SQS remap queue (tests and local runs).
+
+    Received messages stay in flight until deleted or released, like SQS
+    messages within their visibility timeout.
+    """
+
+    def __init__(self):
+        self._visible: OrderedDict = OrderedDict()
+        self._in_flight: Dict[str, str] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def send_batch(self, bodies: List[str]) -> None:
+        """Add messages to the queue."""
+        with self._lock:
+            for body in bodies:
+                self._visible[f'local-{next(self._ids)}'] = body
+
+    def receive(self, max_messages: int = QUEUE_BATCH_SIZE) -> List[Dict[str, str]]:
+        """Take up to max_messages visible messages."""
+        with self._lock:
+            messages = []
+            while self._visible and len(messages) < max_messages:
+                message_id, body = self._visible.popitem(last=False)
+                self._in_flight[message_id] = body
+                messages.append(
+                    {'message_id': message_id, 'receipt_handle': message_id, 'body': body}
+                )
+            return messages
+
+    def delete(self, message: Dict[str, str]) -> None:
+        """Remove a processed message."""
+        with self._lock:
+            self._in_flight.pop(message['receipt_handle'], None)
+
+    def release(self, message: Dict[str, str]) -> None:
+        """Make a received message visible again."""
+        with self._lock:
+            body = self._in_flight.pop(message['receipt_handle'], None)
+            if body is not None:
+                self._visible[message['message_id']] = body
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._visible) + len(self._in_flight)
+
+class SQSRemapQueue:
+    """Remap queue backed by an Amazon SQS queue."""
+
+    def __init__(self, sqs_client, queue_url: str,
+                 wait_seconds: int = RECEIVE_WAIT_SECONDS):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.wait_seconds = wait_seconds
+
+    def send_batch(self, bodies: List[str]) -> None:
+        """
+        Send messages with SendMessageBatch, retrying entries SQS did not accept.
+
+        Batches are split by message count and by total payload size.
+
+        Raises:
+            ValueError: If a message is too large for SQS, or some messages
+                could not be sent
+        """
+        for batch in _send_batches(bodies):
+            entries = [
+                {'Id': str(index), 'MessageBody': body} for index, body in enumerate(batch)
+            ]
+            for _ in range(MAX_SEND_ATTEMPTS):
+                response = self.sqs_client.send_message_batch(
+                    QueueUrl=self.queue_url, Entries=entries
+                )
+                failed = {failure['Id'] for failure in response.get('Failed', [])}
+                entries = [entry for entry in entries if entry['Id'] in failed]
+                if not entries:
+                    break
+            if entries:
+                raise ValueError(f"{len(entries)} remap messages could not be sent to SQS")
+
+    def receive(self, max_messages: int = QUEUE_BATCH_SIZE) -> List[Dict[str, str]]:
+        """
+        Receive up to max_messages messages with long polling, so an empty
+        result means the queue is empty rather than that the servers sampled
+        had no messages.
+        """
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, QUEUE_BATCH_SIZE),
+            WaitTimeSeconds=self.wait_seconds
+        )
+        return [
+            {
+                'message_id': message['MessageId'],
+                'receipt_handle': message['ReceiptHandle'],
+                'body': message['Body']
+            }
+            for message in response.get('Messages', [])
+        ]
+
+    def delete(self, message: Dict[str, str]) -> None:
+        """Remove a processed message."""
+        self.sqs_client.delete_message(
+            QueueUrl=self.queue_url, ReceiptHandle=message['receipt_handle']
+        )
+
+    def release(self, message: Dict[str, str]) -> None:
+        """Make a received message visible again."""
+        self.sqs_client.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=message['receipt_handle'],
+            VisibilityTimeout=0
+        )
+
+def publish_remap_work(queue, sub_mappings: Sequence[Dict[str, str]], checkpoint_key: str,
+                       first_mapping: int = 0, chunk_size: int = DEFAULT_REMAP_CHUNK_SIZE,
+                       time_budget: Optional[TimeBudget] = None) -> Tuple[int, int]:
+    """
+    Publish sub mappings to a remap queue as chunked work messages.
+
+    Args:
+        queue: LocalRemapQueue or SQSRemapQueue
+        sub_mappings: Mappings still to publish (a list or a SubMappingStore)
+        checkpoint_key: Checkpoint of the restore the mappings belong to
+        first_mapping: Position of sub_mappings[0] among the restore's mappings
+        chunk_size: Mappings per message
+        time_budget: Budget checked before each batch of messages
+
+    Returns:
+        Tuple of (mappings published, messages published)
+    """
+    mappings_queued = 0
+    messages_queued = 0
+    batch_mappings = chunk_size * QUEUE_BATCH_SIZE
+    for start in range(0, len(sub_mappings), batch_mappings):
+        if time_budget is not None and time_budget.exhausted():
+            break
+        bodies = [
+            json.dumps({
+                'checkpoint_key': checkpoint_key,
+                'first_mapping': first_mapping + chunk_start,
+                'mappings': list(sub_mappings[chunk_start:chunk_start + chunk_size])
+            })
+            for chunk_start in range(
+                start, min(start + batch_mappings, len(sub_mappings)), chunk_size
+            )
+        ]
+        queue.send_batch(bodies)
+        mappings_queued += min(batch_mappings, len(sub_mappings) - start)
+        messages_queued += len(bodies)
+
+    logger.info(
+        "Queued %d sub mappings in %d remap messages for %s",
+        mappings_queued, messages_queued, checkpoint_key
+    )
+    return mappings_queued, messages_queued
+
+class RemapWorker:
+    """
+    Consumes remap work messages, several at a time.
+
+    A message holds a small slice of a restore's mappings, so scanning the
+    table for each message would read all of it once per message; the
+    worker's 'scan' and 'auto' remaps query per user instead. The mode is
+    passed with every call, so the DynamoDBUpdate given is not changed.
+    """
+
+    def __init__(self, dynamodb_update: DynamoDBUpdate, max_workers: int = 4,
+                 time_budget: Optional[TimeBudget] = None):
+        self.remap_mode = dynamodb_update.remap_mode
+        if self.remap_mode in ('scan', 'auto'):
+            if self.remap_mode == 'scan':
+                logger.info("Remap worker messages are remapped by query, not by scan")
+            self.remap_mode = 'query'
+        self.dynamodb_update = dynamodb_update
+        self.max_workers = max_workers
+        self.time_budget = time_budget or TimeBudget()
+
+    def process_records(self, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Process the records of an SQS-triggered invocation.
+
+        Args:
+            records: Records of the SQS event
+
+        Returns:
+            Dict with the batchItemFailures to report to Lambda (messages SQS
+            should deliver again) and the remap statistics
+        """
+        results = self._process_bodies([record['body'] for record in records])
+        stats = self._summarize(results)
+        stats['batchItemFailures'] = [
+            {'itemIdentifier': record['messageId']}
+            for record, (ok, _) in zip(records, results) if not ok
+        ]
+        return stats
+
+    def drain(self, queue) -> Dict[str, Any]:
+        """
+        Process queued messages until the queue is empty or the budget runs out.
+
+        Failed messages are released for another attempt and are not taken
+        again by the same drain.
+
+        Args:
+            queue: LocalRemapQueue or SQSRemapQueue
+
+        Returns:
+            Dict with the remap statistics and whether the queue was drained
+        """
+        results = []
+        failed_ids = set()
+        drained = False
+        while not self.time_budget.exhausted():
+            messages = queue.receive(QUEUE_BATCH_SIZE)
+            if not messages:
+                drained = True
+                break
+            fresh = [message for message in messages if message['message_id'] not in failed_ids]
+            for message in messages:
+                if message['message_id'] in failed_ids:
+                    queue.release(message)
+            if not fresh:
+                break
+
+            batch_results = self._process_bodies([message['body'] for message in fresh])
+            for message, (ok, _) in zip(fresh, batch_results):
+                if ok:
+                    queue.delete(message)
+                else:
+                    failed_ids.add(message['message_id'])
+                    queue.release(message)
+            results.extend(batch_results)
+
+        stats = self._summarize(results)
+        stats['queue_drained'] = drained
+        return stats
+
+    def _process_bodies(self, bodies: List[str]) -> List[Tuple[bool, Optional[Dict[str, Any]]]]:
+        """Process message bodies concurrently, keeping their order."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self._process_body, bodies))
+
+    def _process_body(self, body: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """
+        Remap the mappings of one message.
+
+        Args:
+            body: Message body
+
+        Returns:
+            Tuple of (whether the message is done, remap statistics or None)
+        """
+        try:
+            message = json.loads(body)
+            mappings = message['mappings']
+            stats = self.dynamodb_update.update_dynamodb_sub(
+                mappings, self.time_budget, remap_mode=self.remap_mode
+            )
+        except (ClientError, ValueError, KeyError, TypeError) as exc:
+            logger.error("Remap message could not be processed: %s", exc)
+            return False, None
+
+        ok = stats['mappings_processed'] == len(mappings) and not stats['failed_updates']
+        if not ok:
+            logger.warning(
+                "Remap message of %s at mapping %d left for another attempt",
+                message.get('checkpoint_key'), message.get('first_mapping', 0)
+            )
+        return ok, stats
+
+    @staticmethod
+    def _summarize(results: List[Tuple[bool, Optional[Dict[str, Any]]]]) -> Dict[str, Any]:
+        """Add up the statistics of processed messages."""
+        summary: Dict[str, Any] = {
+            'messages_processed': sum(1 for ok, _ in results if ok),
+            'messages_failed': sum(1 for ok, _ in results if not ok),
+            'failed_updates': []
+        }
+        for field in SUMMED_STATS:
+            summary[field] = sum(stats.get(field, 0) for _, stats in results if stats)
+        for _, stats in results:
+            if stats:
+                summary['failed_updates'].extend(stats['failed_updates'])
+        return summary
@@ -1,67 +1,647 @@
 """Restore module for AWS Cognito User Pool operations."""
 
-import json
-from typing import Dict, Any, List
+import itertools
+import posixpath
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional
 from botocore.exceptions import ClientError
 from .aws_clients import AWSClients
-from .config import logger
+from .backup_format import is_manifest_key, iter_backup_users, load_manifest
+from .checkpoint import RestoreCheckpoint
+from .concurrency import AIMDController
+from .config import DEFAULT_COGNITO_RPS_LIMITS, DEFAULT_WRITE_CAPACITY_FRACTION, logger
 from .dynamodb_update import DynamoDBUpdate
+from .remap_queue import DEFAULT_REMAP_CHUNK_SIZE, publish_remap_work
+from .sub_mapping_artifact import artifact_prefix, write_sub_mapping_artifact
+from .sub_mapping_store import SubMappingStore
+from .legacy_format import load_legacy_backup
+from .rate_limit import TokenBucket
+from .time_budget import TimeBudget
+from .user_import import CognitoUserImport, FINISHED_JOB_STATUSES, write_import_csvs
+from .user_index import TargetUserIndex, DEFAULT_SPILL_THRESHOLD
+
+# Users in flight per worker thread; each batch completes before the next starts
+RESTORE_BATCH_FACTOR = 16
+
+def membership_key(group_name: str, username: str) -> str:
+    """Key of a group membership in a membership index (usernames hold no whitespace)."""
+    return f'{group_name}\n{username}'
+
+def _import_job_entry(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Ledger entry of a user import job from its description."""
+    return {
+        'job_id': job['JobId'],
+        'status': job['Status'],
+        'imported_users': job.get('ImportedUsers', 0),
+        'skipped_users': job.get('SkippedUsers', 0),
+        'failed_users': job.get('FailedUsers', 0)
+    }
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Yield successive lists of up to size items from any iterable."""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+class _RestoreStats:
+    """
+    Thread-safe restore statistics shared by the restore workers.
+
+    Only the sub mappings not yet saved to the checkpoint ledger are kept;
+    saved ones are read back into a SubMappingStore for the remap.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.users_restored = 0
+        self.existing_users = 0
+        self.memberships_restored = 0
+        self.failed_users: List[str] = []
+        self.sub_mappings: List[Dict[str, str]] = []
+
+    def add_user(self, memberships: int, existing: bool = False) -> None:
+        """Record a restored user and the group memberships restored for it."""
+        with self._lock:
+            self.users_restored += 1
+            self.existing_users += int(existing)
+            self.memberships_restored += memberships
+
+    def add_failure(self, username: str) -> None:
+        """Record a user that could not be restored."""
+        with self._lock:
+            self.failed_users.append(username)
+
+    def add_mapping(self, username: str, old_sub: str, new_sub: str) -> None:
+        """Record the old -> new sub mapping of a restored user."""
+        with self._lock:
+            self.sub_mappings.append({
+                'username': username,
+                'old_sub': old_sub,
+                'new_sub': new_sub
+            })
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint: RestoreCheckpoint) -> '_RestoreStats':
+        """Seed statistics with the progress recorded by earlier invocations."""
+        stats = cls()
+        stats.users_restored = checkpoint.state['users_restored']
+        stats.existing_users = checkpoint.state['existing_users']
+        stats.memberships_restored = checkpoint.state['memberships_restored']
+        stats.failed_users = list(checkpoint.state['failed_users'])
+        return stats
+
+    def progress(self) -> Dict[str, Any]:
+        """Return the counters and hand over the sub mappings added since the last call."""
+        with self._lock:
+            new_sub_mappings, self.sub_mappings = self.sub_mappings, []
+            return {
+                'users_restored': self.users_restored,
+                'existing_users': self.existing_users,
+                'memberships_restored': self.memberships_restored,
+                'failed_users': list(self.failed_users),
+                'new_sub_mappings': new_sub_mappings
+            }
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the statistics in the shape returned by _restore_users."""
+        with self._lock:
+            return {
+                'users_restored': self.users_restored,
+                'existing_users': self.existing_users,
+                'memberships_restored': self.memberships_restored,
+                'failed_users': list(self.failed_users),
+                'sub_mappings': list(self.sub_mappings)
+            }
 
 class CognitoRestore:
     """Handles restore operations for AWS Cognito User Pools."""
 
-    def __init__(self, aws_clients: AWSClients):
+    def __init__(self, aws_clients: AWSClients, max_workers: int = 8,
+                 rps_limits: Optional[Dict[str, float]] = None,
+                 prescan_spill_threshold: int = DEFAULT_SPILL_THRESHOLD,
+                 import_role_arn: Optional[str] = None, import_min_users: int = 10000,
+                 import_poll_interval: float = 5.0,
+                 time_budget: Optional[TimeBudget] = None, remap_mode: str = 'auto',
+                 remap_write_mode: str = 'transaction',
+                 remap_capacity_fraction: float = DEFAULT_WRITE_CAPACITY_FRACTION,
+                 remap_capacity_units: Optional[float] = None,
+                 remap_queue=None, remap_chunk_size: int = DEFAULT_REMAP_CHUNK_SIZE,
+                 remap_probe_profile: bool = False):
         self.aws_clients = aws_clients
-        self.dynamodb_update = DynamoDBUpdate(aws_clients)
+        self.time_budget = time_budget or TimeBudget()
+        self.prescan_spill_threshold = prescan_spill_threshold
+        self.import_role_arn = import_role_arn
+        self.import_min_users = import_min_users
+        self.import_poll_interval = import_poll_interval
+        self.dynamodb_update = DynamoDBUpdate(
+            aws_clients, max_workers=max_workers,
+            remap_mode=remap_mode, write_mode=remap_write_mode,
+            write_capacity_fraction=remap_capacity_fraction,
+            write_capacity_units=remap_capacity_units,
+            probe_profile=remap_probe_profile
+        )
+        self.remap_queue = remap_queue
+        self.remap_chunk_size = remap_chunk_size
+        self.max_workers = max_workers
+        self.concurrency = AIMDController(
+            max_limit=max_workers, initial_limit=max(1, max_workers // 2)
+        )
+        self._rate_limiters = {
+            operation: TokenBucket(rps)
+            for operation, rps in (rps_limits or DEFAULT_COGNITO_RPS_LIMITS).items()
+        }
 
-    def restore_user_pool(self, backup_key: str, target_user_pool_id: str = None) -> Dict[str, Any]:
+    def restore_user_pool(self, backup_key: str, target_user_pool_id: str = None,
+                          prescan: bool = False, restore_mode: str = 'per_user',
+                          checkpoint: Optional[RestoreCheckpoint] = None) -> Dict[str, Any]:
         """
         Restore Cognito User Pool from a backup in S3.
+
+        Progress is recorded in a checkpoint ledger after every batch of users
+        and every slice of DynamoDB remapping. Once the time budget runs out the
+        restore stops at the next checkpoint and returns an 'in_progress'
+        result; resume_user_pool continues it without redoing finished work.
+        With a remap_queue the sub mappings are published as work messages
+        for a RemapWorker instead of being remapped before returning. Once
+        every user is restored the sub mappings are also published next to the
+        backup for other services (see sub_mapping_artifact).
         
         Args:
-            backup_key: S3 key of the backup file
+            backup_key: S3 key of the backup file (v1) or backup manifest (v2)
             target_user_pool_id: The ID of the target user pool for restoration
+            prescan: Whether to index the target pool's existing users first, so
+                users that already exist are resolved without any API calls
+            restore_mode: 'per_user' to create users with admin_create_user,
+                'import' to use Cognito user import jobs, or 'auto' to import
+                backups of at least import_min_users users
+            checkpoint: Ledger of an earlier invocation to continue from
             
         Returns:
             Dict containing restoration status and statistics
         """
+        existing_users = None
+        existing_memberships = None
         try:
-            response = self.aws_clients.s3_client.get_object(
-                Bucket=self.aws_clients.bucket_name,
-                Key=backup_key
-            )
-            backup_data = json.loads(response['Body'].read())
-
             user_pool_id = self._get_user_pool(target_user_pool_id)
-            restored_groups = self._restore_groups(backup_data['groups'], user_pool_id)
-            restore_stats = self._restore_users(backup_data['users'], user_pool_id)
+            backup_data = None
+            if checkpoint is None or not checkpoint.state['users_complete']:
+                backup_data = self._load_backup(backup_key)
+            if checkpoint is None:
+                checkpoint = RestoreCheckpoint.create(
+                    self.aws_clients.s3_client, self.aws_clients.bucket_name,
+                    backup_key, backup_data['timestamp'], user_pool_id,
+                    {'prescan': prescan, 'restore_mode': restore_mode}
+                )
+            if checkpoint.state['groups_restored'] is None:
+                checkpoint.record_groups(
+                    self._restore_groups(backup_data['groups'], user_pool_id)
+                )
 
-            dynamodb_stats = {
-                'records_updated': 0, 'failed_updates': [], 'skipped_updates': 0
-            }
-            if self.aws_clients.dynamodb_table:
-                dynamodb_stats = self.dynamodb_update.update_dynamodb_sub(
-                    restore_stats['sub_mappings']
+            if not checkpoint.state['users_complete']:
+                if not checkpoint.import_jobs_created:
+                    if (checkpoint.state['import_jobs'] is not None
+                            or self._use_import_jobs(restore_mode, backup_data)):
+                        with tempfile.TemporaryDirectory() as work_dir:
+                            created = self._create_import_jobs(
+                                backup_data['users'], user_pool_id, work_dir, checkpoint
+                            )
+                        if not created:
+                            return self._in_progress(checkpoint, 'import')
+                        # Writing the CSVs consumed the users; replay them from the start
+                        backup_data = self._load_backup(backup_key)
+                    checkpoint.record_import_jobs_created()
+                if not self._run_import_jobs(checkpoint, user_pool_id):
+                    return self._in_progress(checkpoint, 'import')
+
+                # Users created by import jobs already exist in the target pool
+                if prescan or checkpoint.state['import_jobs']:
+                    existing_users = self._target_index(
+                        checkpoint, 'users', lambda: self._scan_target_users(user_pool_id)
+                    )
+                if checkpoint.state['import_jobs']:
+                    existing_memberships = self._target_index(
+                        checkpoint, 'memberships', lambda: self._scan_group_members(
+                            user_pool_id, [group['GroupName'] for group in backup_data['groups']]
+                        )
+                    )
+                restore_stats = self._restore_users(
+                    itertools.islice(backup_data['users'], checkpoint.users_processed, None),
+                    user_pool_id, existing_users, checkpoint, existing_memberships
                 )
-            else:
+                if not restore_stats['complete']:
+                    return self._in_progress(checkpoint, 'users')
+                checkpoint.record_users_complete()
+
+            remap = checkpoint.state['remap']
+            done_field = 'mappings_queued' if self.remap_queue else 'mappings_processed'
+            remap_pending = bool(self.aws_clients.dynamodb_table) and (
+                remap[done_field] < checkpoint.mappings_saved
+            )
+            if not self.aws_clients.dynamodb_table:
                 logger.warning("DYNAMODB_TABLE_NAME not set, skipping DynamoDB updates")
+            if checkpoint.state.get('mapping_artifact') is None or remap_pending:
+                # The store's order (by old sub) is the same in every
+                # invocation, so remap progress can be kept as a position
+                with tempfile.TemporaryDirectory() as work_dir:
+                    sub_mappings = SubMappingStore.build(checkpoint.iter_mappings(), work_dir)
+                    try:
+                        if checkpoint.state.get('mapping_artifact') is None:
+                            checkpoint.record_mapping_artifact(
+                                self._publish_mappings(checkpoint, sub_mappings)
+                            )
+                        if remap_pending:
+                            self._remap(checkpoint, sub_mappings)
+                    finally:
+                        sub_mappings.close()
+            if remap_pending and remap[done_field] < checkpoint.mappings_saved:
+                return self._in_progress(checkpoint, 'remap')
 
+            state = checkpoint.state
+            import_jobs = state['import_jobs'] or []
+            users_imported = sum(job['imported_users'] for job in import_jobs)
             logger.info("Restore completed for user pool %s", user_pool_id)
-            return {
+            result = {
                 'status': 'success',
                 'user_pool_id': user_pool_id,
-                'users_restored': restore_stats['users_restored'],
-                'groups_restored': restored_groups,
-                'user_group_memberships_restored': restore_stats['memberships_restored'],
-                'failed_users': restore_stats['failed_users'],
-                'dynamodb_records_updated': dynamodb_stats['records_updated'],
-                'dynamodb_failed_updates': dynamodb_stats['failed_updates'],
-                'backup_timestamp': backup_data['timestamp']
+                'users_restored': state['users_restored'],
+                'groups_restored': state['groups_restored'],
+                'user_group_memberships_restored': state['memberships_restored'],
+                'failed_users': state['failed_users'],
+                'existing_users': max(0, state['existing_users'] - users_imported),
+                'users_imported': users_imported,
+                'import_jobs': import_jobs,
+                'dynamodb_records_updated': remap['records_updated'],
+                'dynamodb_records_already_migrated': remap['already_migrated'],
+                'dynamodb_users_already_migrated': remap['users_already_migrated'],
+                'dynamodb_users_without_records': remap['users_without_records'],
+                'dynamodb_failed_updates': remap['failed_updates'],
+                'dynamodb_aliases_written': remap['aliases_written'],
+                'dynamodb_remap_queued': remap['mappings_queued'],
+                'dynamodb_remap_messages': remap['messages_queued'],
+                'dynamodb_records_per_second': round(
+                    remap['records_updated'] / remap['elapsed_seconds'], 1
+                ) if remap['elapsed_seconds'] else 0.0,
+                'sub_mapping_artifact': (
+                    f"s3://{self.aws_clients.bucket_name}/{state['mapping_artifact']}"
+                ),
+                'backup_timestamp': state['backup_timestamp'],
+                'checkpoint_key': checkpoint.key,
+                'invocations': state['invocations'],
+                'concurrency': self.concurrency.stats()
             }
+            checkpoint.finish(result)
+            return result
 
         except (ClientError, ValueError) as exc:
             logger.error("Restore failed: %s", str(exc))
             raise
+        finally:
+            for index in (existing_users, existing_memberships):
+                if index is not None:
+                    index.close()
+
+    def _publish_mappings(self, checkpoint: RestoreCheckpoint,
+                          sub_mappings: SubMappingStore) -> str:
+        """
+        Publish the restore's sub mappings as an artifact next to the backup.
+
+        Args:
+            checkpoint: Ledger of the restore
+            sub_mappings: Every sub mapping of the restore
+
+        Returns:
+            S3 key of the artifact's index
+        """
+        state = checkpoint.state
+        restore_id = posixpath.basename(posixpath.dirname(checkpoint.key))
+        return write_sub_mapping_artifact(
+            self.aws_clients.s3_client, self.aws_clients.bucket_name,
+            artifact_prefix(state['backup_key'], state['target_user_pool_id'], restore_id),
+            sub_mappings,
+            {
+                'backup_key': state['backup_key'],
+                'backup_timestamp': state['backup_timestamp'],
+                'target_user_pool_id': state['target_user_pool_id'],
+                'checkpoint_key': checkpoint.key
+            }
+        )
+
+    def _remap(self, checkpoint: RestoreCheckpoint, sub_mappings: SubMappingStore) -> None:
+        """
+        Remap (or queue) the next slice of sub mappings and record it in the ledger.
+
+        Args:
+            checkpoint: Ledger of the restore
+            sub_mappings: Every sub mapping of the restore
+        """
+        remap = checkpoint.state['remap']
+        if self.remap_queue is not None:
+            checkpoint.record_remap_queued(*publish_remap_work(
+                self.remap_queue, sub_mappings[remap['mappings_queued']:],
+                checkpoint.key, remap['mappings_queued'],
+                self.remap_chunk_size, self.time_budget
+            ))
+        else:
+            checkpoint.record_remap(self.dynamodb_update.update_dynamodb_sub(
+                sub_mappings[remap['mappings_processed']:], self.time_budget,
+                remap.get('scan_position')
+            ))
+
+    def _in_progress(self, checkpoint: RestoreCheckpoint, phase: str) -> Dict[str, Any]:
+        """
+        Build the result of a restore stopped by its time budget.
+        
+        Args:
+            checkpoint: Ledger of the restore
+            phase: 'import', 'users' or 'remap', the phase the restore stopped in
+            
+        Returns:
+            Dict with the checkpoint to resume from and the progress so far
+        """
+        state = checkpoint.state
+        logger.info(
+            "Restore paused in the %s phase after %d users, resume from %s",
+            phase, state['users_processed'], checkpoint.key
+        )
+        return {
+            'status': 'in_progress',
+            'phase': phase,
+            'user_pool_id': state['target_user_pool_id'],
+            'checkpoint_key': checkpoint.key,
+            'users_processed': state['users_processed'],
+            'mappings_remapped': state['remap']['mappings_processed'],
+            'invocations': state['invocations'],
+            'concurrency': self.concurrency.stats()
+        }
+
+    def resume_user_pool(self, checkpoint: RestoreCheckpoint) -> Dict[str, Any]:
+        """
+        Continue a restore from its checkpoint ledger.
+        
+        Args:
+            checkpoint: Ledger loaded with load_checkpoint
+            
+        Returns:
+            Dict containing restoration status and statistics; the recorded
+            result if the restore had already finished
+        """
+        if checkpoint.complete:
+            logger.info("Restore %s already finished", checkpoint.key)
+            return checkpoint.result
+
+        checkpoint.start_invocation()
+        options = checkpoint.state['options']
+        return self.restore_user_pool(
+            checkpoint.state['backup_key'],
+            checkpoint.state['target_user_pool_id'],
+            prescan=options.get('prescan', False),
+            restore_mode=options.get('restore_mode', 'per_user'),
+            checkpoint=checkpoint
+        )
+
+    def _use_import_jobs(self, restore_mode: str, backup_data: Dict[str, Any]) -> bool:
+        """
+        Decide whether users should be restored through user import jobs.
+
+        A streamed backup without a user count has its first users buffered
+        (and put back into backup_data['users']) to compare against
+        import_min_users.
+        
+        Args:
+            restore_mode: 'per_user', 'import' or 'auto'
+            backup_data: Backup loaded by _load_backup
+            
+        Returns:
+            True to restore with import jobs
+        """
+        if restore_mode == 'per_user':
+            return False
+        if not self.import_role_arn:
+            logger.warning("IMPORT_ROLE_ARN not set, restoring users one by one")
+            return False
+        if restore_mode == 'import':
+            return True
+
+        users = backup_data['users']
+        if isinstance(users, list):
+            return len(users) >= self.import_min_users
+        if 'users_total' in backup_data:
+            return backup_data['users_total'] >= self.import_min_users
+
+        # Streamed v1 backups carry no count: buffer up to import_min_users users
+        users = iter(users)
+        head = list(itertools.islice(users, self.import_min_users))
+        backup_data['users'] = itertools.chain(head, users)
+        return len(head) >= self.import_min_users
+
+    def _create_import_jobs(self, users: Iterable[Dict[str, Any]], user_pool_id: str,
+                            work_dir: str, checkpoint: RestoreCheckpoint) -> bool:
+        """
+        Write users to import CSVs (split at Cognito's per-job limits) and create
+        a user import job for each, uploading its CSV.
+
+        Every created job is recorded in the ledger with the number of backup
+        users written so far, and the time budget is checked before each
+        further job is created, so a resume skips those users and continues
+        with the next job. The jobs are only started by _run_import_jobs. Once
+        they have finished, the backup is replayed through _restore_users
+        against a pre-scan of the target pool: imported users only get their
+        sub mapped and group memberships restored, and users the jobs did not
+        import (or all users, if import jobs are unavailable) are created one
+        by one. Imported users are not sent an invitation message.
+
+        Args:
+            users: User objects to restore (a list or a stream), from the start
+                of the backup
+            user_pool_id: Target user pool ID
+            work_dir: Directory for the CSV files
+            checkpoint: Ledger recording the created jobs, in the order to run them
+
+        Returns:
+            True once no further jobs are to be created, False if the time
+            budget ran out first
+        """
+        importer = self._importer()
+        try:
+            header = importer.get_csv_header(user_pool_id)
+        except ClientError as exc:
+            logger.warning("User import jobs unavailable, restoring users one by one: %s", exc)
+            return True
+
+        users_written = checkpoint.state.get('import_users_written', 0)
+        first_job = len(checkpoint.state['import_jobs'] or [])
+        timestamp = datetime.now(UTC).strftime('%Y%m%d%H%M%S')
+        csv_files = write_import_csvs(
+            header, itertools.islice(users, users_written, None), work_dir
+        )
+        for job_number, (csv_path, rows) in enumerate(csv_files, start=first_job):
+            # At least one job is created per invocation
+            if job_number > first_job and self.time_budget.exhausted():
+                csv_files.close()
+                return False
+            try:
+                job = importer.create_job(
+                    user_pool_id, f'restore-{timestamp}-{job_number:03d}', csv_path
+                )
+            except (ClientError, OSError) as exc:
+                logger.warning(
+                    "User import job %d could not be created, remaining users will be "
+                    "restored one by one: %s", job_number, exc
+                )
+                break
+            users_written += rows
+            checkpoint.record_import_job(_import_job_entry(job), users_written)
+        return True
+
+    def _run_import_jobs(self, checkpoint: RestoreCheckpoint, user_pool_id: str) -> bool:
+        """
+        Start the recorded user import jobs one at a time and wait for them,
+        recording every status change in the ledger.
+
+        A job that cannot be started or described is recorded as failed; its
+        users are restored one by one.
+
+        Args:
+            checkpoint: Ledger holding the jobs created by _create_import_jobs
+            user_pool_id: Target user pool ID
+
+        Returns:
+            True once every job has finished, False if the time budget ran out
+            while a job was still running
+        """
+        importer = self._importer()
+        import_jobs = checkpoint.state['import_jobs']
+        for entry in import_jobs:
+            if entry['status'] in FINISHED_JOB_STATUSES:
+                continue
+            try:
+                if entry['status'] == 'Created':
+                    importer.start_job(user_pool_id, entry['job_id'])
+                    entry['status'] = 'Pending'
+                    checkpoint.record_import_jobs(import_jobs)
+                job = importer.wait_for_job(user_pool_id, entry['job_id'], self.time_budget)
+            except ClientError as exc:
+                logger.warning(
+                    "User import job %s failed, its users will be restored one by one: %s",
+                    entry['job_id'], exc
+                )
+                job = {'JobId': entry['job_id'], 'Status': 'Failed'}
+            if job is None:
+                return False
+            entry.update(_import_job_entry(job))
+            checkpoint.record_import_jobs(import_jobs)
+        return True
+
+    def _importer(self) -> CognitoUserImport:
+        """Return a CognitoUserImport calling Cognito through _call_cognito."""
+        return CognitoUserImport(
+            self._call_cognito, self.import_role_arn, poll_interval=self.import_poll_interval
+        )
+
+    def _scan_group_members(self, user_pool_id: str, group_names: List[str]) -> TargetUserIndex:
+        """
+        Index the group memberships that already exist in the target user pool.
+
+        Cognito has no batch membership API, so the memberships are listed in
+        pages per group and only the missing ones are added user by user.
+
+        Args:
+            user_pool_id: Target user pool ID
+            group_names: Groups of the backup
+
+        Returns:
+            Index keyed by membership_key(group, username)
+        """
+        def membership_pages() -> Iterator[Dict[str, Any]]:
+            for group_name in group_names:
+                for page in self._paginate_cognito(
+                        'list_users_in_group', UserPoolId=user_pool_id, GroupName=group_name):
+                    yield {'Users': [
+                        {**user, 'Username': membership_key(group_name, user['Username'])}
+                        for user in page['Users']
+                    ]}
+
+        return TargetUserIndex.build(
+            membership_pages(), spill_threshold=self.prescan_spill_threshold
+        )
+
+    def _target_index(self, checkpoint: RestoreCheckpoint, name: str,
+                      scan: Callable[[], TargetUserIndex]) -> TargetUserIndex:
+        """
+        Scan an index of the target pool once and save it next to the ledger,
+        so resumed invocations load it instead of scanning the pool again.
+
+        A saved index misses users created after the scan; the users still to
+        restore that exist anyway are resolved when creating them fails.
+
+        Args:
+            checkpoint: Ledger of the restore
+            name: 'users' or 'memberships'
+            scan: Builds the index from the target pool
+
+        Returns:
+            The index
+        """
+        s3_client = self.aws_clients.s3_client
+        bucket = self.aws_clients.bucket_name
+        index_key = checkpoint.state.get('target_indexes', {}).get(name)
+        if index_key is not None:
+            return TargetUserIndex.load(
+                s3_client, bucket, index_key, spill_threshold=self.prescan_spill_threshold
+            )
+        index = scan()
+        index_key = f'{posixpath.dirname(checkpoint.key)}/target-{name}.ndjson'
+        index.save(s3_client, bucket, index_key)
+        checkpoint.record_target_index(name, index_key)
+        return index
+
+    def _scan_target_users(self, user_pool_id: str) -> TargetUserIndex:
+        """
+        Index the users that already exist in the target user pool.
+        
+        Args:
+            user_pool_id: Target user pool ID
+            
+        Returns:
+            Username -> sub index of the target pool
+        """
+        return TargetUserIndex.build(
+            self._paginate_cognito(
+                'list_users', token_key='PaginationToken',
+                UserPoolId=user_pool_id, AttributesToGet=['sub']
+            ),
+            spill_threshold=self.prescan_spill_threshold
+        )
+
+    def _load_backup(self, backup_key: str) -> Dict[str, Any]:
+        """
+        Load a backup in either layout.
+
+        Legacy (v1) backups are parsed incrementally from the S3 body and 'users'
+        is a generator over the document's users array. For sharded (v2) backups
+        the manifest is loaded and 'users' is a generator that streams the
+        shards. Either way users are never all held in memory at once.
+        
+        Args:
+            backup_key: S3 key of the backup file (v1) or backup manifest (v2)
+            
+        Returns:
+            Dict with at least 'timestamp', 'groups' and an iterable of 'users'
+        """
+        bucket = self.aws_clients.bucket_name
+        if is_manifest_key(backup_key):
+            manifest = load_manifest(self.aws_clients.s3_client, bucket, backup_key)
+            return {
+                **manifest,
+                'users': iter_backup_users(
+                    self.aws_clients.s3_client, bucket, manifest, backup_key
+                )
+            }
+
+        return load_legacy_backup(self.aws_clients.s3_client, bucket, backup_key)
 
     def _get_user_pool(self, target_user_pool_id: str = None) -> str:
         """
@@ -80,9 +660,7 @@ class CognitoRestore:
             raise ValueError("target_user_pool_id is required for restoration")
 
         try:
-            self.aws_clients.cognito_client.describe_user_pool(
-                UserPoolId=target_user_pool_id
-            )
+            self._call_cognito('describe_user_pool', UserPoolId=target_user_pool_id)
             logger.info("Using existing user pool: %s", target_user_pool_id)
             return target_user_pool_id
         except ClientError as exc:
@@ -118,7 +696,7 @@ class CognitoRestore:
                 if 'Precedence' in group:
                     group_config['Precedence'] = group['Precedence']
 
-                self.aws_clients.cognito_client.create_group(**group_config)
+                self._call_cognito('create_group', **group_config)
                 restored_groups += 1
                 logger.info("Restored group: %s", group['GroupName'])
 
@@ -131,107 +709,209 @@ class CognitoRestore:
 
         return restored_groups
 
-    def _restore_users(self, users: List[Dict[str, Any]], user_pool_id: str) -> Dict[str, Any]:
+    def _restore_users(self, users: Iterable[Dict[str, Any]], user_pool_id: str,
+                       existing_users: Optional[TargetUserIndex] = None,
+                       checkpoint: Optional[RestoreCheckpoint] = None,
+                       existing_memberships: Optional[TargetUserIndex] = None
+                       ) -> Dict[str, Any]:
         """
         Restore users to the user pool with their group memberships and track sub mappings.
+
+        Users are restored concurrently by a pool of max_workers threads, in
+        batches so that only a bounded number of users is in flight at a time;
+        every Cognito call is paced by its per-operation rate limit.
         
         Args:
-            users: List of user objects to restore
+            users: User objects to restore (a list or a stream)
             user_pool_id: Target user pool ID
+            existing_users: Pre-scanned index of the users already in the target pool
+            checkpoint: Ledger to record each finished batch in; its earlier
+                progress is included in the returned statistics. With a ledger,
+                restoring stops after the batch that exhausts the time budget
+            existing_memberships: Index of the group memberships already in
+                the target pool, skipped for existing users
             
         Returns:
-            Dict containing restoration statistics and sub mappings
+            Dict containing restoration statistics, the sub mappings not
+            recorded in the ledger and whether every user was processed
+            ('complete')
         """
-        restored_users = 0
-        restored_memberships = 0
-        failed_users = []
-        sub_mappings = []
+        stats = _RestoreStats.from_checkpoint(checkpoint) if checkpoint else _RestoreStats()
+        complete = True
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch in _batched(users, self.max_workers * RESTORE_BATCH_FACTOR):
+                for _ in executor.map(
+                        lambda user: self._restore_user(
+                            user, user_pool_id, stats, existing_users, existing_memberships
+                        ),
+                        batch):
+                    pass
+                if checkpoint is not None:
+                    checkpoint.record_progress(len(batch), stats.progress())
+                    if self.time_budget.exhausted():
+                        complete = False
+                        break
 
-        for user in users:
-            try:
-                username = user['Username']
-                user_groups = user.get('Groups', [])
-                old_sub = next(
-                    (attr['Value'] for attr in user.get('Attributes', [])
-                     if attr['Name'] == 'sub'), None
-                )
+        return {**stats.as_dict(), 'complete': complete}
 
-                user_attributes = [
-                    {'Name': attr['Name'], 'Value': attr['Value']}
-                    for attr in user.get('Attributes', [])
-                    if attr['Name'] not in ['sub']
-                ]
+    def _restore_user(self, user: Dict[str, Any], user_pool_id: str,
+                      stats: '_RestoreStats',
+                      existing_users: Optional[TargetUserIndex] = None,
+                      existing_memberships: Optional[TargetUserIndex] = None) -> None:
+        """
+        Restore a single user with its group memberships, recording the outcome.
+        
+        Args:
+            user: User object to restore
+            user_pool_id: Target user pool ID
+            stats: Shared statistics of the running restore
+            existing_users: Pre-scanned index of the users already in the target pool
+            existing_memberships: Index of the group memberships already in the target pool
+        """
+        username = user.get('Username')
+        try:
+            username = user['Username']
+            user_groups = user.get('Groups', [])
+            old_sub = next(
+                (attr['Value'] for attr in user.get('Attributes', [])
+                 if attr['Name'] == 'sub'), None
+            )
 
-                response = self.aws_clients.cognito_client.admin_create_user(
-                    UserPoolId=user_pool_id,
-                    Username=username,
-                    UserAttributes=user_attributes,
-                    DesiredDeliveryMediums=['EMAIL']
+            existing_sub = existing_users.get(username) if existing_users is not None else None
+            if existing_sub is not None:
+                self._restore_existing_user(
+                    user_pool_id, username, old_sub, existing_sub, user_groups, stats,
+                    existing_memberships
                 )
+                return
 
-                new_sub = next(
-                    (attr['Value'] for attr in response['User']['Attributes']
-                     if attr['Name'] == 'sub'), None
-                )
+            user_attributes = [
+                {'Name': attr['Name'], 'Value': attr['Value']}
+                for attr in user.get('Attributes', [])
+                if attr['Name'] not in ['sub']
+            ]
 
-                if old_sub and new_sub:
-                    sub_mappings.append({
-                        'username': username,
-                        'old_sub': old_sub,
-                        'new_sub': new_sub
-                    })
-                    logger.info(
-                        "Mapped old sub %s to new sub %s for user %s",
-                        old_sub, new_sub, username
-                    )
+            response = self._call_cognito(
+                'admin_create_user',
+                UserPoolId=user_pool_id,
+                Username=username,
+                UserAttributes=user_attributes,
+                DesiredDeliveryMediums=['EMAIL']
+            )
 
-                restored_users += 1
-                logger.info("Restored user: %s", username)
-                restored_memberships += self._restore_user_group_memberships(
-                    user_pool_id, username, user_groups
+            new_sub = next(
+                (attr['Value'] for attr in response['User']['Attributes']
+                 if attr['Name'] == 'sub'), None
+            )
+
+            if old_sub and new_sub:
+                stats.add_mapping(username, old_sub, new_sub)
+                logger.info(
+                    "Mapped old sub %s to new sub %s for user %s",
+                    old_sub, new_sub, username
                 )
 
-            except ClientError as exc:
-                if 'UsernameExistsException' in str(exc):
-                    logger.info("User %s already exists, skipping user creation", username)
-                    restored_users += 1
+            logger.info("Restored user: %s", username)
+            stats.add_user(self._restore_user_group_memberships(
+                user_pool_id, username, user_groups
+            ))
 
-                    try:
-                        user_response = self.aws_clients.cognito_client.admin_get_user(
-                            UserPoolId=user_pool_id,
-                            Username=username
-                        )
-                        new_sub = next(
-                            (attr['Value'] for attr in user_response['UserAttributes']
-                             if attr['Name'] == 'sub'), None
-                        )
-                        if old_sub and new_sub:
-                            sub_mappings.append({
-                                'username': username,
-                                'old_sub': old_sub,
-                                'new_sub': new_sub
-                            })
-                            logger.info(
-                                "Mapped old sub %s to new sub %s for existing user %s",
-                                old_sub, new_sub, username
-                            )
+        except ClientError as exc:
+            if 'UsernameExistsException' in str(exc):
+                try:
+                    user_response = self._call_cognito(
+                        'admin_get_user',
+                        UserPoolId=user_pool_id,
+                        Username=username
+                    )
+                    new_sub = next(
+                        (attr['Value'] for attr in user_response['UserAttributes']
+                         if attr['Name'] == 'sub'), None
+                    )
+                    self._restore_existing_user(
+                        user_pool_id, username, old_sub, new_sub, user_groups, stats
+                    )
+                except ClientError as e:
+                    logger.warning("Failed to get user %s details: %s", username, e)
+                    stats.add_failure(username)
+            else:
+                logger.warning("Failed to restore user %s: %s", username, exc)
+                stats.add_failure(username)
 
-                        restored_memberships += self._restore_user_group_memberships(
-                            user_pool_id, username, user_groups
-                        )
-                    except ClientError as e:
-                        logger.warning("Failed to get user %s details: %s", username, e)
-                        failed_users.append(username)
-                else:
-                    logger.warning("Failed to restore user %s: %s", username, exc)
-                    failed_users.append(username)
+    def _restore_existing_user(self, user_pool_id: str, username: str,
+                               old_sub: Optional[str], new_sub: Optional[str],
+                               user_groups: List[str], stats: '_RestoreStats',
+                               existing_memberships: Optional[TargetUserIndex] = None) -> None:
+        """
+        Record a user that already exists in the target pool and restore its
+        group memberships.
+        
+        Args:
+            user_pool_id: Target user pool ID
+            username: Username of the existing user
+            old_sub: Sub of the user in the backup
+            new_sub: Sub of the user in the target pool
+            user_groups: List of group names the user should belong to
+            stats: Shared statistics of the running restore
+            existing_memberships: Index of the group memberships already in the target pool
+        """
+        logger.info("User %s already exists, skipping user creation", username)
+        if old_sub and new_sub:
+            stats.add_mapping(username, old_sub, new_sub)
+            logger.info(
+                "Mapped old sub %s to new sub %s for existing user %s",
+                old_sub, new_sub, username
+            )
 
-        return {
-            'users_restored': restored_users,
-            'memberships_restored': restored_memberships,
-            'failed_users': failed_users,
-            'sub_mappings': sub_mappings
-        }
+        missing_groups = user_groups
+        if existing_memberships is not None:
+            missing_groups = [
+                group_name for group_name in user_groups
+                if existing_memberships.get(membership_key(group_name, username)) is None
+            ]
+        stats.add_user(
+            len(user_groups) - len(missing_groups)
+            + self._restore_user_group_memberships(user_pool_id, username, missing_groups),
+            existing=True
+        )
+
+    def _paginate_cognito(self, operation: str, token_key: str = 'NextToken',
+                          **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Page through a Cognito list API with _call_cognito.
+        
+        Args:
+            operation: Name of the cognito-idp client method
+            token_key: Name of the pagination token in requests and responses
+            **kwargs: Arguments for every call
+            
+        Yields:
+            API response pages
+        """
+        while True:
+            page = self._call_cognito(operation, **kwargs)
+            yield page
+            if not page.get(token_key):
+                return
+            kwargs[token_key] = page[token_key]
+
+    def _call_cognito(self, operation: str, **kwargs) -> Dict[str, Any]:
+        """
+        Call a Cognito API under the adaptive concurrency limit, pacing every
+        attempt by the operation's rate limit before it takes a call slot.
+        
+        Args:
+            operation: Name of the cognito-idp client method
+            **kwargs: Arguments for the call
+            
+        Returns:
+            The API response
+        """
+        limiter = self._rate_limiters.get(operation)
+        return self.concurrency.call_paced(
+            limiter.acquire if limiter is not None else None,
+            getattr(self.aws_clients.cognito_client, operation), **kwargs
+        )
 
     def _restore_user_group_memberships(self, user_pool_id: str, username: str,
                                         user_groups: List[str]) -> int:
@@ -249,7 +929,8 @@ class CognitoRestore:
         memberships_restored = 0
         for group_name in user_groups:
             try:
-                self.aws_clients.cognito_client.admin_add_user_to_group(
+                self._call_cognito(
+                    'admin_add_user_to_group',
                     UserPoolId=user_pool_id,
                     Username=username,
                     GroupName=group_name
@@ -261,4 +942,4 @@ class CognitoRestore:
                 logger.warning("Failed to add user %s to group %s: %s",
                                username, group_name, exc)
 
-        return memberships_restored
\ No newline at end of file
+        return memberships_restored
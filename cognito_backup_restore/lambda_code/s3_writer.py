@@ -0,0 +1,130 @@
+"""Streaming S3 writer module for Cognito backup/restore operations."""
+
+from typing import Any, Dict, List, Optional, Union
+from .config import logger
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+class S3MultipartWriter:
+    """
+    File-like writer that streams data to S3 in fixed-size multipart upload parts.
+
+    At most one part is held in memory at a time. Objects that never fill a single
+    part are written with a plain put_object when the writer is closed.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str,
+                 content_type: str = 'application/json',
+                 part_size: int = DEFAULT_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id: Optional[str] = None
+        self._parts: List[Dict[str, Any]] = []
+        self._closed = False
+
+    def __enter__(self) -> 'S3MultipartWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data: Union[str, bytes]) -> int:
+        """
+        Append data to the object, uploading a part whenever the buffer fills up.
+
+        Args:
+            data: Text (encoded as UTF-8) or bytes to append
+
+        Returns:
+            Number of bytes appended
+        """
+        if self._closed:
+            raise ValueError(f"Writer for s3://{self.bucket}/{self.key} is closed")
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def close(self) -> None:
+        """Flush the remaining buffer and complete the upload."""
+        if self._closed:
+            return
+
+        if self._upload_id is None:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self._buffer),
+                ContentType=self.content_type
+            )
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts}
+            )
+            logger.info(
+                "Completed multipart upload of s3://%s/%s (%d parts, %d bytes)",
+                self.bucket, self.key, len(self._parts), self.bytes_written
+            )
+        self._buffer = bytearray()
+        self._closed = True
+
+    def abort(self) -> None:
+        """Abort the upload so that no partial object or orphaned parts are left behind."""
+        if self._closed:
+            return
+
+        self._closed = True
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id
+                )
+                logger.warning("Aborted multipart upload of s3://%s/%s", self.bucket, self.key)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                logger.warning(
+                    "Could not abort multipart upload of s3://%s/%s: %s",
+                    self.bucket, self.key, exc
+                )
+
+    def _upload_part(self, body: bytes) -> None:
+        """Upload one part, starting the multipart upload on first use."""
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType=self.content_type
+            )
+            self._upload_id = response['UploadId']
+
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
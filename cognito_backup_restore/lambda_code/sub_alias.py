@@ -0,0 +1,227 @@
+"""Sub alias module for translating pre-restore user subs to restored ones.
+
+A restore in ``alias`` remap mode leaves every ``u#<old_sub>`` record where it
+is and writes one item per restored user instead::
+
+    PK = alias#<old_sub>, SK = alias, new_sub = <new_sub>, username = <username>
+
+Applications translate the subs they read with a SubAliasResolver, which
+follows alias chains (a user restored more than once) and keeps an LRU cache
+of answers. The records can be moved later by a query or scan remap.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, UTC
+from typing import Any, Dict, Iterable, Optional, Set
+from .config import logger
+
+ALIAS_PREFIX = 'alias#'
+ALIAS_SORT_KEY = 'alias'
+
+# Subs whose translation the resolver keeps
+DEFAULT_ALIAS_CACHE_SIZE = 10000
+
+# Alias links followed before giving up on a chain (guards against cycles)
+MAX_ALIAS_HOPS = 8
+
+# BatchGetItem accepts at most 100 keys
+ALIAS_BATCH_SIZE = 100
+
+# Retries of UnprocessedKeys (with exponential backoff from the base delay)
+# before a lookup gives up
+MAX_LOOKUP_RETRIES = 8
+LOOKUP_RETRY_BASE_DELAY = 0.05
+
+def alias_key(old_sub: str) -> Dict[str, Dict[str, str]]:
+    """
+    Key of the alias item of a sub.
+
+    Args:
+        old_sub: Sub of the user before the restore
+
+    Returns:
+        DynamoDB key of the alias item
+    """
+    return {'PK': {'S': f'{ALIAS_PREFIX}{old_sub}'}, 'SK': {'S': ALIAS_SORT_KEY}}
+
+def alias_item(mapping: Dict[str, str]) -> Dict[str, Dict[str, str]]:
+    """
+    Alias item recording a user's sub mapping.
+
+    Args:
+        mapping: Sub mapping containing old_sub, new_sub, and username
+
+    Returns:
+        DynamoDB item to put
+    """
+    return {
+        **alias_key(mapping['old_sub']),
+        'new_sub': {'S': mapping['new_sub']},
+        'username': {'S': mapping['username']},
+        'created_at': {'S': datetime.now(UTC).isoformat()}
+    }
+
+class _LRUCache:
+    """Thread-safe least-recently-used mapping with hit and miss counters."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached value (None on a miss), marking it recently used."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, value: str) -> None:
+        """Cache a value, evicting the least recently used entry when full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: Optional[str] = None) -> None:
+        """Drop one entry, or every entry when key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SubAliasResolver:
+    """
+    Translates user subs through the alias items written by alias-mode restores.
+
+    A sub without an alias item translates to itself. Answers, including
+    those for subs without an alias, are cached; call invalidate() after
+    another restore of the same users.
+    """
+
+    def __init__(self, dynamodb_client, table_name: str,
+                 cache_size: int = DEFAULT_ALIAS_CACHE_SIZE):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self._cache = _LRUCache(cache_size)
+
+    def resolve(self, sub: str) -> str:
+        """
+        Translate a sub to the sub of the same user today.
+
+        Args:
+            sub: Sub as stored by the application
+
+        Returns:
+            The current sub of the user
+        """
+        return self.resolve_many([sub])[sub]
+
+    def resolve_many(self, subs: Iterable[str]) -> Dict[str, str]:
+        """
+        Translate several subs, batching the alias lookups of uncached subs.
+
+        Args:
+            subs: Subs as stored by the application
+
+        Returns:
+            Dict mapping every given sub to the current sub of its user
+
+        Raises:
+            ValueError: If alias items stayed unprocessed after MAX_LOOKUP_RETRIES
+        """
+        resolved = {}
+        current = {}
+        for sub in subs:
+            cached = self._cache.get(sub)
+            if cached is not None:
+                resolved[sub] = cached
+            else:
+                current[sub] = sub
+
+        # Follow every uncached sub's chain one link per round of lookups
+        for _ in range(MAX_ALIAS_HOPS):
+            if not current:
+                break
+            links = self._lookup(set(current.values()))
+            for sub, hop in list(current.items()):
+                if hop in links:
+                    current[sub] = links[hop]
+                else:
+                    resolved[sub] = hop
+                    self._cache.put(sub, hop)
+                    del current[sub]
+        for sub, hop in current.items():
+            logger.warning("Alias chain of sub %s is longer than %d links", sub, MAX_ALIAS_HOPS)
+            resolved[sub] = hop
+        return resolved
+
+    def invalidate(self, sub: Optional[str] = None) -> None:
+        """
+        Forget cached translations.
+
+        Args:
+            sub: Sub to forget, or None to clear the whole cache
+        """
+        self._cache.discard(sub)
+
+    def cache_info(self) -> Dict[str, Any]:
+        """Cache hits, misses and size."""
+        return {
+            'hits': self._cache.hits,
+            'misses': self._cache.misses,
+            'size': len(self._cache),
+            'max_size': self._cache.max_size
+        }
+
+    def _lookup(self, subs: Set[str]) -> Dict[str, str]:
+        """
+        Read the alias items of subs with BatchGetItem, retrying UnprocessedKeys
+        with exponential backoff.
+
+        Args:
+            subs: Subs to look up
+
+        Returns:
+            Dict mapping each sub that has an alias item to its new sub
+
+        Raises:
+            ValueError: If keys were still unprocessed after MAX_LOOKUP_RETRIES
+                retries (their subs cannot be told apart from unaliased ones)
+        """
+        links = {}
+        ordered = sorted(subs)
+        for start in range(0, len(ordered), ALIAS_BATCH_SIZE):
+            request = {
+                self.table_name: {
+                    'Keys': [alias_key(sub) for sub in ordered[start:start + ALIAS_BATCH_SIZE]],
+                    'ProjectionExpression': 'PK, new_sub'
+                }
+            }
+            for attempt in range(MAX_LOOKUP_RETRIES + 1):
+                if attempt:
+                    time.sleep(LOOKUP_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                response = self.dynamodb_client.batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self.table_name, []):
+                    links[item['PK']['S'][len(ALIAS_PREFIX):]] = item['new_sub']['S']
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+            if request:
+                raise ValueError(
+                    f"{len(request[self.table_name]['Keys'])} alias lookups were still "
+                    f"unprocessed after {MAX_LOOKUP_RETRIES} retries"
+                )
+        return links
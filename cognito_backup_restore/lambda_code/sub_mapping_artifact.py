@@ -0,0 +1,208 @@
+"""Sub mapping artifact module for sharing a restore's old -> new subs.
+
+Every restore publishes its sub mappings next to the backup it restored, under
+``<backup>/sub-mappings/<target pool>/<restore>/``, for other services that
+key data by Cognito sub:
+
+* ``mappings.ndjson.gz`` - ``[old_sub, new_sub, username]`` lines sorted by
+  old sub, compressed in blocks of block_records mappings. Every block is a
+  complete gzip member, so the object as a whole is also a valid gzip file.
+* ``index.json`` - the first old sub, byte offset, byte length and mapping
+  count of every block.
+
+SubMappingArtifact loads the index once and resolves subs with ranged GETs of
+the blocks that can hold them, so the mappings are never downloaded whole.
+"""
+
+import bisect
+import gzip
+import json
+import posixpath
+from datetime import datetime, UTC
+from typing import Any, Dict, Iterable, List, Optional
+from .backup_format import is_manifest_key
+from .config import logger
+from .s3_writer import S3MultipartWriter, DEFAULT_PART_SIZE
+
+ARTIFACT_FORMAT = 'sub-mappings-v1'
+INDEX_NAME = 'index.json'
+BLOCKS_NAME = 'mappings.ndjson.gz'
+
+# Mappings per compressed block (about 40 KiB compressed, one ranged GET)
+DEFAULT_BLOCK_RECORDS = 1024
+
+def artifact_prefix(backup_key: str, target_user_pool_id: str, restore_id: str) -> str:
+    """
+    Return the S3 prefix of a restore's sub mapping artifact.
+
+    Args:
+        backup_key: S3 key of the backup file (v1) or backup manifest (v2)
+        target_user_pool_id: The ID of the pool the backup was restored to
+        restore_id: Identifier of the restore (its checkpoint's timestamp)
+
+    Returns:
+        Prefix next to the backup, without a trailing slash
+    """
+    if is_manifest_key(backup_key):
+        backup_base = posixpath.dirname(backup_key)
+    else:
+        backup_base = posixpath.splitext(backup_key)[0]
+    return f'{backup_base}/sub-mappings/{target_user_pool_id}/{restore_id}'
+
+def write_sub_mapping_artifact(s3_client, bucket: str, prefix: str,
+                               sub_mappings: Iterable[Dict[str, str]],
+                               metadata: Dict[str, Any],
+                               block_records: int = DEFAULT_BLOCK_RECORDS,
+                               part_size: int = DEFAULT_PART_SIZE) -> str:
+    """
+    Write sub mappings, already sorted by old sub, as a block-compressed artifact.
+
+    Args:
+        s3_client: Boto3 S3 client
+        bucket: Backup bucket name
+        prefix: Prefix from artifact_prefix
+        sub_mappings: Mappings containing username, old_sub and new_sub,
+            sorted by old_sub (a SubMappingStore)
+        metadata: Fields recorded in the index (backup_key, target_user_pool_id, ...)
+        block_records: Mappings per compressed block
+        part_size: Multipart upload part size of the blocks object
+
+    Returns:
+        S3 key of the index
+    """
+    blocks_key = f'{prefix}/{BLOCKS_NAME}'
+    index_key = f'{prefix}/{INDEX_NAME}'
+    blocks: List[List[Any]] = []
+    block: List[str] = []
+    first_sub: Optional[str] = None
+
+    with S3MultipartWriter(s3_client, bucket, blocks_key, 'application/gzip', part_size) as writer:
+        def flush_block() -> None:
+            data = gzip.compress(''.join(block).encode('utf-8'), mtime=0)
+            blocks.append([first_sub, writer.bytes_written, len(data), len(block)])
+            writer.write(data)
+            block.clear()
+
+        for mapping in sub_mappings:
+            if not block:
+                first_sub = mapping['old_sub']
+            block.append(
+                json.dumps([mapping['old_sub'], mapping['new_sub'], mapping['username']]) + '\n'
+            )
+            if len(block) >= block_records:
+                flush_block()
+        if block:
+            flush_block()
+
+    index = {
+        **metadata,
+        'format': ARTIFACT_FORMAT,
+        'created_at': datetime.now(UTC).isoformat(),
+        'blocks_key': blocks_key,
+        'mapping_count': sum(entry[3] for entry in blocks),
+        'compressed_bytes': sum(entry[2] for entry in blocks),
+        'blocks': blocks
+    }
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=index_key,
+        Body=json.dumps(index),
+        ContentType='application/json'
+    )
+    logger.info(
+        "Wrote %d sub mappings in %d blocks (%d bytes) to s3://%s/%s",
+        index['mapping_count'], len(blocks), index['compressed_bytes'], bucket, blocks_key
+    )
+    return index_key
+
+class SubMappingArtifact:
+    """
+    Resolves old subs through a published sub mapping artifact with ranged GETs.
+
+    The most recently read block is kept, so lookups of neighbouring subs (or
+    sorted batches of subs) read each block once.
+    """
+
+    def __init__(self, s3_client, bucket: str, index: Dict[str, Any]):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.index = index
+        self.blocks_read = 0
+        self._first_subs = [entry[0] for entry in index['blocks']]
+        self._cached_block: Optional[int] = None
+        self._cached_mappings: Dict[str, Dict[str, str]] = {}
+
+    @classmethod
+    def load(cls, s3_client, bucket: str, index_key: str) -> 'SubMappingArtifact':
+        """
+        Load the index of an artifact.
+
+        Args:
+            s3_client: Boto3 S3 client
+            bucket: Backup bucket name
+            index_key: S3 key of the artifact's index
+
+        Returns:
+            The artifact, ready for lookups
+
+        Raises:
+            ValueError: If the object is not a sub mapping artifact index
+        """
+        response = s3_client.get_object(Bucket=bucket, Key=index_key)
+        index = json.loads(response['Body'].read())
+        if index.get('format') != ARTIFACT_FORMAT:
+            raise ValueError(f"s3://{bucket}/{index_key} is not a sub mapping artifact index")
+        return cls(s3_client, bucket, index)
+
+    def __len__(self) -> int:
+        return self.index['mapping_count']
+
+    def lookup(self, old_sub: str) -> Optional[Dict[str, str]]:
+        """
+        Find the mapping of an old sub.
+
+        Args:
+            old_sub: Sub of the user before the restore
+
+        Returns:
+            Mapping containing username, old_sub and new_sub, or None if the
+            sub was not restored
+        """
+        block = bisect.bisect_right(self._first_subs, old_sub) - 1
+        if block < 0:
+            return None
+        return self._read_block(block).get(old_sub)
+
+    def lookup_many(self, old_subs: Iterable[str]) -> Dict[str, Dict[str, str]]:
+        """
+        Find the mappings of several old subs, reading each block needed once.
+
+        Args:
+            old_subs: Subs of users before the restore
+
+        Returns:
+            Dict mapping every sub that was restored to its mapping
+        """
+        found = {}
+        for old_sub in sorted(set(old_subs)):
+            mapping = self.lookup(old_sub)
+            if mapping is not None:
+                found[old_sub] = mapping
+        return found
+
+    def _read_block(self, block: int) -> Dict[str, Dict[str, str]]:
+        """Fetch and decode one block with a ranged GET."""
+        if block != self._cached_block:
+            _, offset, length, _ = self.index['blocks'][block]
+            response = self.s3_client.get_object(
+                Bucket=self.bucket,
+                Key=self.index['blocks_key'],
+                Range=f'bytes={offset}-{offset + length - 1}'
+            )
+            mappings = {}
+            for line in gzip.decompress(response['Body'].read()).splitlines():
+                old_sub, new_sub, username = json.loads(line)
+                mappings[old_sub] = {'username': username, 'old_sub': old_sub, 'new_sub': new_sub}
+            self._cached_block, self._cached_mappings = block, mappings
+            self.blocks_read += 1
+        return self._cached_mappings
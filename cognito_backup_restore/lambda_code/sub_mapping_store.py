@@ -0,0 +1,207 @@
+"""Sub mapping store module for compact, on-disk old -> new sub mappings.
+
+A restore of millions of users would need gigabytes to keep its sub
+mappings as Python dicts. SubMappingStore keeps them in a file under /tmp
+instead, as fixed-width records sorted by old sub::
+
+    old_sub (36 bytes) | new_sub (36 bytes) | username offset (8) | username length (4)
+
+Subs are Cognito UUIDs (36 characters; shorter ones are NUL-padded).
+Usernames, which vary in length, live in a companion file. Both files are
+memory-mapped, so the store supports len(), indexing, slicing (views sharing
+the files), sequential iteration and binary-search lookup by old sub while
+keeping only the pages in use in memory.
+"""
+
+import heapq
+import mmap
+import os
+import struct
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Union
+from .config import logger
+
+SUB_WIDTH = 36
+RECORD = struct.Struct(f'<{SUB_WIDTH}s{SUB_WIDTH}sQI')
+
+# Records sorted in memory at a time while building; larger stores are
+# sorted in runs that are merged from disk
+SORT_RUN_RECORDS = 500000
+
+def _encode_sub(sub: str) -> bytes:
+    """Encode a sub into its fixed-width field."""
+    encoded = sub.encode('utf-8')
+    if len(encoded) > SUB_WIDTH:
+        raise ValueError(f"Sub {sub!r} is longer than {SUB_WIDTH} bytes")
+    return encoded.ljust(SUB_WIDTH, b'\0')
+
+def _decode_sub(field: bytes) -> str:
+    """Decode a fixed-width sub field."""
+    return field.rstrip(b'\0').decode('utf-8')
+
+def _map(path: str) -> Union[mmap.mmap, bytes]:
+    """Memory-map a file read-only (empty files cannot be mapped)."""
+    if os.path.getsize(path) == 0:
+        return b''
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _read_run(path: str) -> Iterator[bytes]:
+    """Yield the records of a sorted run file in order."""
+    with open(path, 'rb') as file:
+        while record := file.read(RECORD.size):
+            yield record
+
+def _write_records(file: BinaryIO, records: Iterable[bytes]) -> None:
+    """Write records to a file."""
+    for record in records:
+        file.write(record)
+
+class SubMappingStore:
+    """
+    Read-only sequence of sub mappings, sorted by old sub, backed by mmap'd files.
+
+    Items are dicts with username, old_sub and new_sub, created on access.
+    Slices are views over the same files; only the store returned by build()
+    owns the files and must be closed.
+    """
+
+    def __init__(self, records, usernames, start: int, stop: int,
+                 paths: Optional[List[str]] = None):
+        self._records = records
+        self._usernames = usernames
+        self._start = start
+        self._stop = stop
+        self._paths = paths
+
+    @classmethod
+    def build(cls, mappings: Iterable[Dict[str, str]], work_dir: str,
+              run_records: int = SORT_RUN_RECORDS) -> 'SubMappingStore':
+        """
+        Write mappings to a new store, sorting them in bounded memory.
+
+        Args:
+            mappings: Mappings containing username, old_sub and new_sub
+            work_dir: Directory for the store's files
+            run_records: Records sorted in memory at a time
+
+        Returns:
+            The store, open for reading
+
+        Raises:
+            ValueError: If a sub does not fit its fixed-width field
+        """
+        records_path = os.path.join(work_dir, 'sub-mappings.bin')
+        usernames_path = os.path.join(work_dir, 'sub-mapping-usernames.bin')
+        run_paths: List[str] = []
+        run: List[bytes] = []
+
+        def flush_run() -> None:
+            run.sort()
+            path = os.path.join(work_dir, f'sub-mappings-run-{len(run_paths):04d}.bin')
+            with open(path, 'wb') as run_file:
+                _write_records(run_file, run)
+            run_paths.append(path)
+            run.clear()
+
+        offset = 0
+        with open(usernames_path, 'wb') as usernames_file:
+            for mapping in mappings:
+                username = mapping['username'].encode('utf-8')
+                run.append(RECORD.pack(
+                    _encode_sub(mapping['old_sub']), _encode_sub(mapping['new_sub']),
+                    offset, len(username)
+                ))
+                usernames_file.write(username)
+                offset += len(username)
+                if len(run) >= run_records:
+                    flush_run()
+
+        with open(records_path, 'wb') as records_file:
+            if run_paths:
+                flush_run()
+                _write_records(records_file, heapq.merge(*(_read_run(path) for path in run_paths)))
+                for path in run_paths:
+                    os.remove(path)
+            else:
+                run.sort()
+                _write_records(records_file, run)
+
+        count = os.path.getsize(records_path) // RECORD.size
+        logger.info(
+            "Stored %d sub mappings in %s (%d sorted runs)", count, records_path, len(run_paths)
+        )
+        return cls(
+            _map(records_path), _map(usernames_path), 0, count, [records_path, usernames_path]
+        )
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        for position in range(self._start, self._stop):
+            yield self._mapping(position)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Dict[str, str], 'SubMappingStore']:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("SubMappingStore slices must be contiguous")
+            return SubMappingStore(
+                self._records, self._usernames,
+                self._start + start, self._start + max(start, stop)
+            )
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("sub mapping index out of range")
+        return self._mapping(self._start + index)
+
+    def lookup(self, old_sub: str) -> Optional[Dict[str, str]]:
+        """
+        Find the mapping of an old sub by binary search.
+
+        Args:
+            old_sub: Sub of the user before the restore
+
+        Returns:
+            The mapping, or None if the old sub is not in this store (or view)
+        """
+        try:
+            key = _encode_sub(old_sub)
+        except ValueError:
+            return None
+        low, high = self._start, self._stop
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * RECORD.size
+            if self._records[offset:offset + SUB_WIDTH] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._stop:
+            offset = low * RECORD.size
+            if self._records[offset:offset + SUB_WIDTH] == key:
+                return self._mapping(low)
+        return None
+
+    def close(self) -> None:
+        """Unmap and delete the store's files (owning store only)."""
+        if self._paths is None:
+            return
+        for mapped in (self._records, self._usernames):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        for path in self._paths:
+            os.remove(path)
+        self._paths = None
+
+    def _mapping(self, position: int) -> Dict[str, str]:
+        """Decode the record at an absolute position."""
+        old_sub, new_sub, offset, length = RECORD.unpack_from(
+            self._records, position * RECORD.size
+        )
+        return {
+            'username': self._usernames[offset:offset + length].decode('utf-8'),
+            'old_sub': _decode_sub(old_sub),
+            'new_sub': _decode_sub(new_sub)
+        }
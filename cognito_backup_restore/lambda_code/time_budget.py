@@ -0,0 +1,35 @@
+"""Time budget module for slicing long operations across Lambda invocations."""
+
+from typing import Optional
+from .config import DEFAULT_TIME_BUDGET_MARGIN_MS, logger
+
+class TimeBudget:
+    """
+    Remaining-time check against the Lambda invocation's deadline.
+
+    Long-running loops call exhausted() between units of work (a restore
+    batch, a list_users page, a DynamoDB remap) and stop at the next
+    checkpoint once less than safety_margin_ms is left. Without a Lambda
+    context (tests, local runs) the budget never runs out.
+    """
+
+    def __init__(self, context=None, safety_margin_ms: int = DEFAULT_TIME_BUDGET_MARGIN_MS):
+        self.context = context
+        self.safety_margin_ms = safety_margin_ms
+        self._logged = False
+
+    def remaining_ms(self) -> Optional[int]:
+        """Milliseconds left in the invocation, or None without a Lambda context."""
+        if self.context is None:
+            return None
+        return self.context.get_remaining_time_in_millis()
+
+    def exhausted(self) -> bool:
+        """Whether work should stop so the invocation can end cleanly."""
+        remaining = self.remaining_ms()
+        if remaining is None or remaining > self.safety_margin_ms:
+            return False
+        if not self._logged:
+            logger.info("Time budget exhausted with %d ms remaining, stopping", remaining)
+            self._logged = True
+        return True
@@ -0,0 +1,195 @@
+"""Cognito user import job module for bulk restore operations."""
+
+import csv
+import os
+import time
+import urllib.request
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from .config import logger
+from .time_budget import TimeBudget
+
+# Cognito limits a single import job to 500,000 users and a 100 MB CSV file
+MAX_USERS_PER_JOB = 500000
+MAX_CSV_BYTES = 100 * 1024 * 1024
+# Room left for the row being written when checking a file against MAX_CSV_BYTES
+CSV_SIZE_HEADROOM = 1024 * 1024
+
+# Columns that Cognito requires to hold 'true' or 'false'
+BOOLEAN_COLUMNS = ('email_verified', 'phone_number_verified', 'cognito:mfa_enabled')
+
+FINISHED_JOB_STATUSES = ('Succeeded', 'Failed', 'Stopped', 'Expired')
+
+def user_to_csv_row(header: List[str], user: Dict[str, Any]) -> List[str]:
+    """
+    Convert a backed up user into a row for the pool's import CSV header.
+
+    Args:
+        header: Column names returned by get_csv_header
+        user: User object from a backup
+
+    Returns:
+        Row values in header order
+    """
+    attributes = {attr['Name']: attr['Value'] for attr in user.get('Attributes', [])}
+    attributes['cognito:username'] = user['Username']
+    row = []
+    for column in header:
+        value = attributes.get(column, '')
+        if column in BOOLEAN_COLUMNS:
+            value = 'true' if str(value).lower() == 'true' else 'false'
+        row.append(value)
+    return row
+
+def write_import_csvs(header: List[str], users: Iterable[Dict[str, Any]],
+                      work_dir: str) -> Iterator[Tuple[str, int]]:
+    """
+    Write users to import CSV files, starting a new file whenever one reaches
+    Cognito's per-job user or size limit.
+
+    Files are written lazily: each one is yielded once it is complete, and
+    the next is only written when the caller asks for it.
+
+    Args:
+        header: Column names returned by get_csv_header
+        users: User objects from a backup
+        work_dir: Directory for the CSV files
+
+    Yields:
+        Tuples of (path of a CSV file, one per import job, number of users in it)
+    """
+    csv_paths: List[str] = []
+    csv_file = None
+    try:
+        rows = 0
+        for user in users:
+            if (csv_file is None or rows >= MAX_USERS_PER_JOB
+                    or csv_file.tell() >= MAX_CSV_BYTES - CSV_SIZE_HEADROOM):
+                if csv_file is not None:
+                    csv_file.close()
+                    yield csv_paths[-1], rows
+                csv_paths.append(os.path.join(work_dir, f'import-{len(csv_paths):03d}.csv'))
+                # pylint: disable-next=consider-using-with
+                csv_file = open(csv_paths[-1], 'w', encoding='utf-8', newline='')
+                writer = csv.writer(csv_file, lineterminator='\n')
+                writer.writerow(header)
+                rows = 0
+            writer.writerow(user_to_csv_row(header, user))
+            rows += 1
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+    if csv_paths:
+        yield csv_paths[-1], rows
+
+def upload_import_csv(presigned_url: str, csv_path: str, timeout: int = 300) -> None:
+    """
+    Upload an import CSV to the pre-signed URL of a user import job.
+
+    Args:
+        presigned_url: PreSignedUrl from create_user_import_job
+        csv_path: Path of the CSV file
+        timeout: Upload timeout in seconds
+    """
+    with open(csv_path, 'rb') as csv_file:
+        request = urllib.request.Request(
+            presigned_url,
+            data=csv_file,
+            method='PUT',
+            headers={
+                'x-amz-server-side-encryption': 'aws:kms',
+                'Content-Length': str(os.path.getsize(csv_path))
+            }
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:  # nosec B310
+            response.read()
+
+class CognitoUserImport:
+    """
+    Runs Cognito user import jobs from CSV files.
+
+    Creating (and uploading) a job, starting it and waiting for it are
+    separate steps, so a restore can record its jobs before waiting and
+    continue waiting for them in a later invocation.
+    """
+
+    def __init__(self, call_cognito: Callable[..., Dict[str, Any]], role_arn: str,
+                 poll_interval: float = 5.0,
+                 uploader: Optional[Callable[[str, str], None]] = None):
+        self.call_cognito = call_cognito
+        self.role_arn = role_arn
+        self.poll_interval = poll_interval
+        self.uploader = uploader or upload_import_csv
+
+    def get_csv_header(self, user_pool_id: str) -> List[str]:
+        """Return the import CSV columns of the user pool."""
+        return self.call_cognito('get_csv_header', UserPoolId=user_pool_id)['CSVHeader']
+
+    def create_job(self, user_pool_id: str, job_name: str, csv_path: str) -> Dict[str, Any]:
+        """
+        Create a user import job and upload its CSV file.
+
+        Args:
+            user_pool_id: Target user pool ID
+            job_name: Name of the import job
+            csv_path: Path of the CSV file to import
+
+        Returns:
+            The created job description (JobId, Status, ...)
+
+        Raises:
+            ClientError: If the job cannot be created
+            OSError: If the CSV cannot be uploaded
+        """
+        job = self.call_cognito(
+            'create_user_import_job',
+            JobName=job_name,
+            UserPoolId=user_pool_id,
+            CloudWatchLogsRoleArn=self.role_arn
+        )['UserImportJob']
+        self.uploader(job['PreSignedUrl'], csv_path)
+        logger.info("Created user import job %s for user pool %s", job['JobId'], user_pool_id)
+        return job
+
+    def start_job(self, user_pool_id: str, job_id: str) -> None:
+        """
+        Start a created user import job.
+
+        Raises:
+            ClientError: If the job cannot be started
+        """
+        self.call_cognito('start_user_import_job', UserPoolId=user_pool_id, JobId=job_id)
+        logger.info("Started user import job %s for user pool %s", job_id, user_pool_id)
+
+    def wait_for_job(self, user_pool_id: str, job_id: str,
+                     time_budget: TimeBudget) -> Optional[Dict[str, Any]]:
+        """
+        Poll a started user import job until it finishes or the time budget runs out.
+
+        Args:
+            user_pool_id: Target user pool ID
+            job_id: ID of the import job
+            time_budget: Budget of the invocation
+
+        Returns:
+            The finished job description (Status, ImportedUsers, FailedUsers, ...),
+            or None if the budget ran out first
+
+        Raises:
+            ClientError: If the job cannot be described
+        """
+        while True:
+            job = self.call_cognito(
+                'describe_user_import_job', UserPoolId=user_pool_id, JobId=job_id
+            )['UserImportJob']
+            if job['Status'] in FINISHED_JOB_STATUSES:
+                logger.info(
+                    "User import job %s finished with status %s "
+                    "(%s imported, %s skipped, %s failed)",
+                    job_id, job['Status'], job.get('ImportedUsers', 0),
+                    job.get('SkippedUsers', 0), job.get('FailedUsers', 0)
+                )
+                return job
+            if time_budget.exhausted():
+                logger.info("User import job %s still %s", job_id, job['Status'])
+                return None
+            time.sleep(self.poll_interval)
@@ -0,0 +1,194 @@
+"""Target user pool index module for Cognito restore operations."""
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from .config import logger
+from .s3_writer import S3MultipartWriter
+
+DEFAULT_SPILL_THRESHOLD = 500000
+
+# Entries read back from a saved index per add_all call
+LOAD_BATCH_SIZE = 10000
+
+class TargetUserIndex:
+    """
+    Username -> sub index of the users already present in a target user pool.
+
+    Entries are kept in a dict until spill_threshold users have been indexed;
+    larger pools are moved to an SQLite database under /tmp so Lambda memory
+    stays bounded. Lookups are thread-safe.
+    """
+
+    def __init__(self, spill_threshold: int = DEFAULT_SPILL_THRESHOLD,
+                 spill_dir: Optional[str] = None):
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self._entries: Dict[str, str] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_path: Optional[str] = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, list_users_pages: Iterable[Dict], **kwargs) -> 'TargetUserIndex':
+        """
+        Build an index from list_users response pages.
+
+        Args:
+            list_users_pages: Pages of a list_users scan of the target pool
+            **kwargs: Arguments for the TargetUserIndex constructor
+
+        Returns:
+            The populated index
+        """
+        index = cls(**kwargs)
+        for page in list_users_pages:
+            index.add_all(_username_subs(page['Users']))
+        logger.info(
+            "Pre-scanned %d existing users in the target pool%s",
+            len(index), ' (spilled to disk)' if index.spilled else ''
+        )
+        return index
+
+    @classmethod
+    def load(cls, s3_client, bucket: str, key: str, **kwargs) -> 'TargetUserIndex':
+        """
+        Load an index written by save, so a resumed restore need not scan again.
+
+        Args:
+            s3_client: Boto3 S3 client
+            bucket: Backup bucket name
+            key: S3 key of the saved index
+            **kwargs: Arguments for the TargetUserIndex constructor
+
+        Returns:
+            The populated index
+        """
+        index = cls(**kwargs)
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        batch: List[Tuple[str, str]] = []
+        for line in response['Body'].iter_lines():
+            if line.strip():
+                username, sub = json.loads(line)
+                batch.append((username, sub))
+                if len(batch) >= LOAD_BATCH_SIZE:
+                    index.add_all(batch)
+                    batch = []
+        index.add_all(batch)
+        logger.info("Loaded %d indexed target users from s3://%s/%s", len(index), bucket, key)
+        return index
+
+    def save(self, s3_client, bucket: str, key: str) -> None:
+        """
+        Write the index to S3 as NDJSON [username, sub] lines.
+
+        Args:
+            s3_client: Boto3 S3 client
+            bucket: Backup bucket name
+            key: S3 key to write the index to
+        """
+        with S3MultipartWriter(s3_client, bucket, key, 'application/x-ndjson') as writer:
+            for username, sub in self.items():
+                writer.write(json.dumps([username, sub]) + '\n')
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        """Yield every (username, sub) pair; the index must not change meanwhile."""
+        if self._db is None:
+            yield from list(self._entries.items())
+            return
+        cursor = self._db.execute('SELECT username, sub FROM users')
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the index has been moved to disk."""
+        return self._db is not None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add_all(self, entries: Iterable[Tuple[str, str]]) -> None:
+        """
+        Add (username, sub) pairs to the index.
+
+        Args:
+            entries: Pairs to add; later pairs replace earlier ones
+        """
+        with self._lock:
+            if self._db is not None:
+                self._insert(entries)
+                return
+            for username, sub in entries:
+                self._entries[username] = sub
+            self._size = len(self._entries)
+            if self._size >= self.spill_threshold:
+                self._spill()
+
+    def get(self, username: str) -> Optional[str]:
+        """
+        Look up the sub of an existing user.
+
+        Args:
+            username: Username to look up
+
+        Returns:
+            The user's sub, or None if the user is not in the target pool
+        """
+        with self._lock:
+            if self._db is None:
+                return self._entries.get(username)
+            row = self._db.execute(
+                'SELECT sub FROM users WHERE username = ?', (username,)
+            ).fetchone()
+            return row[0] if row else None
+
+    def close(self) -> None:
+        """Release the index, deleting its on-disk database if it spilled."""
+        with self._lock:
+            self._entries = {}
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                os.remove(self._db_path)
+
+    def _spill(self) -> None:
+        """Move the in-memory entries to an SQLite database (caller holds the lock)."""
+        handle, self._db_path = tempfile.mkstemp(
+            prefix='target-users-', suffix='.sqlite', dir=self.spill_dir
+        )
+        os.close(handle)
+        self._db = sqlite3.connect(self._db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('CREATE TABLE users (username TEXT PRIMARY KEY, sub TEXT NOT NULL)')
+        entries, self._entries = self._entries, {}
+        self._size = 0
+        self._insert(entries.items())
+        logger.info("Spilled target user index to %s", self._db_path)
+
+    def _insert(self, entries: Iterable[Tuple[str, str]]) -> None:
+        """Insert pairs into the on-disk database (caller holds the lock)."""
+        with self._db:
+            cursor = self._db.executemany(
+                'INSERT OR REPLACE INTO users (username, sub) VALUES (?, ?)', entries
+            )
+        # list_users never repeats a username, so every row is a new user
+        self._size += cursor.rowcount
+        cursor.close()
+
+def _username_subs(users: Iterable[Dict]) -> Iterator[Tuple[str, str]]:
+    """Yield (username, sub) for the list_users users that carry a sub attribute."""
+    for user in users:
+        sub = next(
+            (attr['Value'] for attr in user.get('Attributes', []) if attr['Name'] == 'sub'),
+            None
+        )
+        if sub:
+            yield user['Username'], sub
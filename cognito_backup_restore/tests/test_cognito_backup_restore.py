@@ -1096,17 +1096,47 @@
 #     assert response['Item']['data']['S'] == 'test-data'
 
 ###################################################################
+import csv
+import gzip
+import os
+import threading
+from datetime import datetime, timedelta, UTC
 import pytest
 import json
 import boto3
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
 from moto import mock_aws
 from cognito_backup_restore.lambda_code.lambda_handler import lambda_handler
 from cognito_backup_restore.lambda_code.config import Config
-from cognito_backup_restore.lambda_code.aws_clients import AWSClients
+from cognito_backup_restore.lambda_code.aws_clients import AWSClients, ClientRegistry, CLIENT_REGISTRY
 from cognito_backup_restore.lambda_code.backup import CognitoBackup
 from cognito_backup_restore.lambda_code.restore import CognitoRestore
 from cognito_backup_restore.lambda_code.dynamodb_update import DynamoDBUpdate
-
+from cognito_backup_restore.lambda_code.checkpoint import RestoreCheckpoint
+from cognito_backup_restore.lambda_code.compaction import BackupCompaction
+from cognito_backup_restore.lambda_code.backup_format import (
+    ShardedBackupWriter, iter_backup_users, load_catalog, load_manifest, record_backup, resolve_chain
+)
+from cognito_backup_restore.lambda_code.concurrency import AIMDController
+from cognito_backup_restore.lambda_code.legacy_format import load_legacy_backup
+from cognito_backup_restore.lambda_code.rate_limit import TokenBucket
+from cognito_backup_restore.lambda_code.remap_queue import LocalRemapQueue, RemapWorker, SQSRemapQueue
+from cognito_backup_restore.lambda_code.sub_alias import SubAliasResolver
+from cognito_backup_restore.lambda_code.sub_mapping_artifact import SubMappingArtifact, artifact_prefix, write_sub_mapping_artifact
+from cognito_backup_restore.lambda_code.sub_mapping_store import SubMappingStore
+from cognito_backup_restore.lambda_code.s3_writer import S3MultipartWriter, MIN_PART_SIZE
+from cognito_backup_restore.lambda_code.time_budget import TimeBudget
+from cognito_backup_restore.lambda_code.user_index import TargetUserIndex
+
+
+
+@pytest.fixture(autouse=True)
+def client_registry():
+    """Fixture to give every test fresh boto3 clients from the shared client registry."""
+    CLIENT_REGISTRY.clear()
+    yield CLIENT_REGISTRY
+    CLIENT_REGISTRY.clear()
 
 
 @pytest.fixture
@@ -1333,6 +1363,10 @@ def test_lambda_handler_restore_success(user_pool, s3_bucket, dynamodb_table, mo
     assert response_body['failed_users'] == []
     assert response_body['dynamodb_records_updated'] == 1
     assert response_body['dynamodb_failed_updates'] == []
+    artifact_key = response_body['sub_mapping_artifact'].split('/', 3)[3]
+    assert artifact_key.startswith(f'cognito-backups/{source_pool_id}/2025-08-13_12-00-00/sub-mappings/{target_pool_id}/')
+    artifact = SubMappingArtifact.load(s3_client, s3_bucket, artifact_key)
+    assert artifact.lookup('old-sub-123')['username'] == 'testuser'
 
 
 @mock_aws
@@ -1397,7 +1431,7 @@ def test_lambda_handler_invalid_operation(s3_bucket, monkeypatch):
 
 
     assert response['statusCode'] == 400
-    assert json.loads(response['body'])['error'] == 'Invalid operation. Use "backup" or "restore"'
+    assert json.loads(response['body'])['error'] == 'Invalid operation. Use "backup", "restore", "resume", "remap_worker", "verify" or "compact"'
 
 
 
@@ -1570,3 +1604,1665 @@ def test_dynamodb_update_sub(dynamodb_table, aws_clients):
     )
     assert 'Item' in response
     assert response['Item']['data']['S'] == 'test-data'
+
+
+@mock_aws
+def test_cognito_backup_membership_strategies(user_pool, aws_clients, monkeypatch):
+    """Test that group-centric and per-user membership enumeration agree."""
+    cognito_client = aws_clients.cognito_client
+    cognito_client.create_group(GroupName='GroupA', UserPoolId=user_pool)
+    cognito_client.create_group(GroupName='GroupB', UserPoolId=user_pool)
+    for username in ['alice', 'bob', 'carol']:
+        cognito_client.admin_create_user(
+            UserPoolId=user_pool,
+            Username=username,
+            UserAttributes=[{'Name': 'email', 'Value': f'{username}@example.com'}],
+            MessageAction='SUPPRESS'
+        )
+    cognito_client.admin_add_user_to_group(UserPoolId=user_pool, Username='alice', GroupName='GroupA')
+    cognito_client.admin_add_user_to_group(UserPoolId=user_pool, Username='alice', GroupName='GroupB')
+    cognito_client.admin_add_user_to_group(UserPoolId=user_pool, Username='bob', GroupName='GroupB')
+
+    results = {}
+    for strategy in ['group', 'user']:
+        backup = CognitoBackup(aws_clients, membership_strategy=strategy)
+        groups = backup._get_groups(user_pool)
+        membership_index = backup._get_membership_index(user_pool, groups)
+        assert (membership_index is not None) == (strategy == 'group')
+        results[strategy] = {
+            user['Username']: sorted(user['Groups'])
+            for page, _ in backup._iter_users_with_groups(user_pool, membership_index)
+            for user in page
+        }
+
+    assert results['group'] == results['user']
+    assert results['group'] == {'alice': ['GroupA', 'GroupB'], 'bob': ['GroupB'], 'carol': []}
+
+    # A group list that cannot be read fails the backup instead of dropping memberships
+    def denied(**kwargs):
+        raise ClientError({'Error': {'Code': 'NotAuthorizedException', 'Message': 'denied'}}, 'ListGroups')
+    monkeypatch.setattr(aws_clients.cognito_client, 'list_groups', denied)
+    with pytest.raises(ClientError):
+        CognitoBackup(aws_clients, membership_strategy='group').backup_user_pool(user_pool)
+
+
+@mock_aws
+def test_lambda_handler_backup_records_membership_strategy(user_pool, s3_bucket, monkeypatch, aws_region):
+    """Test that the backup records which membership strategy it used."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('AWS_REGION', aws_region)
+
+    response = lambda_handler(
+        {'operation': 'backup', 'user_pool_id': user_pool, 'membership_strategy': 'user'}, None
+    )
+    response_body = json.loads(response['body'])
+    assert response['statusCode'] == 200
+    assert response_body['membership_strategy'] == 'user'
+
+    s3_client = boto3.client('s3', region_name=aws_region)
+    backup_key = response_body['backup_location'].replace(f"s3://{s3_bucket}/", "")
+    backup_data = json.loads(s3_client.get_object(Bucket=s3_bucket, Key=backup_key)['Body'].read())
+    assert backup_data['membership_strategy'] == 'user'
+
+    response = lambda_handler(
+        {'operation': 'backup', 'user_pool_id': user_pool, 'membership_strategy': 'bogus'}, None
+    )
+    assert response['statusCode'] == 400
+
+
+@mock_aws
+def test_s3_multipart_writer(s3_bucket, aws_clients):
+    """Test S3MultipartWriter for single-request, multipart and aborted uploads."""
+    s3_client = aws_clients.s3_client
+
+    with S3MultipartWriter(s3_client, s3_bucket, 'small.json') as writer:
+        writer.write('{"users": []}')
+    assert s3_client.get_object(Bucket=s3_bucket, Key='small.json')['Body'].read() == b'{"users": []}'
+
+    chunk = b'x' * (1024 * 1024)
+    with S3MultipartWriter(s3_client, s3_bucket, 'large.json', part_size=MIN_PART_SIZE) as writer:
+        for _ in range(7):
+            writer.write(chunk)
+        assert len(writer._parts) == 1
+    body = s3_client.get_object(Bucket=s3_bucket, Key='large.json')['Body'].read()
+    assert body == chunk * 7
+
+    with pytest.raises(RuntimeError):
+        with S3MultipartWriter(s3_client, s3_bucket, 'aborted.json', part_size=MIN_PART_SIZE) as writer:
+            writer.write(chunk * 6)
+            raise RuntimeError('serialization failed')
+    assert 'Contents' not in s3_client.list_objects_v2(Bucket=s3_bucket, Prefix='aborted.json')
+    assert s3_client.list_multipart_uploads(Bucket=s3_bucket).get('Uploads', []) == []
+
+
+@mock_aws
+def test_sharded_backup_writer(s3_bucket, aws_clients):
+    """Test that ShardedBackupWriter cuts shards on page boundaries and checksums them."""
+    writer = ShardedBackupWriter(aws_clients.s3_client, s3_bucket, 'cognito-backups/pool/ts', shard_size=3)
+    pages = [[{'Username': f'user{page}{i}', 'Groups': []} for i in range(2)] for page in range(3)]
+    for page in pages:
+        writer.add_page(page)
+    written = writer.write_manifest({'timestamp': '2025-08-13T12:00:00Z', 'groups': []})
+
+    manifest = load_manifest(aws_clients.s3_client, s3_bucket, writer.manifest_key)
+    assert manifest == written
+    assert manifest['users_backed_up'] == 6
+    assert [shard['users'] for shard in manifest['shards']] == [4, 2]
+    users = list(iter_backup_users(aws_clients.s3_client, s3_bucket, manifest))
+    assert [user['Username'] for user in users] == [user['Username'] for page in pages for user in page]
+
+
+@mock_aws
+def test_lambda_handler_v2_backup_verify_and_restore(user_pool, s3_bucket, dynamodb_table, monkeypatch, aws_region):
+    """Test a v2 backup round trip through the verify and restore operations."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('DYNAMODB_TABLE_NAME', dynamodb_table)
+    monkeypatch.setenv('AWS_REGION', aws_region)
+    cognito_client = boto3.client('cognito-idp', region_name=aws_region)
+    cognito_client.create_group(GroupName='TestGroup', UserPoolId=user_pool)
+    for username in ['alice', 'bob']:
+        cognito_client.admin_create_user(
+            UserPoolId=user_pool,
+            Username=username,
+            UserAttributes=[{'Name': 'email', 'Value': f'{username}@example.com'}],
+            MessageAction='SUPPRESS'
+        )
+    cognito_client.admin_add_user_to_group(UserPoolId=user_pool, Username='bob', GroupName='TestGroup')
+
+    response = lambda_handler(
+        {'operation': 'backup', 'user_pool_id': user_pool, 'backup_format': 'v2'}, None
+    )
+    assert response['statusCode'] == 200
+    response_body = json.loads(response['body'])
+    manifest_key = response_body['backup_location'].replace(f"s3://{s3_bucket}/", "")
+    assert manifest_key.endswith('/manifest.json')
+    assert response_body['users_backed_up'] == 2
+
+    response = lambda_handler({'operation': 'verify', 'backup_key': manifest_key}, None)
+    assert json.loads(response['body'])['status'] == 'success'
+
+    target_pool_id = cognito_client.create_user_pool(PoolName='targetPool')['UserPool']['Id']
+    response = lambda_handler({
+        'operation': 'restore',
+        'backup_key': manifest_key,
+        'target_user_pool_id': target_pool_id
+    }, None)
+    assert response['statusCode'] == 200
+    response_body = json.loads(response['body'])
+    assert response_body['users_restored'] == 2
+    assert response_body['groups_restored'] == 1
+    assert response_body['user_group_memberships_restored'] == 1
+
+    s3_client = boto3.client('s3', region_name=aws_region)
+    manifest = load_manifest(s3_client, s3_bucket, manifest_key)
+    s3_client.put_object(Bucket=s3_bucket, Key=manifest['shards'][0]['key'], Body=b'{"Username": "mallory"}\n')
+    response = lambda_handler({'operation': 'verify', 'backup_key': manifest_key}, None)
+    response_body = json.loads(response['body'])
+    assert response_body['status'] == 'corrupt'
+    assert response_body['failed_shards'] == [manifest['shards'][0]['key']]
+    assert response_body['users_verified'] == 0
+
+    # A corrupt shard is rejected before any of its users is created
+    corrupt_target_id = cognito_client.create_user_pool(PoolName='corruptTarget')['UserPool']['Id']
+    response = lambda_handler({
+        'operation': 'restore',
+        'backup_key': manifest_key,
+        'target_user_pool_id': corrupt_target_id
+    }, None)
+    assert response['statusCode'] == 500
+    assert cognito_client.list_users(UserPoolId=corrupt_target_id)['Users'] == []
+
+
+@mock_aws
+def test_lambda_handler_incremental_backup_and_restore(user_pool, s3_bucket, dynamodb_table, monkeypatch, aws_region):
+    """Test an incremental backup chained to a full snapshot, and restoring from it."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('DYNAMODB_TABLE_NAME', dynamodb_table)
+    monkeypatch.setenv('AWS_REGION', aws_region)
+    cognito_client = boto3.client('cognito-idp', region_name=aws_region)
+    s3_client = boto3.client('s3', region_name=aws_region)
+    cognito_client.create_group(GroupName='TestGroup', UserPoolId=user_pool)
+    for username in ['alice', 'bob', 'carol']:
+        cognito_client.admin_create_user(
+            UserPoolId=user_pool,
+            Username=username,
+            UserAttributes=[{'Name': 'email', 'Value': f'{username}@example.com'}],
+            MessageAction='SUPPRESS'
+        )
+
+    # Without a previous v2 backup an incremental backup is a full snapshot
+    response = lambda_handler({'operation': 'backup', 'user_pool_id': user_pool, 'incremental': True}, None)
+    response_body = json.loads(response['body'])
+    assert response_body['backup_type'] == 'full'
+    assert response_body['users_backed_up'] == 3
+    base_key = response_body['backup_location'].replace(f"s3://{s3_bucket}/", "")
+
+    cognito_client.admin_update_user_attributes(
+        UserPoolId=user_pool, Username='bob',
+        UserAttributes=[{'Name': 'email', 'Value': 'bob@example.org'}]
+    )
+    cognito_client.admin_add_user_to_group(UserPoolId=user_pool, Username='alice', GroupName='TestGroup')
+    cognito_client.admin_delete_user(UserPoolId=user_pool, Username='carol')
+    cognito_client.admin_create_user(UserPoolId=user_pool, Username='dave', MessageAction='SUPPRESS')
+
+    response = lambda_handler({'operation': 'backup', 'user_pool_id': user_pool, 'incremental': True}, None)
+    response_body = json.loads(response['body'])
+    assert response_body['backup_type'] == 'incremental'
+    assert response_body['users_backed_up'] == 3
+    assert response_body['users_deleted'] == 1
+    assert response_body['users_unchanged'] == 0
+    assert response_body['groups_changed'] is False
+    assert response_body['base_backup'] == base_key
+    delta_key = response_body['backup_location'].replace(f"s3://{s3_bucket}/", "")
+
+    users = {
+        user['Username']: user
+        for user in iter_backup_users(s3_client, s3_bucket, load_manifest(s3_client, s3_bucket, delta_key))
+    }
+    assert sorted(users) == ['alice', 'bob', 'dave']
+    assert users['alice']['Groups'] == ['TestGroup']
+    assert {'Name': 'email', 'Value': 'bob@example.org'} in users['bob']['Attributes']
+
+    target_pool_id = cognito_client.create_user_pool(PoolName='targetPool')['UserPool']['Id']
+    response = lambda_handler({
+        'operation': 'restore',
+        'backup_key': delta_key,
+        'target_user_pool_id': target_pool_id
+    }, None)
+    response_body = json.loads(response['body'])
+    assert response_body['users_restored'] == 3
+    assert response_body['user_group_memberships_restored'] == 1
+
+
+@mock_aws
+def test_lambda_handler_compact_backup_chain(user_pool, s3_bucket, monkeypatch, aws_region):
+    """Test compacting a base snapshot and its deltas into a new full snapshot."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('AWS_REGION', aws_region)
+    monkeypatch.setenv('BACKUP_SHARD_SIZE', '2')
+    cognito_client = boto3.client('cognito-idp', region_name=aws_region)
+    s3_client = boto3.client('s3', region_name=aws_region)
+    for username in ['dave', 'bob', 'alice']:
+        cognito_client.admin_create_user(UserPoolId=user_pool, Username=username, MessageAction='SUPPRESS')
+    backup_event = {'operation': 'backup', 'user_pool_id': user_pool, 'incremental': True}
+    lambda_handler(backup_event, None)
+
+    cognito_client.admin_delete_user(UserPoolId=user_pool, Username='bob')
+    cognito_client.admin_create_user(UserPoolId=user_pool, Username='carol', MessageAction='SUPPRESS')
+    lambda_handler(backup_event, None)
+    cognito_client.admin_update_user_attributes(
+        UserPoolId=user_pool, Username='carol',
+        UserAttributes=[{'Name': 'email', 'Value': 'carol@example.com'}]
+    )
+    response = lambda_handler(backup_event, None)
+    delta_key = json.loads(response['body'])['backup_location'].replace(f"s3://{s3_bucket}/", "")
+
+    response = lambda_handler({'operation': 'compact', 'user_pool_id': user_pool}, None)
+    assert response['statusCode'] == 200
+    response_body = json.loads(response['body'])
+    assert response_body['status'] == 'success'
+    assert response_body['deltas_merged'] == 2
+    compacted_key = response_body['backup_location'].replace(f"s3://{s3_bucket}/", "")
+
+    compacted = load_manifest(s3_client, s3_bucket, compacted_key)
+    assert compacted['backup_type'] == 'full'
+    assert compacted['compacted_from'][-1] == delta_key
+    users = list(iter_backup_users(s3_client, s3_bucket, compacted))
+    assert [user['Username'] for user in users] == ['alice', 'carol', 'dave']
+    assert {'Name': 'email', 'Value': 'carol@example.com'} in users[1]['Attributes']
+
+    # Restoring the delta now starts from the compacted snapshot
+    delta = load_manifest(s3_client, s3_bucket, delta_key)
+    assert resolve_chain(s3_client, s3_bucket, delta, delta_key) == [compacted]
+    assert sorted(user['Username'] for user in iter_backup_users(s3_client, s3_bucket, delta, delta_key)) == [
+        'alice', 'carol', 'dave'
+    ]
+
+    # The next incremental backup is based on the compacted snapshot
+    response = lambda_handler(backup_event, None)
+    assert json.loads(response['body'])['base_backup'] == compacted_key
+    response = lambda_handler({'operation': 'compact', 'user_pool_id': user_pool}, None)
+    assert json.loads(response['body'])['deltas_merged'] == 1
+
+
+def test_token_bucket_paces_callers():
+    """Test that TokenBucket allows a burst up to capacity and then paces to its rate."""
+    bucket = TokenBucket(rate=100, capacity=5)
+    assert sum(bucket.acquire() for _ in range(5)) == 0
+    assert bucket.acquire(2) > 0
+
+
+@mock_aws
+def test_cognito_restore_users_concurrently(user_pool, aws_clients):
+    """Test that the concurrent restore engine keeps its statistics consistent."""
+    aws_clients.cognito_client.create_group(GroupName='TestGroup', UserPoolId=user_pool)
+    aws_clients.cognito_client.admin_create_user(UserPoolId=user_pool, Username='user00', MessageAction='SUPPRESS')
+    users = [
+        {
+            'Username': f'user{i:02d}',
+            'Attributes': [
+                {'Name': 'email', 'Value': f'user{i:02d}@example.com'},
+                {'Name': 'sub', 'Value': f'old-sub-{i:02d}'}
+            ],
+            'Groups': ['TestGroup', 'MissingGroup'] if i % 2 else []
+        }
+        for i in range(40)
+    ]
+
+    restore = CognitoRestore(aws_clients, max_workers=4, rps_limits={'admin_create_user': 1000})
+    stats = restore._restore_users(iter(users), user_pool)
+
+    assert stats['users_restored'] == 40
+    assert stats['memberships_restored'] == 20
+    assert stats['failed_users'] == []
+    assert sorted(mapping['old_sub'] for mapping in stats['sub_mappings']) == [f'old-sub-{i:02d}' for i in range(40)]
+    assert len({mapping['new_sub'] for mapping in stats['sub_mappings']}) == 40
+
+
+def test_aimd_controller_adapts_to_throttling():
+    """Test that AIMDController grows on success, halves on throttling and retries."""
+    controller = AIMDController(max_limit=8, initial_limit=4, base_delay=0.001, max_delay=0.001)
+    for _ in range(40):
+        controller.call(lambda: 'ok')
+    assert controller.limit == 8
+
+    attempts = []
+
+    def throttled_once():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ClientError({'Error': {'Code': 'TooManyRequestsException', 'Message': 'Rate exceeded'}}, 'AdminCreateUser')
+        return 'created'
+
+    assert controller.call(throttled_once) == 'created'
+    stats = controller.stats()
+    assert stats['throttles'] == 1
+    assert stats['retries'] == 1
+    assert stats['concurrency_limit'] == 4
+    assert stats['peak_concurrency_limit'] == 8
+
+    def not_found():
+        raise ClientError({'Error': {'Code': 'UserNotFoundException', 'Message': 'missing'}}, 'AdminGetUser')
+
+    with pytest.raises(ClientError):
+        controller.call(not_found)
+    assert controller.stats()['retries'] == 1
+
+
+@mock_aws
+def test_cognito_restore_prescan_resolves_existing_users(user_pool, aws_clients, monkeypatch):
+    """Test that a pre-scanned restore resolves existing users without calling Cognito for them."""
+    cognito_client = aws_clients.cognito_client
+    existing_subs = {}
+    for username in ['alice', 'bob']:
+        response = cognito_client.admin_create_user(UserPoolId=user_pool, Username=username, MessageAction='SUPPRESS')
+        existing_subs[username] = next(
+            attr['Value'] for attr in response['User']['Attributes'] if attr['Name'] == 'sub'
+        )
+    users = [
+        {'Username': username, 'Attributes': [{'Name': 'sub', 'Value': f'old-{username}'}], 'Groups': []}
+        for username in ['alice', 'bob', 'carol']
+    ]
+
+    created = []
+    create_user = cognito_client.admin_create_user
+    monkeypatch.setattr(cognito_client, 'admin_create_user', lambda **kwargs: created.append(kwargs['Username']) or create_user(**kwargs))
+    monkeypatch.setattr(cognito_client, 'admin_get_user', lambda **kwargs: pytest.fail('admin_get_user called'))
+
+    restore = CognitoRestore(aws_clients, prescan_spill_threshold=1)
+    index = TargetUserIndex.build(
+        restore._paginate_cognito('list_users', token_key='PaginationToken', UserPoolId=user_pool),
+        spill_threshold=1
+    )
+    assert index.spilled
+    assert index.get('alice') == existing_subs['alice']
+    assert index.get('carol') is None
+    stats = restore._restore_users(users, user_pool, index)
+    index.close()
+
+    assert created == ['carol']
+    assert stats['users_restored'] == 3
+    assert stats['existing_users'] == 2
+    mappings = {mapping['username']: mapping['new_sub'] for mapping in stats['sub_mappings']}
+    assert mappings['alice'] == existing_subs['alice']
+    assert mappings['bob'] == existing_subs['bob']
+
+
+@mock_aws
+def test_cognito_restore_with_user_import_jobs(user_pool, aws_clients, monkeypatch):
+    """Test that import-mode restores create users through import jobs and map their subs."""
+    cognito_client = aws_clients.cognito_client
+    cognito_client.create_group(GroupName='TestGroup', UserPoolId=user_pool)
+    header = ['cognito:username', 'email', 'email_verified', 'cognito:mfa_enabled']
+    uploads = {}
+
+    def upload(url, path):
+        with open(path, encoding='utf-8') as csv_file:
+            uploads['job-1'] = list(csv.DictReader(csv_file))
+
+    def start_user_import_job(**kwargs):
+        rows = uploads[kwargs['JobId']]
+        for row in rows[:-1]:
+            cognito_client.admin_create_user(
+                UserPoolId=kwargs['UserPoolId'], Username=row['cognito:username'],
+                UserAttributes=[{'Name': 'email', 'Value': row['email']}], MessageAction='SUPPRESS'
+            )
+        uploads[kwargs['JobId']] = len(rows) - 1
+        return {}
+
+    monkeypatch.setattr(cognito_client, 'get_csv_header', lambda **kwargs: {'CSVHeader': header})
+    monkeypatch.setattr(cognito_client, 'create_user_import_job', lambda **kwargs: {'UserImportJob': {'JobId': 'job-1', 'Status': 'Created', 'PreSignedUrl': 'https://upload'}})
+    monkeypatch.setattr(cognito_client, 'start_user_import_job', start_user_import_job)
+    monkeypatch.setattr(cognito_client, 'describe_user_import_job', lambda **kwargs: {'UserImportJob': {'JobId': 'job-1', 'Status': 'Succeeded', 'ImportedUsers': uploads['job-1'], 'FailedUsers': 1}})
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.user_import.upload_import_csv', upload)
+
+    users = [
+        {
+            'Username': f'user{i}',
+            'Attributes': [
+                {'Name': 'email', 'Value': f'user{i}@example.com'},
+                {'Name': 'email_verified', 'Value': 'True'},
+                {'Name': 'sub', 'Value': f'old-sub-{i}'}
+            ],
+            'Groups': ['TestGroup']
+        }
+        for i in range(4)
+    ]
+    aws_clients.s3_client.put_object(Bucket=aws_clients.bucket_name, Key='import.json', Body=json.dumps({'timestamp': 'now', 'groups': [], 'users': users}))
+    restore = CognitoRestore(aws_clients, import_role_arn='arn:aws:iam::123456789012:role/import', import_min_users=2, import_poll_interval=0)
+    stats = restore.restore_user_pool('import.json', user_pool, restore_mode='auto')
+
+    assert stats['users_imported'] == 3
+    assert stats['users_restored'] == 4
+    assert stats['existing_users'] == 0
+    assert stats['user_group_memberships_restored'] == 4
+    assert stats['import_jobs'][0]['failed_users'] == 1
+    checkpoint = RestoreCheckpoint.load(aws_clients.s3_client, aws_clients.bucket_name, stats['checkpoint_key'])
+    assert sorted(mapping['old_sub'] for mapping in checkpoint.load_mappings()) == [f'old-sub-{i}' for i in range(4)]
+    members = cognito_client.list_users_in_group(UserPoolId=user_pool, GroupName='TestGroup')['Users']
+    assert len(members) == 4
+
+    def no_import_jobs(**kwargs):
+        raise ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'denied'}}, 'GetCSVHeader')
+
+    monkeypatch.setattr(cognito_client, 'get_csv_header', no_import_jobs)
+    users[0]['Username'] = 'fallback-user'
+    aws_clients.s3_client.put_object(Bucket=aws_clients.bucket_name, Key='fallback.json', Body=json.dumps({'timestamp': 'now', 'groups': [], 'users': users[:1]}))
+    stats = restore.restore_user_pool('fallback.json', user_pool, restore_mode='import')
+    assert stats['users_imported'] == 0
+    assert stats['import_jobs'] == []
+    assert stats['users_restored'] == 1
+    assert cognito_client.admin_get_user(UserPoolId=user_pool, Username='fallback-user')
+
+
+@mock_aws
+def test_load_legacy_backup_streams_users(s3_bucket, aws_clients, monkeypatch):
+    """Test that v1 backups are streamed in either field order, reading users-first files twice."""
+    s3_client = aws_clients.s3_client
+    users = [
+        {'Username': f'user{i}', 'Attributes': [{'Name': 'name', 'Value': f'Zo\u00eb "{i}"'}], 'Enabled': True, 'Groups': ['Admins']}
+        for i in range(25)
+    ]
+    groups = [{'GroupName': 'Admins', 'Precedence': 12345}]
+    s3_client.put_object(
+        Bucket=s3_bucket, Key='users-first.json',
+        Body=json.dumps({'timestamp': '2024-01-01T00:00:00', 'users': users, 'groups': groups}, indent=2)
+    )
+    s3_client.put_object(
+        Bucket=s3_bucket, Key='groups-first.json',
+        Body=json.dumps({'timestamp': '2024-01-01T00:00:00', 'groups': groups})[:-1] + ', "users": [' + ','.join(json.dumps(user) for user in users) + ']}'
+    )
+    s3_client.put_object(Bucket=s3_bucket, Key='empty.json', Body=json.dumps({'timestamp': 'now', 'groups': [], 'users': []}))
+
+    reads = []
+    get_object = s3_client.get_object
+    monkeypatch.setattr(s3_client, 'get_object', lambda **kwargs: reads.append(kwargs['Key']) or get_object(**kwargs))
+
+    for key, expected_reads in [('users-first.json', 2), ('groups-first.json', 1)]:
+        backup = load_legacy_backup(s3_client, s3_bucket, key, chunk_size=7)
+        assert backup['groups'] == groups
+        assert backup['timestamp'] == '2024-01-01T00:00:00'
+        assert list(backup['users']) == users
+        assert reads.count(key) == expected_reads
+
+    assert list(load_legacy_backup(s3_client, s3_bucket, 'empty.json')['users']) == []
+
+    s3_client.put_object(Bucket=s3_bucket, Key='broken.json', Body='{"timestamp": "now", "groups": [], "users": [{"Username": ')
+    with pytest.raises(ValueError):
+        list(load_legacy_backup(s3_client, s3_bucket, 'broken.json', chunk_size=7)['users'])
+
+
+@mock_aws
+def test_lambda_handler_resume_interrupted_restore(user_pool, s3_bucket, monkeypatch, aws_region):
+    """Test that a restore interrupted mid-way is finished by the resume operation from its checkpoint."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('REGION', aws_region)
+    monkeypatch.setenv('RESTORE_WORKERS', '2')
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.restore.RESTORE_BATCH_FACTOR', 1)
+    s3_client = boto3.client('s3', region_name=aws_region)
+    users = [
+        {'Username': f'user{i}', 'Attributes': [{'Name': 'sub', 'Value': f'old-sub-{i}'}], 'Groups': []}
+        for i in range(10)
+    ]
+    s3_client.put_object(Bucket=s3_bucket, Key='backup.json', Body=json.dumps({'timestamp': 'now', 'groups': [], 'users': users}))
+
+    created = []
+    interrupted = {'after': 5}
+    # Invocations share their clients through the client registry
+    cognito = AWSClients(Config()).cognito_client
+    admin_create_user = cognito.admin_create_user
+
+    def interrupted_create_user(**kwargs):
+        if interrupted['after'] is not None and len(created) >= interrupted['after']:
+            raise RuntimeError('Lambda timed out')
+        created.append(kwargs['Username'])
+        return admin_create_user(**kwargs)
+
+    monkeypatch.setattr(cognito, 'admin_create_user', interrupted_create_user)
+    with pytest.raises(RuntimeError):
+        lambda_handler({'operation': 'restore', 'backup_key': 'backup.json', 'target_user_pool_id': user_pool}, None)
+
+    checkpoint_key = s3_client.list_objects_v2(Bucket=s3_bucket, Prefix=f'cognito-restores/{user_pool}/')['Contents'][0]['Key']
+    checkpoint = json.loads(s3_client.get_object(Bucket=s3_bucket, Key=checkpoint_key)['Body'].read())
+    assert checkpoint['status'] == 'in_progress'
+    assert checkpoint['users_processed'] == 4
+
+    interrupted['after'] = None
+    response = lambda_handler({'operation': 'resume', 'checkpoint_key': checkpoint_key}, None)
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert body['users_restored'] == 10
+    assert body['existing_users'] == 1
+    assert body['invocations'] == 2
+    assert body['checkpoint_key'] == checkpoint_key
+    assert created.count('user0') == 1
+    mappings = RestoreCheckpoint.load(s3_client, s3_bucket, checkpoint_key).load_mappings()
+    assert sorted(mapping['old_sub'] for mapping in mappings) == sorted(f'old-sub-{i}' for i in range(10))
+
+    response = lambda_handler({'operation': 'resume', 'checkpoint_key': checkpoint_key}, None)
+    assert json.loads(response['body']) == body
+    assert lambda_handler({'operation': 'resume'}, None)['statusCode'] == 400
+
+
+@mock_aws
+def test_lambda_handler_resume_interrupted_backup(user_pool, s3_bucket, monkeypatch, aws_region):
+    """Test that v2 backups interrupted mid-listing are finished by resume from their PaginationToken."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('REGION', aws_region)
+    monkeypatch.setenv('BACKUP_SHARD_SIZE', '2')
+    cognito_client = boto3.client('cognito-idp', region_name=aws_region)
+    s3_client = boto3.client('s3', region_name=aws_region)
+    for i in range(7):
+        cognito_client.admin_create_user(UserPoolId=user_pool, Username=f'user{i}', MessageAction='SUPPRESS')
+
+    calls = []
+    interrupted = {'after': 2}
+    cognito = AWSClients(Config()).cognito_client
+    list_users = cognito.list_users
+
+    def paged_list_users(**kwargs):
+        calls.append(kwargs.get('PaginationToken'))
+        if interrupted['after'] is not None and len(calls) > interrupted['after']:
+            raise RuntimeError('Lambda timed out')
+        return list_users(Limit=2, **kwargs)
+
+    monkeypatch.setattr(cognito, 'list_users', paged_list_users)
+
+    def interrupted_backup(event):
+        calls.clear()
+        with pytest.raises(RuntimeError):
+            lambda_handler(event, None)
+        checkpoint_key = max(
+            obj['Key'] for obj in s3_client.list_objects_v2(Bucket=s3_bucket, Prefix=f'cognito-backups/{user_pool}/')['Contents']
+            if obj['Key'].endswith('/checkpoint.json')
+        )
+        checkpoint = json.loads(s3_client.get_object(Bucket=s3_bucket, Key=checkpoint_key)['Body'].read())
+        assert checkpoint['status'] == 'in_progress'
+        assert checkpoint['pagination_token'] == calls[-1]
+        assert not s3_client.list_objects_v2(Bucket=s3_bucket, Prefix=checkpoint_key.replace('checkpoint.json', 'manifest.json')).get('Contents')
+
+        calls.clear()
+        interrupted['after'] = None
+        response = lambda_handler({'operation': 'resume', 'checkpoint_key': checkpoint_key}, None)
+        interrupted['after'] = 2
+        assert response['statusCode'] == 200
+        assert calls[0] == checkpoint['pagination_token']
+        return json.loads(response['body'])
+
+    body = interrupted_backup({'operation': 'backup', 'user_pool_id': user_pool, 'backup_format': 'v2'})
+    assert body['backup_type'] == 'full'
+    assert body['users_backed_up'] == 7
+    assert body['invocations'] == 2
+    manifest_key = body['backup_location'].split(f's3://{s3_bucket}/')[1]
+    manifest = load_manifest(s3_client, s3_bucket, manifest_key)
+    assert sorted(user['Username'] for user in iter_backup_users(s3_client, s3_bucket, manifest)) == [f'user{i}' for i in range(7)]
+
+    cognito_client.admin_delete_user(UserPoolId=user_pool, Username='user6')
+    body = interrupted_backup({'operation': 'backup', 'user_pool_id': user_pool, 'incremental': True})
+    assert body['backup_type'] == 'incremental'
+    assert body['users_deleted'] == 1
+    assert body['users_unchanged'] == 6
+    manifest_key = body['backup_location'].split(f's3://{s3_bucket}/')[1]
+    manifest = load_manifest(s3_client, s3_bucket, manifest_key)
+    assert sorted(user['Username'] for user in iter_backup_users(s3_client, s3_bucket, manifest, manifest_key)) == [f'user{i}' for i in range(6)]
+
+
+class FakeLambdaContext:
+    """Lambda context whose remaining time runs out after a number of checks."""
+
+    invoked_function_arn = 'arn:aws:lambda:eu-west-2:123456789012:function:cognito-backup-restore'
+
+    def __init__(self, checks):
+        self.checks = checks
+
+    def get_remaining_time_in_millis(self):
+        self.checks -= 1
+        return 300000 if self.checks >= 0 else 1000
+
+
+def user_items(dynamodb_client, table_name):
+    """Scan the application's u#<sub> records, leaving out remap ledger and alias items."""
+    return [
+        item for item in dynamodb_client.scan(TableName=table_name)['Items']
+        if item['PK']['S'].startswith('u#')
+    ]
+
+
+@mock_aws
+def test_lambda_handler_restore_in_time_budget_slices(user_pool, s3_bucket, dynamodb_table, monkeypatch, aws_region):
+    """Test that a restore stops at its time budget and is finished by automatic continuations."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('DYNAMODB_TABLE_NAME', dynamodb_table)
+    monkeypatch.setenv('REGION', aws_region)
+    monkeypatch.setenv('RESTORE_WORKERS', '2')
+    monkeypatch.setenv('AUTO_CONTINUE', 'true')
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.restore.RESTORE_BATCH_FACTOR', 1)
+    s3_client = boto3.client('s3', region_name=aws_region)
+    dynamodb_client = boto3.client('dynamodb', region_name=aws_region)
+    users = [
+        {'Username': f'user{i}', 'Attributes': [{'Name': 'sub', 'Value': f'old-sub-{i}'}], 'Groups': []}
+        for i in range(10)
+    ]
+    s3_client.put_object(Bucket=s3_bucket, Key='backup.json', Body=json.dumps({'timestamp': 'now', 'groups': [], 'users': users}))
+    for i in range(10):
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-sub-{i}'}, 'SK': {'S': f'u#old-sub-{i}'}})
+
+    invocations = []
+    monkeypatch.setattr(
+        AWSClients(Config()).lambda_client, 'invoke',
+        lambda **kwargs: invocations.append(kwargs) or {'StatusCode': 202}
+    )
+
+    event = {'operation': 'restore', 'backup_key': 'backup.json', 'target_user_pool_id': user_pool}
+    phases = []
+    for _ in range(10):
+        response = lambda_handler(event, FakeLambdaContext(checks=3))
+        body = json.loads(response['body'])
+        if response['statusCode'] == 200:
+            break
+        assert response['statusCode'] == 202
+        assert body['continued']
+        phases.append(body['phase'])
+        assert invocations[-1]['InvocationType'] == 'Event'
+        assert invocations[-1]['FunctionName'] == FakeLambdaContext.invoked_function_arn
+        event = json.loads(invocations[-1]['Payload'])
+        assert event == body['continuation']
+
+    assert 'users' in phases and 'remap' in phases
+    assert body['users_restored'] == 10
+    assert body['dynamodb_records_updated'] == 10
+    assert body['invocations'] == len(phases) + 1
+    assert len(user_items(dynamodb_client, dynamodb_table)) == 10
+    assert not any(item['PK']['S'].startswith('u#old-sub') for item in dynamodb_client.scan(TableName=dynamodb_table)['Items'])
+
+
+@mock_aws
+def test_lambda_handler_backup_in_time_budget_slices(user_pool, s3_bucket, monkeypatch, aws_region):
+    """Test that a v2 backup stops at its time budget with a continuation that finishes it."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('REGION', aws_region)
+    cognito_client = boto3.client('cognito-idp', region_name=aws_region)
+    for i in range(7):
+        cognito_client.admin_create_user(UserPoolId=user_pool, Username=f'user{i}', MessageAction='SUPPRESS')
+
+    cognito = AWSClients(Config()).cognito_client
+    list_users = cognito.list_users
+    monkeypatch.setattr(cognito, 'list_users', lambda **kwargs: list_users(Limit=2, **kwargs))
+
+    response = lambda_handler({'operation': 'backup', 'user_pool_id': user_pool, 'backup_format': 'v2'}, FakeLambdaContext(checks=1))
+    assert response['statusCode'] == 202
+    body = json.loads(response['body'])
+    assert body['users_listed'] == 4
+    assert body['shards_written'] == 1
+    assert not body['continued']
+
+    response = lambda_handler(body['continuation'], FakeLambdaContext(checks=100))
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert body['users_backed_up'] == 7
+    assert body['invocations'] == 2
+
+
+@mock_aws
+def test_dynamodb_update_packs_transactions(dynamodb_table, aws_clients, monkeypatch):
+    """Test that record moves are packed into 50-pair transactions and failed transactions are split."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for i in range(120):
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#old-a'}, 'SK': {'S': f'order#{i:03d}'}})
+    dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#old-b'}, 'SK': {'S': 'u#old-b'}})
+
+    transactions = []
+    transact_write_items = dynamodb_client.transact_write_items
+
+    def failing_transact_write_items(**kwargs):
+        keys = [action['Put']['Item']['SK']['S'] for action in kwargs['TransactItems'] if 'Put' in action]
+        transactions.append(len(keys))
+        if 'order#007' in keys:
+            raise ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'cancelled'}}, 'TransactWriteItems')
+        return transact_write_items(**kwargs)
+
+    monkeypatch.setattr(dynamodb_client, 'transact_write_items', failing_transact_write_items)
+    result = DynamoDBUpdate(aws_clients).update_dynamodb_sub([
+        {'username': 'alice', 'old_sub': 'old-a', 'new_sub': 'new-a'},
+        {'username': 'bob', 'old_sub': 'old-b', 'new_sub': 'new-b'}
+    ])
+
+    assert result['records_updated'] == 120
+    assert [failure['sk'] for failure in result['failed_updates']] == ['order#007']
+    assert result['transactions'] == 2 + 6
+    assert transactions[:2] == [50, 25]
+    assert max(transactions) == 50
+    items = user_items(dynamodb_client, dynamodb_table)
+    assert sorted(item['PK']['S'] for item in items if item['PK']['S'] != 'u#new-a') == ['u#new-b', 'u#old-a']
+    assert {'PK': {'S': 'u#new-b'}, 'SK': {'S': 'u#new-b'}} in items
+
+
+@mock_aws
+def test_dynamodb_update_follows_query_pagination(dynamodb_table, aws_clients, monkeypatch):
+    """Test that remap queries read every page of an item collection and keep each collection in key order."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for user in 'abc':
+        for i in range(10):
+            dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-{user}'}, 'SK': {'S': f'{user}#{i:02d}'}})
+
+    query = dynamodb_client.query
+    pages = []
+    monkeypatch.setattr(dynamodb_client, 'query', lambda **kwargs: pages.append(kwargs['ExpressionAttributeValues']) or query(Limit=3, **kwargs))
+    written = []
+    transact_write_items = dynamodb_client.transact_write_items
+    monkeypatch.setattr(dynamodb_client, 'transact_write_items', lambda **kwargs: written.extend(
+        action['Put']['Item']['SK']['S'] for action in kwargs['TransactItems'] if 'Put' in action
+    ) or transact_write_items(**kwargs))
+
+    result = DynamoDBUpdate(aws_clients, max_transaction_pairs=4, max_workers=3).update_dynamodb_sub([
+        {'username': user, 'old_sub': f'old-{user}', 'new_sub': f'new-{user}'} for user in 'abc'
+    ])
+
+    assert result['records_updated'] == 30
+    assert result['mappings_processed'] == 3
+    assert len(pages) == 3 * 4
+    assert written == sorted(written)
+    items = user_items(dynamodb_client, dynamodb_table)
+    assert sorted(item['PK']['S'] for item in items) == sorted(f'u#new-{user}' for user in 'abc' for _ in range(10))
+
+
+@mock_aws
+def test_dynamodb_update_scan_mode_hash_joins_items(dynamodb_table, aws_clients, monkeypatch):
+    """Test that scan mode rewrites only the items whose PK matches a mapping, across every segment."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for user in 'abcdef':
+        for i in range(3):
+            dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-{user}'}, 'SK': {'S': f'{user}#{i}'}})
+    dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#unmapped'}, 'SK': {'S': 'x'}})
+
+    # moto's backend is not thread-safe, so serialise the calls the segments make
+    lock = threading.Lock()
+    segments = []
+    for name in ('scan', 'transact_write_items'):
+        method = getattr(dynamodb_client, name)
+        def locked(method=method, name=name, **kwargs):
+            with lock:
+                if 'Segment' in kwargs:
+                    segments.append((kwargs['Segment'], kwargs['TotalSegments']))
+                return method(**kwargs)
+        monkeypatch.setattr(dynamodb_client, name, locked)
+    monkeypatch.setattr(dynamodb_client, 'query', lambda **kwargs: pytest.fail('scan mode must not query'))
+
+    mappings = [{'username': user, 'old_sub': f'old-{user}', 'new_sub': f'new-{user}'} for user in 'abcde']
+    mappings.append({'username': 'same', 'old_sub': 'same', 'new_sub': 'same'})
+    result = DynamoDBUpdate(aws_clients, max_workers=3, remap_mode='scan').update_dynamodb_sub(mappings)
+
+    assert sorted(segments) == [(0, 3), (1, 3), (2, 3)]
+    assert result['records_updated'] == 15
+    assert result['mappings_processed'] == 6
+    assert result['skipped_updates'] == 1
+    assert result['failed_updates'] == []
+    items = dynamodb_client.scan(TableName=dynamodb_table)['Items']
+    assert sorted(item['PK']['S'] for item in items) == sorted(
+        [f'u#new-{user}' for user in 'abcde' for _ in range(3)] + ['u#old-f'] * 3 + ['u#unmapped']
+    )
+
+
+@mock_aws
+def test_dynamodb_update_auto_mode_picks_scan_for_large_share(dynamodb_table, aws_clients, monkeypatch):
+    """Test that auto remap mode scans only when the mappings are a large share of the table."""
+    update = DynamoDBUpdate(aws_clients)
+    item_count = {'ItemCount': 20000}
+    monkeypatch.setattr(aws_clients.dynamodb_client, 'describe_table', lambda **kwargs: {'Table': item_count})
+
+    assert update._use_scan(999) is False
+    assert update._use_scan(1999) is False
+    assert update._use_scan(2000) is True
+    item_count['ItemCount'] = 0
+    assert update._use_scan(5000) is False
+    assert DynamoDBUpdate(aws_clients, remap_mode='query')._use_scan(10 ** 6) is False
+    assert DynamoDBUpdate(aws_clients, remap_mode='scan')._use_scan(1) is True
+
+
+@mock_aws
+def test_dynamodb_update_batch_write_mode(dynamodb_table, aws_clients, monkeypatch):
+    """Test that batch write mode retries unprocessed writes and keeps old records whose new copy is unconfirmed."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for user in 'abc':
+        for i in range(20):
+            dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-{user}'}, 'SK': {'S': f'{user}#{i:02d}'}})
+
+    batch_sizes = []
+    batch_write_item = dynamodb_client.batch_write_item
+    def throttled_batch_write_item(RequestItems, **kwargs):
+        requests = RequestItems[dynamodb_table]
+        batch_sizes.append(len(requests))
+        if len(batch_sizes) == 1:
+            # Leave the last request unprocessed, as a throttled batch would
+            batch_write_item(RequestItems={dynamodb_table: requests[:-1]})
+            return {'UnprocessedItems': {dynamodb_table: requests[-1:]}}
+        return batch_write_item(RequestItems=RequestItems, **kwargs)
+    monkeypatch.setattr(dynamodb_client, 'batch_write_item', throttled_batch_write_item)
+    batch_get_item = dynamodb_client.batch_get_item
+    def unconfirmed_batch_get_item(RequestItems):
+        response = batch_get_item(RequestItems=RequestItems)
+        response['Responses'][dynamodb_table] = [
+            item for item in response['Responses'][dynamodb_table] if item['SK']['S'] != 'c#19'
+        ]
+        return response
+    monkeypatch.setattr(dynamodb_client, 'batch_get_item', unconfirmed_batch_get_item)
+    monkeypatch.setattr(dynamodb_client, 'transact_write_items', lambda **kwargs: pytest.fail('batch mode must not use transactions'))
+
+    result = DynamoDBUpdate(aws_clients, remap_mode='query', write_mode='batch', write_capacity_units=10000).update_dynamodb_sub([
+        {'username': user, 'old_sub': f'old-{user}', 'new_sub': f'new-{user}'} for user in 'abc'
+    ])
+
+    assert max(batch_sizes) == 25
+    assert batch_sizes[1] == 1
+    assert result['records_updated'] == 59
+    assert result['mappings_processed'] == 3
+    assert result['write_mode'] == 'batch'
+    assert result['transactions'] == 0
+    assert result['records_per_second'] > 0
+    assert [(failure['username'], failure['sk']) for failure in result['failed_updates']] == [('c', 'c#19')]
+    keys = {(item['PK']['S'], item['SK']['S']) for item in user_items(dynamodb_client, dynamodb_table)}
+    assert len(keys) == 61
+    assert ('u#old-c', 'c#19') in keys and ('u#new-c', 'c#19') in keys
+
+
+@mock_aws
+def test_dynamodb_update_paces_writes_to_table_capacity(dynamodb_table, aws_clients, monkeypatch):
+    """Test that remap writes are paced to a share of the table's capacity and throttled transactions are retried."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for i in range(6):
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#old'}, 'SK': {'S': f'r#{i}'}})
+
+    monkeypatch.setattr(dynamodb_client, 'describe_table', lambda **kwargs: {'Table': {
+        'ProvisionedThroughput': {'WriteCapacityUnits': 400},
+        'GlobalSecondaryIndexes': [{'ProvisionedThroughput': {'WriteCapacityUnits': 200}}]
+    }})
+    transact_write_items = dynamodb_client.transact_write_items
+    calls = []
+    def throttled_transact_write_items(**kwargs):
+        calls.append(kwargs['ReturnConsumedCapacity'])
+        if len(calls) == 1:
+            raise ClientError({
+                'Error': {'Code': 'TransactionCanceledException', 'Message': 'Throttled'},
+                'CancellationReasons': [{'Code': 'ThrottlingError'}, {'Code': 'None'}]
+            }, 'TransactWriteItems')
+        return transact_write_items(**kwargs)
+    monkeypatch.setattr(dynamodb_client, 'transact_write_items', throttled_transact_write_items)
+
+    update = DynamoDBUpdate(aws_clients, max_transaction_pairs=3, write_capacity_fraction=0.25)
+    assert update._write_capacity_units() == 200
+    result = update.update_dynamodb_sub([{'username': 'user', 'old_sub': 'old', 'new_sub': 'new'}])
+
+    assert result['records_updated'] == 6
+    assert result['failed_updates'] == []
+    assert calls == ['TOTAL'] * 3
+    assert result['throttled_writes'] == 1
+    assert result['write_capacity_rate'] == 25.0
+    # 6 records at 4 units each, plus the remap ledger entry
+    assert result['write_capacity_units'] == 25.0
+    assert result['capacity_wait_seconds'] >= 0
+
+
+@mock_aws
+def test_dynamodb_update_alias_mode_and_resolver(dynamodb_table, aws_clients, monkeypatch):
+    """Test that alias mode leaves records in place and the resolver follows aliases through its cache."""
+    dynamodb_client = aws_clients.dynamodb_client
+    dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#old-a'}, 'SK': {'S': 'profile'}})
+    update = DynamoDBUpdate(aws_clients, remap_mode='alias')
+
+    result = update.update_dynamodb_sub([
+        {'username': 'a', 'old_sub': 'old-a', 'new_sub': 'new-a'},
+        {'username': 'b', 'old_sub': 'old-b', 'new_sub': 'new-b'},
+        {'username': 'c', 'old_sub': 'same', 'new_sub': 'same'}
+    ])
+    assert result['aliases_written'] == 2
+    assert result['records_updated'] == 0
+    assert result['skipped_updates'] == 1
+    assert result['mappings_processed'] == 3
+    # A second restore of user a chains a new alias onto the first
+    update.update_dynamodb_sub([{'username': 'a', 'old_sub': 'new-a', 'new_sub': 'newer-a'}])
+    assert dynamodb_client.get_item(TableName=dynamodb_table, Key={'PK': {'S': 'u#old-a'}, 'SK': {'S': 'profile'}}).get('Item')
+
+    lookups = []
+    batch_get_item = dynamodb_client.batch_get_item
+    monkeypatch.setattr(dynamodb_client, 'batch_get_item', lambda **kwargs: lookups.append(kwargs) or batch_get_item(**kwargs))
+    resolver = SubAliasResolver(dynamodb_client, dynamodb_table, cache_size=3)
+    assert resolver.resolve_many(['old-a', 'old-b', 'unknown']) == {'old-a': 'newer-a', 'old-b': 'new-b', 'unknown': 'unknown'}
+    assert len(lookups) == 3
+    assert resolver.resolve('old-a') == 'newer-a'
+    assert len(lookups) == 3
+    assert resolver.cache_info() == {'hits': 1, 'misses': 3, 'size': 3, 'max_size': 3}
+
+    # 'unknown' is now the least recently used entry and is evicted first
+    resolver.resolve('other')
+    assert resolver.cache_info()['size'] == 3
+    resolver.resolve('old-b')
+    assert len(lookups) == 4
+    resolver.resolve('unknown')
+    assert len(lookups) == 5
+
+
+@mock_aws
+def test_lambda_handler_restore_queues_remap_for_worker(user_pool, s3_bucket, dynamodb_table, monkeypatch, aws_region):
+    """Test that a restore with a remap queue publishes its mappings and the remap_worker operation applies them."""
+    queue_url = boto3.client('sqs', region_name=aws_region).create_queue(QueueName='remap')['QueueUrl']
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('DYNAMODB_TABLE_NAME', dynamodb_table)
+    monkeypatch.setenv('REGION', aws_region)
+    monkeypatch.setenv('REMAP_QUEUE_URL', queue_url)
+    monkeypatch.setenv('REMAP_CHUNK_SIZE', '2')
+    monkeypatch.setenv('REMAP_QUEUE_WAIT_SECONDS', '1')
+    # moto's backends are not thread-safe; keep the worker's writes sequential
+    monkeypatch.setenv('RESTORE_WORKERS', '1')
+    s3_client = boto3.client('s3', region_name=aws_region)
+    dynamodb_client = boto3.client('dynamodb', region_name=aws_region)
+    users = [
+        {'Username': f'user{i}', 'Attributes': [{'Name': 'sub', 'Value': f'old-sub-{i}'}], 'Groups': []}
+        for i in range(5)
+    ]
+    s3_client.put_object(Bucket=s3_bucket, Key='backup.json', Body=json.dumps({'timestamp': 'now', 'groups': [], 'users': users}))
+    for i in range(5):
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-sub-{i}'}, 'SK': {'S': 'profile'}})
+
+    response = lambda_handler({'operation': 'restore', 'backup_key': 'backup.json', 'target_user_pool_id': user_pool}, None)
+    body = json.loads(response['body'])
+    assert body['status'] == 'success'
+    assert body['dynamodb_remap_queued'] == 5
+    assert body['dynamodb_remap_messages'] == 3
+    assert body['dynamodb_records_updated'] == 0
+    assert all(item['PK']['S'].startswith('u#old-sub') for item in dynamodb_client.scan(TableName=dynamodb_table)['Items'])
+
+    response = lambda_handler({'operation': 'remap_worker'}, None)
+    body = json.loads(response['body'])
+    assert response['statusCode'] == 200
+    assert body['queue_drained']
+    assert body['messages_processed'] == 3
+    assert body['records_updated'] == 5
+    assert not any(item['PK']['S'].startswith('u#old-sub') for item in dynamodb_client.scan(TableName=dynamodb_table)['Items'])
+
+
+@mock_aws
+def test_remap_worker_reports_partial_batch_failures(dynamodb_table, aws_clients):
+    """Test that the remap worker reports failed SQS records and releases failed messages when draining."""
+    dynamodb_client = aws_clients.dynamodb_client
+    dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#old-a'}, 'SK': {'S': 'profile'}})
+    worker = RemapWorker(DynamoDBUpdate(aws_clients), max_workers=2)
+    good = json.dumps({'checkpoint_key': 'restore', 'first_mapping': 0,
+                       'mappings': [{'username': 'a', 'old_sub': 'old-a', 'new_sub': 'new-a'}]})
+
+    result = worker.process_records([
+        {'messageId': 'm1', 'eventSource': 'aws:sqs', 'body': good},
+        {'messageId': 'm2', 'eventSource': 'aws:sqs', 'body': 'not json'}
+    ])
+    assert result['batchItemFailures'] == [{'itemIdentifier': 'm2'}]
+    assert result['records_updated'] == 1
+    # Redelivery of a processed message finds nothing left to move
+    assert worker.process_records([{'messageId': 'm1', 'body': good}])['batchItemFailures'] == []
+
+    queue = LocalRemapQueue()
+    queue.send_batch([good, '{"mappings": 1}'])
+    result = worker.drain(queue)
+    assert result['messages_processed'] == 1
+    assert result['messages_failed'] == 1
+    assert not result['queue_drained']
+    assert len(queue) == 1
+
+
+@mock_aws
+def test_dynamodb_update_retries_are_idempotent(dynamodb_table, aws_clients, monkeypatch):
+    """Test that half-moved records count as already migrated and the remap ledger skips finished users."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for sk in ('profile', 'settings', 'orders'):
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#old-a'}, 'SK': {'S': sk}, 'v': {'S': 'old'}})
+    # An earlier non-transactional run already wrote the new copy of one record
+    dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#new-a'}, 'SK': {'S': 'settings'}, 'v': {'S': 'old'}})
+    tokens = []
+    transact_write_items = dynamodb_client.transact_write_items
+    monkeypatch.setattr(dynamodb_client, 'transact_write_items', lambda **kwargs: tokens.append(kwargs['ClientRequestToken']) or transact_write_items(**kwargs))
+    query = dynamodb_client.query
+    # Another worker moves the orders record between the query and the write
+    def racing_query(**kwargs):
+        response = query(**kwargs)
+        dynamodb_client.delete_item(TableName=dynamodb_table, Key={'PK': {'S': 'u#old-a'}, 'SK': {'S': 'orders'}})
+        return response
+    monkeypatch.setattr(dynamodb_client, 'query', racing_query)
+    mappings = [{'username': 'a', 'old_sub': 'old-a', 'new_sub': 'new-a'}]
+
+    result = DynamoDBUpdate(aws_clients).update_dynamodb_sub(mappings)
+
+    assert result['records_updated'] == 1
+    assert result['already_migrated'] == 2
+    assert result['failed_updates'] == []
+    assert len(tokens) == 2 and len(tokens[0]) == 36
+    assert {(item['SK']['S'], item['v']['S']) for item in user_items(dynamodb_client, dynamodb_table)} == {('profile', 'old'), ('settings', 'old')}
+    assert all(item['PK']['S'] == 'u#new-a' for item in user_items(dynamodb_client, dynamodb_table))
+
+    monkeypatch.setattr(dynamodb_client, 'query', lambda **kwargs: pytest.fail('finished users must not be queried again'))
+    result = DynamoDBUpdate(aws_clients).update_dynamodb_sub(mappings)
+    assert result['users_already_migrated'] == 1
+    assert result['mappings_processed'] == 1
+    assert result['records_updated'] == 0
+    assert DynamoDBUpdate._request_token([{'old_pk': 'u#x', 'old_sk': 's', 'new_item': {'PK': {'S': 'u#y'}}}]) == \
+        DynamoDBUpdate._request_token([{'old_pk': 'u#x', 'old_sk': 's', 'new_item': {'PK': {'S': 'u#y'}}}])
+
+
+@mock_aws
+def test_dynamodb_update_profile_probe_skips_users_without_records(dynamodb_table, aws_clients, monkeypatch):
+    """Test that the profile probe queries only users with a profile record, in one batched lookup."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for user in 'ab':
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-{user}'}, 'SK': {'S': f'u#old-{user}'}})
+    dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#old-a'}, 'SK': {'S': 'orders'}})
+    queried = []
+    query = dynamodb_client.query
+    monkeypatch.setattr(dynamodb_client, 'query', lambda **kwargs: queried.append(kwargs['ExpressionAttributeValues'][':old_sub']['S']) or query(**kwargs))
+    probes = []
+    batch_get_item = dynamodb_client.batch_get_item
+    monkeypatch.setattr(dynamodb_client, 'batch_get_item', lambda **kwargs: probes.append(kwargs) or batch_get_item(**kwargs))
+
+    result = DynamoDBUpdate(aws_clients, probe_profile=True).update_dynamodb_sub([
+        {'username': user, 'old_sub': f'old-{user}', 'new_sub': f'new-{user}'} for user in 'abcde'
+    ])
+
+    assert sorted(queried) == ['u#old-a', 'u#old-b']
+    assert len(probes) == 1
+    assert len(probes[0]['RequestItems'][dynamodb_table]['Keys']) == 10
+    assert result['users_without_records'] == 3
+    assert result['mappings_processed'] == 5
+    assert result['records_updated'] == 3
+    assert sorted(item['PK']['S'] for item in user_items(dynamodb_client, dynamodb_table)) == ['u#new-a', 'u#new-a', 'u#new-b']
+
+
+@mock_aws
+def test_sub_mapping_store_sorts_and_remaps_by_scan(dynamodb_table, aws_clients, tmp_path):
+    """Test that the sub mapping store sorts in runs, looks up by old sub, slices, and drives a scan remap."""
+    mappings = [{'username': f'user-é{i}', 'old_sub': f'old-{i:04d}', 'new_sub': f'new-{i:04d}'} for i in range(250, -1, -1)]
+    store = SubMappingStore.build(iter(mappings), str(tmp_path), run_records=40)
+
+    assert len(store) == 251
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['sub-mapping-usernames.bin', 'sub-mappings.bin']
+    assert [mapping['old_sub'] for mapping in store] == [f'old-{i:04d}' for i in range(251)]
+    assert store[-1] == {'username': 'user-é250', 'old_sub': 'old-0250', 'new_sub': 'new-0250'}
+    assert store.lookup('old-0123')['username'] == 'user-é123'
+    assert store.lookup('old-9999') is None
+    view = store[100:]
+    assert len(view) == 151 and view[0]['old_sub'] == 'old-0100'
+    assert view.lookup('old-0099') is None and view.lookup('old-0100') is not None
+
+    dynamodb_client = aws_clients.dynamodb_client
+    for i in (5, 150):
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-{i:04d}'}, 'SK': {'S': 'profile'}})
+    result = DynamoDBUpdate(aws_clients, max_workers=1, remap_mode='scan').update_dynamodb_sub(view)
+
+    assert result['records_updated'] == 1
+    assert result['mappings_processed'] == 151
+    assert sorted(item['PK']['S'] for item in user_items(dynamodb_client, dynamodb_table)) == ['u#new-0150', 'u#old-0005']
+    store.close()
+    assert list(tmp_path.iterdir()) == []
+    with pytest.raises(ValueError):
+        SubMappingStore.build([{'username': 'x', 'old_sub': 'x' * 37, 'new_sub': 'y'}], str(tmp_path))
+
+
+@mock_aws
+def test_sub_mapping_artifact_resolves_subs_with_ranged_gets(s3_bucket, aws_clients, tmp_path, monkeypatch):
+    """Test that the sub mapping artifact is block-compressed, indexed and read back with ranged GETs."""
+    s3_client = aws_clients.s3_client
+    mappings = [{'username': f'user{i}', 'old_sub': f'old-{i:02d}', 'new_sub': f'new-{i:02d}'} for i in range(10)]
+    store = SubMappingStore.build(reversed(mappings), str(tmp_path))
+    prefix = artifact_prefix('cognito-backups/pool/2025-01-01/manifest.json', 'target', 'restore-1')
+    assert prefix == 'cognito-backups/pool/2025-01-01/sub-mappings/target/restore-1'
+    assert artifact_prefix('cognito-backups/pool/2025-01-01.json', 'target', 'r').startswith('cognito-backups/pool/2025-01-01/')
+    index_key = write_sub_mapping_artifact(s3_client, s3_bucket, prefix, store, {'backup_key': 'b'}, block_records=4)
+    store.close()
+
+    blocks = s3_client.get_object(Bucket=s3_bucket, Key=f'{prefix}/mappings.ndjson.gz')['Body'].read()
+    assert [json.loads(line)[0] for line in gzip.decompress(blocks).splitlines()] == [m['old_sub'] for m in mappings]
+
+    ranges = []
+    get_object = s3_client.get_object
+    monkeypatch.setattr(s3_client, 'get_object', lambda **kwargs: ranges.append(kwargs.get('Range')) or get_object(**kwargs))
+    artifact = SubMappingArtifact.load(s3_client, s3_bucket, index_key)
+    assert len(artifact) == 10 and artifact.index['backup_key'] == 'b'
+    assert [entry[0] for entry in artifact.index['blocks']] == ['old-00', 'old-04', 'old-08']
+    assert artifact.lookup('old-05') == {'username': 'user5', 'old_sub': 'old-05', 'new_sub': 'new-05'}
+    assert artifact.lookup('old-07')['new_sub'] == 'new-07'
+    assert artifact.lookup('a') is None and artifact.lookup('old-99') is None
+    found = artifact.lookup_many(['old-09', 'old-01', 'old-03', 'missing'])
+    assert sorted(found) == ['old-01', 'old-03', 'old-09']
+    assert ranges[0] is None and all(r.startswith('bytes=') for r in ranges[1:])
+    assert artifact.blocks_read == len(ranges) - 1 == 4
+
+
+@mock_aws
+def test_lambda_handler_reuses_clients_across_invocations(s3_bucket, monkeypatch, aws_region, client_registry):
+    """Test that warm invocations reuse the registry's clients, created lazily on first use."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('REGION', aws_region)
+    created = []
+    client = boto3.client
+    monkeypatch.setattr(boto3, 'client', lambda *args, **kwargs: created.append(args[0]) or client(*args, **kwargs))
+
+    for _ in range(3):
+        response = lambda_handler({'operation': 'verify', 'backup_key': 'missing/manifest.json'}, None)
+        assert response['statusCode'] == 500
+    assert created == ['s3']
+    assert client_registry.stats() == {'hits': 2, 'misses': 1, 'clients': 1}
+
+    clients = AWSClients(Config())
+    assert clients.s3_client is clients.s3_client
+    assert clients.cognito_client is not AWSClients(Config(), registry=ClientRegistry()).cognito_client
+    assert client_registry.stats() == {'hits': 4, 'misses': 2, 'clients': 2}
+
+    # Clients are keyed by the value of their botocore settings, not the Config object
+    registry = ClientRegistry()
+    first = registry.client('s3', aws_region, BotoConfig(retries={'mode': 'standard', 'max_attempts': 1}))
+    assert registry.client('s3', aws_region, BotoConfig(retries={'max_attempts': 1, 'mode': 'standard'})) is first
+    assert registry.client('s3', aws_region, BotoConfig(retries={'mode': 'standard', 'max_attempts': 2})) is not first
+    assert registry.client('s3', aws_region) is not first
+    assert registry.stats() == {'hits': 1, 'misses': 3, 'clients': 3}
+
+
+@mock_aws
+def test_record_backup_keeps_entries_of_overlapping_backups(s3_bucket, aws_clients, monkeypatch):
+    """Test that every backup records its own catalog entry, so a backup finishing concurrently is not lost."""
+    s3_client = aws_clients.s3_client
+    record_backup(s3_client, s3_bucket, 'pool', {'manifest_key': 'first'})
+    put_object = s3_client.put_object
+    puts = []
+
+    def racing_put(**kwargs):
+        puts.append(kwargs)
+        if len(puts) == 1:
+            # Another backup of the pool records itself while ours is being written
+            record_backup(s3_client, s3_bucket, 'pool', {'manifest_key': 'concurrent'})
+        return put_object(**kwargs)
+
+    monkeypatch.setattr(s3_client, 'put_object', racing_put)
+    record_backup(s3_client, s3_bucket, 'pool', {'manifest_key': 'second'})
+
+    # Only parameters the pinned boto3 (1.34) knows are used: no conditional writes
+    assert set(puts[0]) == {'Bucket', 'Key', 'Body', 'ContentType'}
+    assert puts[0]['Key'] != puts[1]['Key']
+    # Entries sort by the time they were recorded; ours was named before the concurrent one
+    assert [entry['manifest_key'] for entry in load_catalog(s3_client, s3_bucket, 'pool')['backups']] == ['first', 'second', 'concurrent']
+
+
+def test_aimd_controller_retries_transient_errors_and_paces_outside_slots():
+    """Test that AIMDController retries 5xx errors without throttling and paces before taking a slot."""
+    controller = AIMDController(max_limit=1, initial_limit=1, base_delay=0.001, max_delay=0.001)
+    attempts = []
+
+    def failing_once():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ClientError(
+                {'Error': {'Code': 'InternalErrorException', 'Message': 'boom'},
+                 'ResponseMetadata': {'HTTPStatusCode': 500}},
+                'DescribeUserPool'
+            )
+        return 'described'
+
+    assert controller.call(failing_once) == 'described'
+    stats = controller.stats()
+    assert stats['retries'] == 1
+    assert stats['throttles'] == 0
+    assert stats['concurrency_limit'] == 1
+
+    in_flight_while_pacing = []
+
+    def pace():
+        in_flight_while_pacing.append(controller._in_flight)
+
+    assert controller.call_paced(pace, lambda: 'ok') == 'ok'
+    assert in_flight_while_pacing == [0]
+
+    # Failures other than throttles leave the limit where it was
+    controller = AIMDController(max_limit=8, initial_limit=1, max_retries=3, base_delay=0.001, max_delay=0.001)
+
+    def failing():
+        raise ClientError(
+            {'Error': {'Code': 'InternalErrorException', 'Message': 'boom'},
+             'ResponseMetadata': {'HTTPStatusCode': 500}},
+            'DescribeUserPool'
+        )
+
+    def not_found():
+        raise ClientError({'Error': {'Code': 'UserNotFoundException', 'Message': 'gone'}}, 'AdminGetUser')
+
+    with pytest.raises(ClientError):
+        controller.call(failing)
+    with pytest.raises(ClientError):
+        controller.call(not_found)
+    assert controller.stats()['calls'] == 5
+    assert controller.stats()['concurrency_limit'] == 1
+    controller.call(lambda: 'ok')
+    assert controller.stats()['concurrency_limit'] == 2
+
+
+@mock_aws
+def test_cognito_restore_import_jobs_resume_after_time_budget(user_pool, aws_clients, monkeypatch):
+    """Test that import jobs are recorded before polling, waited for again on resume, and only missing memberships are added."""
+    cognito_client = aws_clients.cognito_client
+    cognito_client.create_group(GroupName='TestGroup', UserPoolId=user_pool)
+    add_user_to_group = cognito_client.admin_add_user_to_group
+    statuses = iter(['InProgress', 'Succeeded'])
+    started, added = [], []
+
+    def start_user_import_job(**kwargs):
+        started.append(kwargs['JobId'])
+        for i in range(2):
+            cognito_client.admin_create_user(UserPoolId=user_pool, Username=f'user{i}', MessageAction='SUPPRESS')
+        add_user_to_group(UserPoolId=user_pool, Username='user0', GroupName='TestGroup')
+        return {}
+
+    monkeypatch.setattr(cognito_client, 'get_csv_header', lambda **kwargs: {'CSVHeader': ['cognito:username', 'email']})
+    monkeypatch.setattr(cognito_client, 'create_user_import_job', lambda **kwargs: {'UserImportJob': {'JobId': 'job-1', 'Status': 'Created', 'PreSignedUrl': 'https://upload'}})
+    monkeypatch.setattr(cognito_client, 'start_user_import_job', start_user_import_job)
+    monkeypatch.setattr(cognito_client, 'describe_user_import_job', lambda **kwargs: {'UserImportJob': {'JobId': 'job-1', 'Status': next(statuses), 'ImportedUsers': 2}})
+    monkeypatch.setattr(cognito_client, 'admin_add_user_to_group', lambda **kwargs: added.append(kwargs['Username']) or add_user_to_group(**kwargs))
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.user_import.upload_import_csv', lambda url, path: None)
+
+    users = [
+        {'Username': f'user{i}', 'Attributes': [{'Name': 'sub', 'Value': f'old-sub-{i}'}], 'Groups': ['TestGroup']}
+        for i in range(2)
+    ]
+    aws_clients.s3_client.put_object(Bucket=aws_clients.bucket_name, Key='import-budget.json', Body=json.dumps({'timestamp': 'now', 'groups': [{'GroupName': 'TestGroup'}], 'users': users}))
+    role_arn = 'arn:aws:iam::123456789012:role/import'
+    restore = CognitoRestore(aws_clients, import_role_arn=role_arn, import_poll_interval=0, time_budget=TimeBudget(FakeLambdaContext(checks=0)))
+    result = restore.restore_user_pool('import-budget.json', user_pool, restore_mode='import')
+
+    assert result['status'] == 'in_progress'
+    assert result['phase'] == 'import'
+    checkpoint = RestoreCheckpoint.load(aws_clients.s3_client, aws_clients.bucket_name, result['checkpoint_key'])
+    assert [(job['job_id'], job['status']) for job in checkpoint.state['import_jobs']] == [('job-1', 'Pending')]
+
+    resumed = CognitoRestore(aws_clients, import_role_arn=role_arn, import_poll_interval=0).resume_user_pool(checkpoint)
+    assert resumed['status'] == 'success'
+    assert started == ['job-1']
+    assert resumed['users_imported'] == 2
+    assert resumed['user_group_memberships_restored'] == 2
+    assert added == ['user1']
+
+
+@mock_aws
+def test_backup_membership_index_is_budgeted_and_saved_for_resume(user_pool, s3_bucket, monkeypatch, aws_region):
+    """Test that resumed v2 backups reuse the saved membership index and fall back to per-user lookups when the budget runs out while indexing."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('REGION', aws_region)
+    monkeypatch.setenv('BACKUP_FORMAT', 'v2')
+    cognito_client = boto3.client('cognito-idp', region_name=aws_region)
+    cognito_client.create_group(GroupName='TestGroup', UserPoolId=user_pool)
+    for i in range(5):
+        cognito_client.admin_create_user(UserPoolId=user_pool, Username=f'user{i}', MessageAction='SUPPRESS')
+        cognito_client.admin_add_user_to_group(UserPoolId=user_pool, Username=f'user{i}', GroupName='TestGroup')
+
+    cognito = AWSClients(Config()).cognito_client
+    list_users = cognito.list_users
+    list_users_in_group = cognito.list_users_in_group
+    group_listings = []
+    monkeypatch.setattr(cognito, 'list_users', lambda **kwargs: list_users(Limit=2, **kwargs))
+    monkeypatch.setattr(cognito, 'list_users_in_group', lambda **kwargs: group_listings.append(kwargs['GroupName']) or list_users_in_group(**kwargs))
+    s3_client = boto3.client('s3', region_name=aws_region)
+
+    for checks, strategy, listings in [(2, 'group', 1), (0, 'user', 1)]:
+        group_listings.clear()
+        body = json.loads(lambda_handler({'operation': 'backup', 'user_pool_id': user_pool}, FakeLambdaContext(checks=checks))['body'])
+        assert body['status'] == 'in_progress'
+        response = lambda_handler(body['continuation'], FakeLambdaContext(checks=100))
+        assert response['statusCode'] == 200
+        body = json.loads(response['body'])
+        assert body['backup_format'] == 'v2'
+        assert body['membership_strategy'] == strategy
+        assert len(group_listings) == listings
+        manifest_key = body['backup_location'].split(f's3://{s3_bucket}/')[1]
+        users = iter_backup_users(s3_client, s3_bucket, load_manifest(s3_client, s3_bucket, manifest_key), manifest_key)
+        assert {user['Username']: user['Groups'] for user in users} == {f'user{i}': ['TestGroup'] for i in range(5)}
+
+
+@mock_aws
+def test_cognito_restore_prescan_index_is_saved_for_resume(user_pool, aws_clients, monkeypatch):
+    """Test that a resumed pre-scanned restore loads the saved target index instead of scanning the pool again."""
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.restore.RESTORE_BATCH_FACTOR', 1)
+    cognito_client = aws_clients.cognito_client
+    for username in ['user2', 'user3']:
+        cognito_client.admin_create_user(UserPoolId=user_pool, Username=username, MessageAction='SUPPRESS')
+    users = [
+        {'Username': f'user{i}', 'Attributes': [{'Name': 'sub', 'Value': f'old-sub-{i}'}], 'Groups': []}
+        for i in range(4)
+    ]
+    aws_clients.s3_client.put_object(Bucket=aws_clients.bucket_name, Key='prescan.json', Body=json.dumps({'timestamp': 'now', 'groups': [], 'users': users}))
+    result = CognitoRestore(aws_clients, max_workers=1, time_budget=TimeBudget(FakeLambdaContext(checks=0))).restore_user_pool('prescan.json', user_pool, prescan=True)
+    assert result['status'] == 'in_progress'
+
+    list_users_calls = []
+    list_users = cognito_client.list_users
+    admin_get_user_calls = []
+    admin_get_user = cognito_client.admin_get_user
+    monkeypatch.setattr(cognito_client, 'list_users', lambda **kwargs: list_users_calls.append(kwargs) or list_users(**kwargs))
+    monkeypatch.setattr(cognito_client, 'admin_get_user', lambda **kwargs: admin_get_user_calls.append(kwargs) or admin_get_user(**kwargs))
+    checkpoint = RestoreCheckpoint.load(aws_clients.s3_client, aws_clients.bucket_name, result['checkpoint_key'])
+    resumed = CognitoRestore(aws_clients, max_workers=1).resume_user_pool(checkpoint)
+
+    assert resumed['status'] == 'success'
+    assert list_users_calls == []
+    assert admin_get_user_calls == []
+    assert resumed['users_restored'] == 4
+    assert resumed['existing_users'] == 2
+
+
+@mock_aws
+def test_dynamodb_update_scan_resumes_from_segment_positions(dynamodb_table, aws_clients, monkeypatch):
+    """Test that a scan remap stopped by its budget continues from each segment's LastEvaluatedKey and records scan errors."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for user in 'abcd':
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-{user}'}, 'SK': {'S': f'u#old-{user}'}})
+    scan = dynamodb_client.scan
+    start_keys = []
+    monkeypatch.setattr(dynamodb_client, 'scan', lambda **kwargs: start_keys.append(kwargs.get('ExclusiveStartKey')) or scan(Limit=2, **kwargs))
+    mappings = [{'username': user, 'old_sub': f'old-{user}', 'new_sub': f'new-{user}'} for user in 'abcd']
+
+    update = DynamoDBUpdate(aws_clients, max_workers=1, remap_mode='scan')
+    first = update.update_dynamodb_sub(mappings, TimeBudget(FakeLambdaContext(checks=1)))
+    assert first['records_updated'] == 2
+    assert first['mappings_processed'] == 0
+    assert first['scan_position']['segments'][0]['done'] is False
+    assert json.loads(json.dumps(first['scan_position'])) == first['scan_position']
+
+    start_keys.clear()
+    second = update.update_dynamodb_sub(mappings, None, first['scan_position'])
+    assert start_keys[0] == first['scan_position']['segments'][0]['start_key']
+    assert second['records_updated'] == 2
+    assert second['mappings_processed'] == 4
+    assert second['scan_position'] is None
+
+    def failing_scan(**kwargs):
+        raise ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'denied'}}, 'Scan')
+
+    monkeypatch.setattr(dynamodb_client, 'scan', failing_scan)
+    failed = update.update_dynamodb_sub(mappings)
+    assert failed['scan_position'] is None
+    assert failed['failed_updates'][0]['segment'] == 0
+    assert 'AccessDenied' in failed['failed_updates'][0]['error']
+
+
+def test_remap_worker_queries_instead_of_scanning(aws_clients, monkeypatch):
+    """Test that remap workers never scan the table per message, without changing the updater they are given."""
+    update = DynamoDBUpdate(aws_clients, remap_mode='scan')
+    assert RemapWorker(update).remap_mode == 'query'
+    assert update.remap_mode == 'scan'
+    assert RemapWorker(DynamoDBUpdate(aws_clients, remap_mode='auto')).remap_mode == 'query'
+    assert RemapWorker(DynamoDBUpdate(aws_clients, remap_mode='alias')).remap_mode == 'alias'
+
+    modes = []
+    monkeypatch.setattr(update, 'update_dynamodb_sub', lambda mappings, time_budget, remap_mode=None: modes.append(remap_mode) or {'mappings_processed': 0, 'failed_updates': []})
+    body = json.dumps({'checkpoint_key': 'restore', 'first_mapping': 0, 'mappings': []})
+    RemapWorker(update).process_records([{'messageId': 'm1', 'body': body}])
+    assert modes == ['query']
+
+
+@mock_aws
+def test_dynamodb_update_moves_items_with_binary_attributes(dynamodb_table, aws_clients):
+    """Test that items with B and BS attributes are sized, tokenised and moved in both write modes."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for user in 'ab':
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={
+            'PK': {'S': f'u#old-{user}'}, 'SK': {'S': f'u#old-{user}'},
+            'avatar': {'B': b'\x89PNG' * 400}, 'keys': {'BS': [b'\x00\x01', b'\xff']},
+            'tags': {'L': [{'S': 'x'}, {'B': b'\x02'}]}
+        })
+    item = dynamodb_client.get_item(TableName=dynamodb_table, Key={'PK': {'S': 'u#old-a'}, 'SK': {'S': 'u#old-a'}})['Item']
+    assert DynamoDBUpdate._write_units(item) == 2
+    pair = DynamoDBUpdate._remap_pair({'username': 'a', 'old_sub': 'old-a', 'new_sub': 'new-a'}, item)
+    assert DynamoDBUpdate._request_token([pair]) == DynamoDBUpdate._request_token([pair])
+
+    for user, write_mode in [('a', 'transaction'), ('b', 'batch')]:
+        result = DynamoDBUpdate(aws_clients, remap_mode='query', write_mode=write_mode).update_dynamodb_sub(
+            [{'username': user, 'old_sub': f'old-{user}', 'new_sub': f'new-{user}'}]
+        )
+        assert result['records_updated'] == 1
+        assert result['failed_updates'] == []
+        moved = dynamodb_client.get_item(TableName=dynamodb_table, Key={'PK': {'S': f'u#new-{user}'}, 'SK': {'S': f'u#new-{user}'}})['Item']
+        assert moved['avatar']['B'] == b'\x89PNG' * 400
+
+
+@mock_aws
+def test_lambda_handler_sqs_event_failure_redelivers_every_message(s3_bucket, monkeypatch, aws_region):
+    """Test that an SQS event failing before its messages are processed reports every message as failed."""
+    monkeypatch.setenv('BACKUP_BUCKET_NAME', s3_bucket)
+    monkeypatch.setenv('REGION', aws_region)
+    monkeypatch.setenv('REMAP_MODE', 'unknown')
+    records = [
+        {'messageId': f'm{i}', 'eventSource': 'aws:sqs', 'body': '{"mappings": []}'}
+        for i in range(3)
+    ]
+
+    response = lambda_handler({'Records': records}, None)
+    assert response == {'batchItemFailures': [{'itemIdentifier': f'm{i}'} for i in range(3)]}
+
+
+@pytest.mark.parametrize('write_mode', ['transaction', 'batch'])
+@mock_aws
+def test_dynamodb_update_keeps_records_conflicting_with_the_new_key(dynamodb_table, aws_clients, write_mode):
+    """Test that a different item under the new key is a conflict that keeps both records, in either write mode."""
+    dynamodb_client = aws_clients.dynamodb_client
+    for sk in ('profile', 'settings', 'orders'):
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#old-a'}, 'SK': {'S': sk}, 'v': {'S': 'old'}, 'tags': {'SS': ['x', 'y']}})
+    # One record was already moved, another new key holds unrelated data
+    dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#new-a'}, 'SK': {'S': 'orders'}, 'v': {'S': 'old'}, 'tags': {'SS': ['y', 'x']}})
+    dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': 'u#new-a'}, 'SK': {'S': 'settings'}, 'v': {'S': 'new'}})
+    mappings = [{'username': 'a', 'old_sub': 'old-a', 'new_sub': 'new-a'}]
+
+    result = DynamoDBUpdate(aws_clients, remap_mode='query', write_mode=write_mode).update_dynamodb_sub(mappings)
+
+    assert result['records_updated'] == 1
+    assert result['already_migrated'] == 1
+    assert [(failure['sk'], failure['error']) for failure in result['failed_updates']] == \
+        [('settings', 'conflicting record exists under the new key')]
+    items = dynamodb_client.scan(TableName=dynamodb_table)['Items']
+    assert {(item['PK']['S'], item['SK']['S'], item['v']['S']) for item in items if item['PK']['S'].startswith('u#')} == {
+        ('u#new-a', 'profile', 'old'), ('u#new-a', 'orders', 'old'),
+        ('u#old-a', 'settings', 'old'), ('u#new-a', 'settings', 'new')
+    }
+
+
+@mock_aws
+def test_dynamodb_update_profile_probe_queries_users_it_could_not_check(dynamodb_table, aws_clients, monkeypatch):
+    """Test that keys the profile probe could not read (errors, unprocessed keys) are not taken as missing."""
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.remap_ledger.BATCH_RETRY_BASE_DELAY', 0)
+    dynamodb_client = aws_clients.dynamodb_client
+    for user in 'ab':
+        dynamodb_client.put_item(TableName=dynamodb_table, Item={'PK': {'S': f'u#old-{user}'}, 'SK': {'S': f'u#old-{user}'}})
+    queried = []
+    query = dynamodb_client.query
+    monkeypatch.setattr(dynamodb_client, 'query', lambda **kwargs: queried.append(kwargs['ExpressionAttributeValues'][':old_sub']['S']) or query(**kwargs))
+    batch_get_item = dynamodb_client.batch_get_item
+    # User b's profile key is never processed
+    def unprocessed_profile(**kwargs):
+        request = kwargs['RequestItems'][dynamodb_table]
+        response = batch_get_item(**kwargs)
+        response['Responses'][dynamodb_table] = [item for item in response['Responses'][dynamodb_table] if item['PK']['S'] != 'u#old-b']
+        if any(key['PK']['S'] == 'u#old-b' for key in request['Keys']):
+            response['UnprocessedKeys'] = {dynamodb_table: {**request, 'Keys': [{'PK': {'S': 'u#old-b'}, 'SK': {'S': 'u#old-b'}}]}}
+        return response
+    monkeypatch.setattr(dynamodb_client, 'batch_get_item', unprocessed_profile)
+    mappings = [{'username': user, 'old_sub': f'old-{user}', 'new_sub': f'new-{user}'} for user in 'abc']
+
+    result = DynamoDBUpdate(aws_clients, probe_profile=True).update_dynamodb_sub(mappings)
+    assert sorted(queried) == ['u#old-a', 'u#old-b']
+    assert result['users_without_records'] == 1
+    assert result['records_updated'] == 2
+
+    def failing_batch_get_item(**kwargs):
+        raise ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'x'}}, 'BatchGetItem')
+    monkeypatch.setattr(dynamodb_client, 'batch_get_item', failing_batch_get_item)
+    queried.clear()
+    result = DynamoDBUpdate(aws_clients, probe_profile=True).update_dynamodb_sub(mappings)
+    assert sorted(queried) == ['u#old-a', 'u#old-b', 'u#old-c']
+    assert result['users_without_records'] == 0
+
+
+@mock_aws
+def test_incremental_backup_with_user_strategy_detects_group_changes(user_pool, s3_bucket, aws_clients, aws_region):
+    """Test that per-user group lookups pick up membership changes that leave UserLastModifiedDate alone."""
+    cognito_client = aws_clients.cognito_client
+    s3_client = aws_clients.s3_client
+    cognito_client.create_group(GroupName='TestGroup', UserPoolId=user_pool)
+    for username in ['alice', 'bob']:
+        cognito_client.admin_create_user(UserPoolId=user_pool, Username=username, MessageAction='SUPPRESS')
+    backup = CognitoBackup(aws_clients, membership_strategy='user')
+    assert backup.backup_user_pool(user_pool, incremental=True)['backup_type'] == 'full'
+
+    cognito_client.admin_add_user_to_group(UserPoolId=user_pool, Username='alice', GroupName='TestGroup')
+    result = CognitoBackup(aws_clients, membership_strategy='user').backup_user_pool(user_pool, incremental=True)
+
+    assert result['backup_type'] == 'incremental'
+    assert result['users_backed_up'] == 1
+    assert result['users_unchanged'] == 1
+    delta_key = result['backup_location'].replace(f"s3://{s3_bucket}/", "")
+    users = {
+        user['Username']: user['Groups']
+        for user in iter_backup_users(s3_client, s3_bucket, load_manifest(s3_client, s3_bucket, delta_key))
+    }
+    assert users == {'alice': ['TestGroup'], 'bob': []}
+
+
+def test_sub_alias_resolver_backs_off_and_gives_up_on_unprocessed_keys(monkeypatch):
+    """Test that alias lookups retry UnprocessedKeys with backoff and raise once the retries run out."""
+    sleeps = []
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.sub_alias.time.sleep', sleeps.append)
+
+    class ThrottledClient:
+        def __init__(self, unprocessed_calls):
+            self.calls = 0
+            self.unprocessed_calls = unprocessed_calls
+
+        def batch_get_item(self, RequestItems):
+            self.calls += 1
+            if self.calls <= self.unprocessed_calls:
+                return {'Responses': {'table': []}, 'UnprocessedKeys': RequestItems}
+            return {'Responses': {'table': [{'PK': {'S': 'alias#old'}, 'new_sub': {'S': 'new'}}]}}
+
+    client = ThrottledClient(unprocessed_calls=2)
+    assert SubAliasResolver(client, 'table').resolve_many(['old']) == {'old': 'new'}
+    assert sleeps == [0.05, 0.1]
+
+    client = ThrottledClient(unprocessed_calls=100)
+    resolver = SubAliasResolver(client, 'table')
+    with pytest.raises(ValueError):
+        resolver.resolve('old')
+    assert client.calls == 9
+    assert resolver.cache_info()['size'] == 0
+
+
+def test_sqs_remap_queue_splits_batches_by_payload_size():
+    """Test that SendMessageBatch calls stay under both the message count and the 256 KiB payload limits."""
+    class RecordingSQS:
+        def __init__(self):
+            self.batches = []
+
+        def send_message_batch(self, QueueUrl, Entries):
+            self.batches.append([entry['MessageBody'] for entry in Entries])
+            return {'Successful': Entries}
+
+    sqs = RecordingSQS()
+    queue = SQSRemapQueue(sqs, 'url')
+    large = ['x' * 100 * 1024] * 5
+    small = ['y'] * 12
+    queue.send_batch(large + small)
+
+    assert [len(batch) for batch in sqs.batches] == [2, 2, 10, 3]
+    assert all(sum(len(body) for body in batch) <= 256 * 1024 for batch in sqs.batches)
+    with pytest.raises(ValueError):
+        queue.send_batch(['z' * (256 * 1024 + 1)])
+
+
+@mock_aws
+def test_cognito_restore_import_job_creation_resumes_after_time_budget(user_pool, aws_clients, monkeypatch):
+    """Test that import jobs are created within the time budget and a resume continues with the next job's users."""
+    cognito_client = aws_clients.cognito_client
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.user_import.MAX_USERS_PER_JOB', 1)
+    job_ids = iter(f'job-{i}' for i in range(10))
+    uploads, started = [], []
+
+    def upload(url, path):
+        with open(path, encoding='utf-8') as csv_file:
+            uploads.append([row[0] for row in csv.reader(csv_file)][1:])
+
+    monkeypatch.setattr(cognito_client, 'get_csv_header', lambda **kwargs: {'CSVHeader': ['cognito:username', 'email']})
+    monkeypatch.setattr(cognito_client, 'create_user_import_job', lambda **kwargs: {'UserImportJob': {'JobId': next(job_ids), 'Status': 'Created', 'PreSignedUrl': 'https://upload'}})
+    monkeypatch.setattr(cognito_client, 'start_user_import_job', lambda **kwargs: started.append(kwargs['JobId']) or {})
+    monkeypatch.setattr(cognito_client, 'describe_user_import_job', lambda **kwargs: {'UserImportJob': {'JobId': kwargs['JobId'], 'Status': 'Succeeded', 'ImportedUsers': 0}})
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.user_import.upload_import_csv', upload)
+
+    users = [
+        {'Username': f'user{i}', 'Attributes': [{'Name': 'sub', 'Value': f'old-sub-{i}'}], 'Groups': []}
+        for i in range(3)
+    ]
+    aws_clients.s3_client.put_object(Bucket=aws_clients.bucket_name, Key='import-create.json', Body=json.dumps({'timestamp': 'now', 'groups': [], 'users': users}))
+    role_arn = 'arn:aws:iam::123456789012:role/import'
+    restore = CognitoRestore(aws_clients, import_role_arn=role_arn, import_poll_interval=0, time_budget=TimeBudget(FakeLambdaContext(checks=1)))
+    result = restore.restore_user_pool('import-create.json', user_pool, restore_mode='import')
+
+    assert result['status'] == 'in_progress'
+    assert result['phase'] == 'import'
+    checkpoint = RestoreCheckpoint.load(aws_clients.s3_client, aws_clients.bucket_name, result['checkpoint_key'])
+    assert [job['job_id'] for job in checkpoint.state['import_jobs']] == ['job-0', 'job-1']
+    assert checkpoint.state['import_users_written'] == 2
+    assert started == []
+
+    resumed = CognitoRestore(aws_clients, import_role_arn=role_arn, import_poll_interval=0).resume_user_pool(checkpoint)
+    assert resumed['status'] == 'success'
+    assert uploads == [['user0'], ['user1'], ['user2']]
+    assert started == ['job-0', 'job-1', 'job-2']
+    assert resumed['users_restored'] == 3
+
+
+def test_backup_compaction_merges_runs_in_bounded_passes(tmp_path, monkeypatch):
+    """Test that runs are merged a few files at a time and deletions still hide older versions across passes."""
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.compaction.MERGE_FAN_IN', 2)
+    compaction = BackupCompaction(None)
+    # Runs of a base (priority 0) and four deltas; bob is deleted in the last delta
+    versions = [
+        [('alice', 0), ('bob', 0), ('dave', 0)],
+        [('carol', 1)],
+        [('alice', 2)],
+        [('eve', 3)],
+        [('bob', 4), ('carol', 4)]
+    ]
+    runs = [
+        BackupCompaction._write_run(
+            ((name, -priority, {'Username': name, 'v': priority, **({'Deleted': True} if name == 'bob' and priority == 4 else {})})
+             for name, priority in run),
+            str(tmp_path), number
+        )
+        for number, run in enumerate(versions)
+    ]
+
+    reduced = compaction._reduce_runs(runs, str(tmp_path))
+    assert len(reduced) <= 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(os.path.basename(path) for path in reduced)
+    files = [open(path, encoding='utf-8') for path in reduced]
+    try:
+        merged = [(user['Username'], user['v']) for user in BackupCompaction._merge_runs(files)]
+    finally:
+        for file in files:
+            file.close()
+    assert merged == [('alice', 2), ('carol', 4), ('dave', 0), ('eve', 3)]
+
+
+@mock_aws
+def test_v2_backup_prefix_comes_from_a_single_clock_reading(user_pool, aws_clients, monkeypatch):
+    """Test that the seconds and microseconds of a v2 backup prefix are read together, so prefixes sort in time order."""
+    class SteppingDatetime(datetime):
+        """datetime whose clock advances a microsecond per reading, starting just before a second boundary."""
+        current = datetime(2026, 1, 1, 12, 0, 0, 999999, tzinfo=UTC)
+
+        @classmethod
+        def now(cls, tz=None):
+            reading = cls.current
+            cls.current += timedelta(microseconds=1)
+            return reading
+
+    monkeypatch.setattr('cognito_backup_restore.lambda_code.backup.datetime', SteppingDatetime)
+    result = CognitoBackup(aws_clients, backup_format='v2', max_workers=1).backup_user_pool(user_pool)
+
+    assert f'/cognito-backups/{user_pool}/2026-01-01_12-00-00-999999/' in result['backup_location']
@@ -44,6 +44,7 @@ resource "aws_iam_role_policy" "lambda_policy" {
         Action = [
           "s3:GetObject",
           "s3:PutObject",
+          "s3:AbortMultipartUpload",
           "s3:ListBucket"
         ]
         Resource = [
@@ -59,12 +60,88 @@ resource "aws_iam_role_policy" "lambda_policy" {
           "cognito-idp:DescribeUserPoolClient",
           "cognito-idp:ListUsers",
           "cognito-idp:ListGroups",
+          "cognito-idp:ListUsersInGroup",
+          "cognito-idp:AdminListGroupsForUser",
           "cognito-idp:CreateUserPool",
           "cognito-idp:AdminCreateUser",
           "cognito-idp:AdminSetUserPassword",
-          "cognito-idp:CreateGroup"
+          "cognito-idp:AdminGetUser",
+          "cognito-idp:AdminAddUserToGroup",
+          "cognito-idp:CreateGroup",
+          "cognito-idp:GetCSVHeader",
+          "cognito-idp:CreateUserImportJob",
+          "cognito-idp:StartUserImportJob",
+          "cognito-idp:DescribeUserImportJob"
         ]
         Resource = "*"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "iam:PassRole"
+        ]
+        Resource = aws_iam_role.cognito_import_role.arn
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "lambda:InvokeFunction"
+        ]
+        Resource = "arn:aws:lambda:*:*:function:${var.projectName}-${var.environment}-cognito-backup-restore"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "sqs:SendMessage",
+          "sqs:ReceiveMessage",
+          "sqs:DeleteMessage",
+          "sqs:ChangeMessageVisibility",
+          "sqs:GetQueueAttributes"
+        ]
+        Resource = aws_sqs_queue.remap_queue.arn
+      }
+    ]
+  })
+}
+
+# IAM role Cognito user import jobs write their CloudWatch logs with
+resource "aws_iam_role" "cognito_import_role" {
+  name = "${var.projectName}-${var.environment}-cognito-import-role"
+
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = "sts:AssumeRole"
+        Effect = "Allow"
+        Principal = {
+          Service = "cognito-idp.amazonaws.com"
+        }
+      }
+    ]
+  })
+
+  tags = {
+    Name = "${var.projectName}-${var.environment}-Cognito-Import-Role"
+  }
+}
+
+resource "aws_iam_role_policy" "cognito_import_policy" {
+  name = "${var.projectName}-${var.environment}-cognito-import-policy"
+  role = aws_iam_role.cognito_import_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:DescribeLogStreams",
+          "logs:PutLogEvents"
+        ]
+        Resource = "arn:aws:logs:*:*:log-group:/aws/cognito/*"
       }
     ]
   })
@@ -82,6 +159,10 @@ resource "aws_lambda_function" "cognito_backup_restore" {
   environment {
     variables = {
       BACKUP_BUCKET_NAME      = var.s3_bucket_name
+      AUTO_CONTINUE           = "true"
+      REMAP_QUEUE_URL         = aws_sqs_queue.remap_queue.url
+      IMPORT_ROLE_ARN         = aws_iam_role.cognito_import_role.arn
+      BACKUP_FORMAT           = var.backup_format
     }
   }
   tags = {
@@ -89,3 +170,25 @@ resource "aws_lambda_function" "cognito_backup_restore" {
   }
 }
 
+# Queue of DynamoDB sub remap work published by restores
+resource "aws_sqs_queue" "remap_dead_letter_queue" {
+  name                      = "${var.projectName}-${var.environment}-cognito-remap-dlq"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue" "remap_queue" {
+  name                       = "${var.projectName}-${var.environment}-cognito-remap"
+  visibility_timeout_seconds = 660                # longer than the Lambda timeout
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.remap_dead_letter_queue.arn
+    maxReceiveCount     = 5
+  })
+}
+
+resource "aws_lambda_event_source_mapping" "remap_worker" {
+  event_source_arn        = aws_sqs_queue.remap_queue.arn
+  function_name           = aws_lambda_function.cognito_backup_restore.arn
+  batch_size              = 10
+  function_response_types = ["ReportBatchItemFailures"]
+}
@@ -8,4 +8,8 @@ output "cognito_backup_lambda_function_arn" {
 
 output "lambda_execution_role_arn" {
   value = aws_iam_role.lambda_execution_role.arn
+}
+
+output "remap_queue_url" {
+  value = aws_sqs_queue.remap_queue.url
 }
\ No newline at end of file
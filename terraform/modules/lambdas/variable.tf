@@ -4,3 +4,7 @@ variable "s3_bucket_name" {}
 variable "s3_bucket_arn" {}
 variable "lambda_image_uri" {}
 
+# Backup layout: v1 (single JSON object) or v2 (sharded, checkpointed, resumable)
+variable "backup_format" {
+  default = "v1"
+}